@@ -0,0 +1,132 @@
+# agents/answer_cache.py
+import copy
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+    Кэш готовых ответов в памяти.
+    Сначала ищется точное совпадение нормализованного вопроса, затем -
+    похожий вопрос по косинусной схожести эмбеддингов (не ниже similarity_threshold).
+    Записи привязаны к области поиска (scope: версия индекса, фильтры),
+    поэтому после переиндексации документа старые ответы не находятся.
+    Вытеснение - по TTL и LRU.
+    """
+
+    def __init__(self, max_entries: int = 500, ttl_seconds: float = 3600,
+                 similarity_threshold: float = 0.92):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[Tuple[Hashable, str], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        """Нормализация вопроса: NFC, регистр, пробелы, финальная пунктуация"""
+        text = ' '.join(unicodedata.normalize('NFC', question).casefold().split())
+        return text.rstrip(' ?!.…')
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def get_exact(self, question: str, scope: Hashable) -> Optional[Dict[str, Any]]:
+        """Ответ на тот же (после нормализации) вопрос в той же области"""
+        key = (scope, self.normalize_question(question))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(key, entry):
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return self._hit(entry, 'exact', 1.0)
+
+    def get_similar(self, query_embedding, scope: Hashable) -> Optional[Dict[str, Any]]:
+        """Ответ на ближайший по смыслу вопрос; промах учитывается в статистике"""
+        query = self._unit(query_embedding)
+        with self._lock:
+            self._drop_expired()
+            keys = [key for key in self._entries if key[0] == scope]
+            if keys:
+                matrix = np.stack([self._entries[key]['embedding'] for key in keys])
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    key = keys[best]
+                    self._entries.move_to_end(key)
+                    self.semantic_hits += 1
+                    return self._hit(self._entries[key], 'semantic', float(scores[best]))
+            self.misses += 1
+            return None
+
+    def put(self, question: str, query_embedding, scope: Hashable, result: Dict[str, Any]):
+        key = (scope, self.normalize_question(question))
+        with self._lock:
+            self._entries[key] = {
+                'question': question,
+                'embedding': self._unit(query_embedding),
+                'result': copy.deepcopy(result),
+                'created_at': time.time()
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _hit(self, entry: Dict[str, Any], kind: str, similarity: float) -> Dict[str, Any]:
+        result = copy.deepcopy(entry['result'])
+        result['cache'] = {
+            'type': kind,
+            'similarity': round(similarity, 4),
+            'question': entry['question'],
+            'age_s': int(time.time() - entry['created_at'])
+        }
+        return result
+
+    def _expired(self, key, entry) -> bool:
+        if self.ttl_seconds and time.time() - entry['created_at'] > self.ttl_seconds:
+            del self._entries[key]
+            self.expirations += 1
+            return True
+        return False
+
+    def _drop_expired(self):
+        if not self.ttl_seconds:
+            return
+        deadline = time.time() - self.ttl_seconds
+        for key in [k for k, e in self._entries.items() if e['created_at'] < deadline]:
+            del self._entries[key]
+            self.expirations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.exact_hits + self.semantic_hits
+        total = hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'capacity': self.max_entries,
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': round(hits / total, 3) if total else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
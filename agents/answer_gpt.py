@@ -4,6 +4,10 @@ import asyncio
 import json
 from typing import List, Dict, Any, Optional
 
+from agents.prompt_builder import SYSTEM_PROMPT, GenerationError, build_messages, format_context, parse_usage
+from agents.context_packer import ContextPacker
+from agents.llm_pool import LLMPool
+
 class AnswerGPTAgentAsync:
     """
     Асинхронный агент для максимальной производительности
@@ -11,53 +15,126 @@ class AnswerGPTAgentAsync:
     
     def __init__(self, 
                  api_base: str = "http://localhost:1234/v1", 
-                 model: str = "local-model"):
+                 model: str = "local-model",
+                 temperature: float = 0.3,
+                 max_tokens: int = 1000,
+                 timeout: float = 120.0,
+                 http2: bool = True,
+                 context_packer: Optional[ContextPacker] = None,
+                 prompt_layout: str = "question_first",
+                 cache_prompt: bool = False,
+                 pool: Optional[LLMPool] = None):
         
-        self.api_base = api_base.rstrip('/')
+        # Пул серверов генерации (балансировка, failover, хеджирование);
+        # без него - один сервер api_base
+        self.pool = pool or LLMPool([api_base], timeout=timeout, health_interval=None, http2=http2)
+        self.api_base = self.pool.primary_url
         self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.system_prompt = SYSTEM_PROMPT
+        # Упаковка контекста по бюджету токенов (общая для агентов генерации)
+        self.context_packer = context_packer or ContextPacker()
+        self.prompt_layout = prompt_layout
+        self.cache_prompt = cache_prompt  # llama.cpp: переиспользовать KV-кэш общего префикса
         
-        # Асинхронный клиент
-        self.client = httpx.AsyncClient(
-            timeout=120.0,
-            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
-            headers={"Content-Type": "application/json"},
-            http2=True
-        )
+        # Асинхронный клиент пула
+        self.client = self.pool.client
     
-    async def generate_answer_async(self, query: str, context_chunks: List[Dict]) -> str:
-        """Асинхронная генерация ответа"""
-        
+    def _build_payload(self, query: str, context_chunks: List[Dict], stream: bool = False) -> Dict[str, Any]:
         context_text = self._format_context(context_chunks)
         
         payload = {
             "model": self.model,
-            "messages": [
-                {"role": "system", "content": "Ты - ассистент по анализу документов."},
-                {"role": "user", "content": f"Контекст: {context_text}\n\nВопрос: {query}"}
-            ],
-            "temperature": 0.3,
-            "max_tokens": 1000
+            "messages": build_messages(query, context_text, self.system_prompt, self.prompt_layout),
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
         }
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        if self.cache_prompt:
+            payload["cache_prompt"] = True
+        return payload
+    
+    async def generate_answer_async(self, query: str, context_chunks: List[Dict],
+                                    usage: Optional[Dict] = None) -> str:
+        """
+        Асинхронная генерация ответа.
+        usage - словарь, куда записываются токены промпта/ответа и токены из кэша сервера
+        """
+        
+        if not context_chunks:
+            return GenerationError("Нет контекста для генерации ответа.")
+        
+        payload = self._build_payload(query, context_chunks)
         
         try:
-            response = await self.client.post(
-                f"{self.api_base}/chat/completions",
-                json=payload
-            )
+            response = await self.pool.apost("/chat/completions", payload)
             
             if response.status_code == 200:
                 data = response.json()
+                if usage is not None:
+                    usage.update(parse_usage(data))
                 return data['choices'][0]['message']['content']
             else:
-                return f"Ошибка: {response.status_code}"
+                return GenerationError(f"Ошибка: {response.status_code}")
+                
+        except httpx.TimeoutException:
+            return GenerationError("Таймаут при обращении к LM Studio. Модель слишком медленная или сервер перегружен.")
+        except Exception as e:
+            return GenerationError(f"Ошибка: {str(e)}")
+    
+    async def stream_answer(self, query: str, context_chunks: List[Dict],
+                            usage: Optional[Dict] = None):
+        """
+        Потоковая генерация: читает SSE-поток OpenAI-совместимого API
+        и отдает фрагменты текста по мере их появления.
+        usage заполняется из финального события потока (если сервер его присылает)
+        """
+        if not context_chunks:
+            yield GenerationError("Нет контекста для генерации ответа.")
+            return
+        
+        payload = self._build_payload(query, context_chunks, stream=True)
+        
+        try:
+            async with self.pool.stream("/chat/completions", payload) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    yield GenerationError(f"Ошибка API (статус {response.status_code}): {response.text[:200]}")
+                    return
                 
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        event = json.loads(data)
+                    except json.JSONDecodeError:
+                        continue
+                    
+                    if usage is not None and (event.get('usage') or event.get('timings')):
+                        usage.update(parse_usage(event))
+                    choices = event.get('choices') or []
+                    if not choices:
+                        continue
+                    delta = choices[0].get('delta') or {}
+                    text = delta.get('content') or choices[0].get('text')
+                    if text:
+                        yield text
+                        
+        except httpx.TimeoutException:
+            yield GenerationError("Таймаут при обращении к LM Studio. Модель слишком медленная или сервер перегружен.")
         except Exception as e:
-            return f"Ошибка: {str(e)}"
+            yield GenerationError(f"Ошибка: {str(e)}")
     
     def _format_context(self, chunks: List[Dict]) -> str:
         """Форматирование контекста"""
-        return "\n\n".join([chunk.get('text', '') for chunk in chunks[:5]])
+        return format_context(chunks, self.context_packer)
     
     async def close(self):
         """Закрытие клиента"""
-        await self.client.aclose()
\ No newline at end of file
+        await self.pool.aclose()
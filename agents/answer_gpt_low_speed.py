@@ -4,6 +4,10 @@ import json
 import time
 from typing import List, Dict, Any, Optional
 
+from agents.prompt_builder import SYSTEM_PROMPT, GenerationError, build_messages, format_context, parse_usage
+from agents.context_packer import ContextPacker
+from agents.llm_pool import LLMPool
+
 class AnswerGPTAgent:
     """
     Агент для генерации ответов через LM Studio
@@ -15,70 +19,62 @@ class AnswerGPTAgent:
                  model: str = "local-model", 
                  temperature: float = 0.2, 
                  max_tokens: int = 500,
-                 timeout: int = 180):
+                 timeout: int = 180,
+                 context_packer: Optional[ContextPacker] = None,
+                 prompt_layout: str = "question_first",
+                 cache_prompt: bool = False,
+                 pool: Optional[LLMPool] = None):
         
-        self.api_base = api_base.rstrip('/')
+        # Пул серверов генерации; без него - один сервер api_base
+        self.pool = pool or LLMPool([api_base], timeout=timeout, health_interval=None)
+        self.api_base = self.pool.primary_url
         self.model = model
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.timeout = timeout
-        self.session = requests.Session()
-        
-        # Настройка заголовков
-        self.session.headers.update({
-            "Content-Type": "application/json"
-        })
         
-        self.system_prompt = """Ты - ассистент по анализу документов. 
-        Используй предоставленные фрагменты документа для ответа.
-        Обязательно указывай номера глав и разделов в ответе.
-        Если информации недостаточно - так и скажи.
-        Отвечай на том же языке, на котором задан вопрос."""
+        self.system_prompt = SYSTEM_PROMPT
+        # Упаковка контекста по бюджету токенов (общая для агентов генерации)
+        self.context_packer = context_packer or ContextPacker()
+        self.prompt_layout = prompt_layout
+        self.cache_prompt = cache_prompt  # llama.cpp: переиспользовать KV-кэш общего префикса
         
         print(f"✅ AnswerGPTAgent инициализирован (прямые HTTP запросы)")
         print(f"   API: {self.api_base}, Модель: {self.model}")
     
     def check_connection(self) -> bool:
-        """Проверка подключения к LM Studio"""
+        """Проверка подключения к серверам LM Studio (GET /models)"""
         try:
-            response = self.session.get(
-                f"{self.api_base}/models",
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                models = []
-                if 'data' in data:
-                    models = [m['id'] for m in data['data']]
-                elif 'models' in data:
-                    models = data['models']
-                
-                print(f"✅ LM Studio доступна. Модели: {models}")
+            available = False
+            for backend in self.pool.check_all():
+                if not backend['healthy']:
+                    print(f"❌ Не удалось подключиться к {backend['url']}")
+                    continue
+                available = True
+                print(f"✅ LM Studio доступна ({backend['url']}). Модели: {backend['models']}")
                 
                 # Если наша модель не указана, используем первую доступную
-                if self.model == "local-model" and models:
-                    self.model = models[0]
+                if self.model == "local-model" and backend['models']:
+                    self.model = backend['models'][0]
                     print(f"   Автоматически выбрана модель: {self.model}")
+            
+            if not available:
+                print("   Убедитесь, что LM Studio запущена и сервер активен")
+            return available
                 
-                return True
-            else:
-                print(f"❌ LM Studio вернула статус {response.status_code}")
-                return False
-                
-        except requests.exceptions.ConnectionError:
-            print(f"❌ Не удалось подключиться к {self.api_base}")
-            print("   Убедитесь, что LM Studio запущена и сервер активен")
-            return False
         except Exception as e:
             print(f"❌ Ошибка проверки подключения: {e}")
             return False
     
-    def generate_answer(self, query: str, context_chunks: List[Dict]) -> str:
-        """Генерация ответа через прямой HTTP запрос"""
+    def generate_answer(self, query: str, context_chunks: List[Dict],
+                        usage: Optional[Dict] = None) -> str:
+        """
+        Генерация ответа через прямой HTTP запрос.
+        usage - словарь, куда записываются токены промпта/ответа и токены из кэша сервера
+        """
         
         if not context_chunks:
-            return "Нет контекста для генерации ответа."
+            return GenerationError("Нет контекста для генерации ответа.")
         
         # Форматируем контекст
         context_text = self._format_context(context_chunks)
@@ -86,120 +82,51 @@ class AnswerGPTAgent:
         # Формируем запрос в формате OpenAI API
         payload = {
             "model": self.model,
-            "messages": [
-                {
-                    "role": "system", 
-                    "content": self.system_prompt
-                },
-                {
-                    "role": "user", 
-                    "content": f"""
-Вопрос: {query}
-
-Контекст из документа:
-{context_text}
-
-Ответь на вопрос, используя только предоставленный контекст.
-Укажи источники (глава, раздел) в ответе.
-"""
-                }
-            ],
+            "messages": build_messages(query, context_text, self.system_prompt, self.prompt_layout),
             "temperature": self.temperature,
             "max_tokens": self.max_tokens,
             "stream": False
         }
+        if self.cache_prompt:
+            payload["cache_prompt"] = True
         
-        # Пробуем отправить запрос
-        for attempt in range(2):  # Две попытки
-            try:
-                response = self.session.post(
-                    f"{self.api_base}/chat/completions",
-                    json=payload,
-                    timeout=self.timeout
-                )
+        # Пул сам переключается на другой сервер при ошибке соединения или 5xx
+        try:
+            response = self.pool.post("/chat/completions", payload, timeout=self.timeout)
+            
+            if response.status_code == 200:
+                data = response.json()
+                if usage is not None:
+                    usage.update(parse_usage(data))
                 
-                if response.status_code == 200:
-                    data = response.json()
-                    
-                    # Извлекаем ответ из разных форматов
-                    if 'choices' in data and len(data['choices']) > 0:
-                        if 'message' in data['choices'][0]:
-                            return data['choices'][0]['message']['content']
-                        elif 'text' in data['choices'][0]:
-                            return data['choices'][0]['text']
-                    
-                    return "Получен пустой ответ от модели."
-                    
-                elif response.status_code == 404:
-                    return f"Модель '{self.model}' не найдена. Проверьте название модели в LM Studio."
-                else:
-                    error_text = response.text[:200]
-                    return f"Ошибка API (статус {response.status_code}): {error_text}"
-                    
-            except requests.exceptions.Timeout:
-                if attempt == 0:
-                    print(f"⏱️ Таймаут, пробую еще раз...")
-                    time.sleep(2)
-                    continue
-                return "Таймаут при обращении к LM Studio. Модель слишком медленная или сервер перегружен."
+                # Извлекаем ответ из разных форматов
+                if 'choices' in data and len(data['choices']) > 0:
+                    if 'message' in data['choices'][0]:
+                        return data['choices'][0]['message']['content']
+                    elif 'text' in data['choices'][0]:
+                        return data['choices'][0]['text']
                 
-            except requests.exceptions.ConnectionError:
-                return "Ошибка подключения к LM Studio. Сервер не доступен."
+                return GenerationError("Получен пустой ответ от модели.")
                 
-            except Exception as e:
-                print(f"❌ Ошибка при запросе: {e}")
-                if attempt == 0:
-                    continue
-                return f"Ошибка при генерации ответа: {str(e)}"
-        
-        return "Не удалось получить ответ после нескольких попыток."
-    
-    def _format_context(self, chunks: List[Dict]) -> str:
-        """Форматирование контекста с ограничением размера"""
-        formatted = []
-        total_length = 0
-        MAX_CONTEXT_LENGTH = 2000  # Ограничиваем контекст
-        
-        for i, chunk in enumerate(chunks, 1):
-            # Получаем текст чанка
-            chunk_text = ""
-            if isinstance(chunk, dict):
-                chunk_text = chunk.get('text', '')
-                if not chunk_text:
-                    chunk_text = chunk.get('content', '')
+            elif response.status_code == 404:
+                return GenerationError(f"Модель '{self.model}' не найдена. Проверьте название модели в LM Studio.")
             else:
-                chunk_text = str(chunk)
-            
-            if not chunk_text:
-                continue
-            
-            # Получаем метаданные
-            metadata = chunk.get('metadata', {}) if isinstance(chunk, dict) else {}
-            
-            # Формируем источник
-            source_info = []
-            if metadata.get('chapter_title'):
-                source_info.append(f"Глава: {metadata['chapter_title']}")
-            if metadata.get('section_title'):
-                source_info.append(f"Раздел: {metadata['section_title']}")
-            
-            source_str = f"[{', '.join(source_info)}]" if source_info else ""
-            
-            # Обрезаем слишком длинные чанки
-            if len(chunk_text) > 500:
-                chunk_text = chunk_text[:500] + "..."
-            
-            # Формируем фрагмент
-            fragment = f"Фрагмент {i} {source_str}:\n{chunk_text}"
+                error_text = response.text[:200]
+                return GenerationError(f"Ошибка API (статус {response.status_code}): {error_text}")
+                
+        except requests.exceptions.Timeout:
+            return GenerationError("Таймаут при обращении к LM Studio. Модель слишком медленная или сервер перегружен.")
             
-            # Проверяем общую длину
-            if total_length + len(fragment) > MAX_CONTEXT_LENGTH:
-                break
+        except requests.exceptions.ConnectionError:
+            return GenerationError("Ошибка подключения к LM Studio. Сервер не доступен.")
             
-            formatted.append(fragment)
-            total_length += len(fragment)
-        
-        return "\n\n".join(formatted)
+        except Exception as e:
+            print(f"❌ Ошибка при запросе: {e}")
+            return GenerationError(f"Ошибка при генерации ответа: {str(e)}")
+    
+    def _format_context(self, chunks: List[Dict]) -> str:
+        """Форматирование контекста в пределах бюджета токенов"""
+        return format_context(chunks, self.context_packer)
     
     def __repr__(self):
         return f"AnswerGPTAgent(api={self.api_base}, model={self.model})"
\ No newline at end of file
@@ -0,0 +1,55 @@
+# agents/batch_documents.py
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from agents.doc_parser import DocParserAgent, collect_sections
+from agents.smart_chunker import split_sentences
+from agents.corpus_router import make_document_id
+
+
+def prepare_document(docx_path: str, streaming: bool = False,
+                     document_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Подготовка документа в процессе пула: парсинг структуры и разбиение
+    текстов глав/разделов на предложения. Модели здесь не нужны -
+    кодирование выполняется в основном процессе, общим пакетом на несколько документов.
+    """
+    started = time.perf_counter()
+    structure = DocParserAgent().parse_with_hierarchy(docx_path, streaming=streaming)
+    section_texts, section_meta = collect_sections(structure)
+    results, section_sentences = split_sentences(section_texts)
+    return {
+        'path': docx_path,
+        'document_id': document_id or make_document_id(os.path.basename(docx_path)),
+        'structure': structure,
+        'section_texts': section_texts,
+        'section_meta': section_meta,
+        'results': results,
+        'section_sentences': section_sentences,
+        'sentences': sum(len(s) for s in section_sentences.values()),
+        'prepare_s': time.perf_counter() - started
+    }
+
+
+def find_documents(paths: List[str], root: Optional[str] = None) -> List[Tuple[str, str]]:
+    """
+    Файлы .docx из списка путей (папки обходятся рекурсивно) и их id.
+    id строится по пути относительно root (по умолчанию - обходимой папки),
+    поэтому одноименные файлы из разных подпапок - разные документы;
+    у файла в корне папки id тот же, что при загрузке по имени.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            base = root or path
+            for folder, folders, files in os.walk(path):
+                folders.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.docx') and not name.startswith('~$'):
+                        file_path = os.path.join(folder, name)
+                        relative = os.path.relpath(file_path, base).replace(os.sep, '/')
+                        found.append((file_path, make_document_id(relative)))
+        elif path.lower().endswith('.docx'):
+            found.append((path, make_document_id(os.path.basename(path))))
+    return found
@@ -0,0 +1,226 @@
+# agents/context_packer.py
+import re
+import math
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+WORD_PATTERN = re.compile(r"[^\W\d_]+|\d+|[^\w\s]")
+CYRILLIC_PATTERN = re.compile(r"[а-яё]", re.IGNORECASE)
+
+
+class TokenCounter:
+    """
+    Подсчет токенов токенизатором генерирующей модели (transformers, имя модели
+    на Hugging Face или локальный путь). Без него - локальная оценка:
+    кириллица ~3 символа на токен, латиница ~5, числа - по 3 цифры, знаки - по одному.
+    """
+
+    def __init__(self, tokenizer_name: Optional[str] = None, cache_size: int = 20000):
+        self.tokenizer_name = tokenizer_name
+        self.tokenizer = None
+        self.backend = 'heuristic'
+
+        if tokenizer_name:
+            try:
+                from transformers import AutoTokenizer
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+                self.backend = 'transformers'
+                print(f"✅ Токенизатор контекста: {tokenizer_name}")
+            except Exception as e:
+                print(f"⚠️ Токенизатор {tokenizer_name} не загружен ({e}), используется оценка")
+
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        tokens = 0
+        for word in WORD_PATTERN.findall(text):
+            if word.isdigit():
+                tokens += math.ceil(len(word) / 3)
+            elif word.isalpha():
+                tokens += math.ceil(len(word) / (3 if CYRILLIC_PATTERN.search(word) else 5))
+            else:
+                tokens += 1
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Самый длинный префикс текста (по границе слова) не длиннее max_tokens"""
+        if self.count(text) <= max_tokens:
+            return text
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.count(text[:mid]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        cut = text[:low]
+        if ' ' in cut:
+            cut = cut[:cut.rfind(' ')]
+        return cut.rstrip() + "..."
+
+
+def format_fragment(number: int, text: str, metadata: Dict[str, Any]) -> str:
+    """Фрагмент контекста с указанием источника (глава, раздел, подраздел)"""
+    source_info = []
+    if metadata.get('chapter_title'):
+        source_info.append(f"Глава: {metadata['chapter_title']}")
+    if metadata.get('section_title'):
+        source_info.append(f"Раздел: {metadata['section_title']}")
+    if metadata.get('subsection_title'):
+        source_info.append(f"Подраздел: {metadata['subsection_title']}")
+    source_str = f"[{', '.join(source_info)}]" if source_info else ""
+    return f"Фрагмент {number} {source_str}:\n{text}"
+
+
+def natural_key(value) -> tuple:
+    """
+    Ключ сортировки с учетом чисел: ch_2 < ch_10. Части помечены типом
+    (0 - число, 1 - текст), поэтому id вида «2023_отчет» и «устав» сравнимы.
+    """
+    return tuple((0, int(part), '') if part.isdigit() else (1, 0, part)
+                 for part in re.split(r'(\d+)', str(value or '')) if part)
+
+
+def strip_overlap(previous: str, following: str, min_chars: int = 20, max_chars: int = 600) -> str:
+    """Удаление из начала following текста, повторяющего конец previous (перекрытие чанков)"""
+    limit = min(len(previous), len(following), max_chars)
+    for size in range(limit, min_chars - 1, -1):
+        if previous.endswith(following[:size]):
+            return following[size:].lstrip()
+    return following
+
+
+class ContextPacker:
+    """
+    Упаковка найденных чанков в контекст промпта в пределах бюджета токенов.
+    Чанки берутся по релевантности, пока помещаются в бюджет; дубликаты
+    и перекрытия соседних чанков удаляются, соседние чанки одного раздела
+    склеиваются в один фрагмент (один заголовок вместо нескольких).
+    order='document' выстраивает фрагменты в порядке документа, а не по
+    релевантности: одинаковый набор чанков дает одинаковый текст контекста.
+    """
+
+    ORDERS = ('relevance', 'document')
+
+    MIN_FRAGMENT_TOKENS = 64  # меньший остаток бюджета не заполняем обрезком чанка
+
+    def __init__(self, token_counter: Optional[TokenCounter] = None,
+                 budget_tokens: int = 2500, merge_adjacent: bool = True,
+                 order: str = 'relevance'):
+        if order not in self.ORDERS:
+            raise ValueError(f"Неизвестный порядок контекста: {order}. Доступны: {', '.join(self.ORDERS)}")
+        self.order = order
+        self.counter = token_counter or TokenCounter()
+        self.budget_tokens = budget_tokens
+        self.merge_adjacent = merge_adjacent
+        self.last_stats: Dict[str, Any] = {}
+
+    @staticmethod
+    def _chunk_text(chunk) -> str:
+        if isinstance(chunk, dict):
+            return chunk.get('text', '') or chunk.get('content', '')
+        return str(chunk)
+
+    @staticmethod
+    def _group_key(metadata: Dict[str, Any]) -> tuple:
+        return (metadata.get('document_id'), metadata.get('chapter_id'), metadata.get('section_id'),
+                metadata.get('subsection_id'))
+
+    def select(self, chunks: List[Dict]) -> List[Dict]:
+        """Отбор чанков по релевантности в пределах бюджета, без дубликатов"""
+        header_tokens = self.counter.count(format_fragment(0, '', {'chapter_title': 'x', 'section_title': 'x'}))
+        remaining = self.budget_tokens
+        selected = []
+        kept_texts: List[str] = []
+        skipped_duplicates = 0
+
+        for rank, chunk in enumerate(chunks):
+            text = ' '.join(self._chunk_text(chunk).split())
+            if not text:
+                continue
+            if any(text in kept for kept in kept_texts):
+                skipped_duplicates += 1
+                continue
+
+            metadata = chunk.get('metadata', {}) if isinstance(chunk, dict) else {}
+            cost = self.counter.count(text) + header_tokens
+            if cost > remaining:
+                if selected and remaining - header_tokens < self.MIN_FRAGMENT_TOKENS:
+                    continue
+                if remaining - header_tokens < self.MIN_FRAGMENT_TOKENS:
+                    break
+                # Обрезаем чанк под остаток бюджета
+                text = self.counter.truncate(text, remaining - header_tokens)
+                cost = self.counter.count(text) + header_tokens
+
+            selected.append({'text': text, 'metadata': metadata, 'rank': rank})
+            kept_texts.append(text)
+            remaining -= cost
+
+        self.last_stats = {
+            'candidates': len(chunks),
+            'selected': len(selected),
+            'duplicates': skipped_duplicates,
+            'budget_tokens': self.budget_tokens
+        }
+        return selected
+
+    def fit(self, chunks: List[Dict]) -> List[Dict]:
+        """Исходные чанки, попадающие в контекст (для валидации и списка источников)"""
+        return [chunks[item['rank']] for item in self.select(chunks)]
+
+    def merge(self, selected: List[Dict]) -> List[Dict]:
+        """Склейка соседних (по chunk_index) чанков одного раздела с удалением перекрытий"""
+        if not self.merge_adjacent:
+            return self._sort_blocks([dict(item, ranks=[item['rank']]) for item in selected])
+
+        groups: Dict[tuple, List[Dict]] = {}
+        for item in selected:
+            groups.setdefault(self._group_key(item['metadata']), []).append(item)
+
+        blocks = []
+        for items in groups.values():
+            if any(item['metadata'].get('chunk_index') is None for item in items):
+                blocks.extend(dict(item, ranks=[item['rank']]) for item in items)
+                continue
+            items = sorted(items, key=lambda item: item['metadata']['chunk_index'])
+            current = dict(items[0], ranks=[items[0]['rank']])
+            for item in items[1:]:
+                if item['metadata']['chunk_index'] == current['metadata']['chunk_index'] + 1:
+                    tail = strip_overlap(current['text'], item['text'])
+                    current = dict(current, text=f"{current['text']} {tail}".strip(),
+                                   metadata=item['metadata'], ranks=current['ranks'] + [item['rank']])
+                else:
+                    blocks.append(current)
+                    current = dict(item, ranks=[item['rank']])
+            blocks.append(current)
+
+        return self._sort_blocks(blocks)
+
+    def _sort_blocks(self, blocks: List[Dict]) -> List[Dict]:
+        if self.order == 'document':
+            def position(block):
+                meta = block['metadata']
+                return (natural_key(meta.get('document_id')), natural_key(meta.get('chapter_id')),
+                        natural_key(meta.get('section_id')), natural_key(meta.get('subsection_id')),
+                        meta.get('chunk_index') or 0, block['text'])
+            return sorted(blocks, key=position)
+        # Порядок фрагментов - по самому релевантному чанку в блоке
+        return sorted(blocks, key=lambda block: min(block['ranks']))
+
+    def pack(self, chunks: List[Dict]) -> List[Dict]:
+        blocks = self.merge(self.select(chunks))
+        self.last_stats['fragments'] = len(blocks)
+        return blocks
+
+    def format(self, chunks: List[Dict]) -> str:
+        """Текст контекста для промпта"""
+        fragments = [
+            format_fragment(i, block['text'], block['metadata'])
+            for i, block in enumerate(self.pack(chunks), 1)
+        ]
+        context = "\n\n".join(fragments)
+        self.last_stats['context_tokens'] = self.counter.count(context)
+        return context
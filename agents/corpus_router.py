@@ -0,0 +1,237 @@
+# agents/corpus_router.py
+import os
+import re
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+DEFAULT_DOCUMENT = "default"
+
+
+# Допустимый id документа: буквы, цифры, «_» и «-» (как у make_document_id)
+DOCUMENT_ID_PATTERN = re.compile(r'^[\w-]{1,128}$')
+
+
+def is_valid_document_id(document_id: str) -> bool:
+    """id можно использовать в имени файла: без «/», «..» и абсолютных путей"""
+    return isinstance(document_id, str) and bool(DOCUMENT_ID_PATTERN.match(document_id))
+
+
+def make_document_id(filename: str) -> str:
+    """Стабильный id документа по имени файла"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    slug = re.sub(r'[^\w-]+', '_', stem.lower()).strip('_')[:40]
+    digest = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:8]
+    return f"{slug}_{digest}" if slug else digest
+
+
+def collection_name_for(document_id: str) -> str:
+    """Имя коллекции Chroma для документа (ограничения Chroma: 3-63 символа, [a-zA-Z0-9._-])"""
+    if document_id == DEFAULT_DOCUMENT:
+        return "document_chunks"
+    return f"doc_{hashlib.sha1(document_id.encode('utf-8')).hexdigest()[:16]}"
+
+
+class CorpusRouter:
+    """
+    Реестр документов корпуса и маршрутизация запросов.
+    Для каждого документа хранится центроид эмбеддингов его чанков;
+    при запросе ко всему корпусу опрашиваются только коллекции
+    документов с ближайшими к запросу центроидами.
+    Центроиды лежат в матрице с запасом строк (емкость растет вдвое), поэтому
+    регистрация документа не копирует всю матрицу. Внутри deferred_save()
+    реестр сохраняется на диск один раз в конце, а не после каждого документа.
+    """
+
+    def __init__(self, db_path: str, top_documents: int = 20):
+        self.top_documents = top_documents
+        self.manifest_path = os.path.join(db_path, "corpus.json")
+        self.centroids_path = os.path.join(db_path, "corpus_centroids.npy")
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}  # id документа -> строка матрицы
+        self._matrix: Optional[np.ndarray] = None  # (емкость, dim), первые len(_ids) строк заняты
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._local = threading.local()  # глубина deferred_save в текущем потоке
+        self._dirty = False
+        self.load()
+
+    @property
+    def _centroids(self) -> Optional[np.ndarray]:
+        """Центроиды документов (len(_ids), dim), нормированы"""
+        if self._matrix is None or not self._ids:
+            return None
+        return self._matrix[:len(self._ids)]
+
+    # ---------- хранение ----------
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.documents = manifest.get('documents', {})
+            self._ids = manifest.get('order', [])
+            if self._ids and os.path.exists(self.centroids_path):
+                self._matrix = np.load(self.centroids_path)
+            if self._matrix is None or len(self._matrix) != len(self._ids):
+                self._ids, self._matrix = [], None
+            self._rows = {document_id: i for i, document_id in enumerate(self._ids)}
+            print(f"✅ Корпус загружен: {len(self.documents)} документов")
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить реестр корпуса: {e}")
+            self.documents, self._ids, self._rows, self._matrix = {}, [], {}, None
+
+    def save(self):
+        """Запись реестра и центроидов на диск (снимок берется под блокировкой, запись - вне ее)"""
+        with self._save_lock:
+            with self._lock:
+                manifest = json.dumps({'documents': self.documents, 'order': self._ids}, ensure_ascii=False)
+                centroids = self._centroids
+                centroids = centroids.copy() if centroids is not None else None
+                self._dirty = False
+            os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+            tmp_path = self.manifest_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(manifest)
+            os.replace(tmp_path, self.manifest_path)
+            if centroids is not None:
+                tmp_path = self.centroids_path + ".tmp.npy"
+                np.save(tmp_path, centroids)
+                os.replace(tmp_path, self.centroids_path)
+            elif os.path.exists(self.centroids_path):
+                os.remove(self.centroids_path)
+
+    @contextmanager
+    def deferred_save(self):
+        """
+        Регистрации в этом потоке сохраняются на диск один раз - при выходе из блока
+        (пакетная загрузка тысяч документов)
+        """
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.depth -= 1
+            if self._local.depth == 0 and self._dirty:
+                self.save()
+
+    def _changed(self):
+        """Отметка об изменении реестра: сохранение сразу или в конце deferred_save()"""
+        self._dirty = True
+        if not getattr(self._local, 'depth', 0):
+            self.save()
+
+    # ---------- реестр ----------
+
+    def register(self, document_id: str, info: Dict[str, Any], centroid: Optional[np.ndarray]):
+        """Добавление/обновление документа и его центроида"""
+        with self._lock:
+            self.documents[document_id] = info
+            if centroid is None:
+                self._drop_centroid(document_id)
+            else:
+                self._set_centroid(document_id, np.asarray(centroid, dtype=np.float32).ravel())
+        self._changed()
+
+    def update_info(self, document_id: str, info: Dict[str, Any]):
+        """Обновление сведений о документе без пересчета центроида"""
+        with self._lock:
+            self.documents[document_id] = info
+        self._changed()
+
+    def remove(self, document_id: str):
+        with self._lock:
+            self.documents.pop(document_id, None)
+            self._drop_centroid(document_id)
+        self._changed()
+
+    def _set_centroid(self, document_id: str, centroid: np.ndarray):
+        row = self._rows.get(document_id)
+        if row is None:
+            row = len(self._ids)
+            if self._matrix is None or self._matrix.shape[1] != len(centroid):
+                self._matrix = np.zeros((16, len(centroid)), dtype=np.float32)
+                self._ids, self._rows, row = [], {}, 0
+            elif row == len(self._matrix):
+                # Амортизированный рост: копирование раз в удвоение, а не на каждый документ
+                grown = np.zeros((2 * len(self._matrix), self._matrix.shape[1]), dtype=np.float32)
+                grown[:row] = self._matrix[:row]
+                self._matrix = grown
+            self._ids.append(document_id)
+            self._rows[document_id] = row
+        self._matrix[row] = centroid
+
+    def _drop_centroid(self, document_id: str):
+        """Удаление строки: на ее место переносится последняя (O(1))"""
+        row = self._rows.pop(document_id, None)
+        if row is None:
+            return
+        last = len(self._ids) - 1
+        if row != last:
+            moved = self._ids[last]
+            self._ids[row] = moved
+            self._rows[moved] = row
+            self._matrix[row] = self._matrix[last]
+        self._ids.pop()
+
+    # ---------- маршрутизация ----------
+
+    def route(self, query_embedding: np.ndarray,
+              document_ids: Optional[List[str]] = None,
+              top_n: Optional[int] = None) -> List[str]:
+        """
+        Выбор документов для поиска.
+        document_ids ограничивает область; если кандидатов больше top_n,
+        остаются top_n документов с ближайшими центроидами.
+        """
+        top_n = top_n or self.top_documents
+        if document_ids:
+            candidates = [d for d in document_ids if d in self.documents]
+        else:
+            candidates = list(self.documents.keys())
+
+        if len(candidates) <= top_n or self._centroids is None:
+            return candidates
+
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        query = query / (np.linalg.norm(query) or 1.0)
+        # Строки матрицы меняются на месте при регистрации - оценки и снимок id
+        # берутся под блокировкой
+        with self._lock:
+            ids, centroids = list(self._ids), self._centroids
+            if centroids is None:
+                return candidates
+            if document_ids:
+                wanted = set(candidates)
+                rows = np.array([self._rows[d] for d in wanted if d in self._rows], dtype=np.int64)
+                scores = centroids[rows] @ query
+            else:
+                rows = None
+                scores = centroids @ query
+
+        if len(scores) <= top_n:
+            best = np.argsort(-scores)
+        else:
+            best = np.argpartition(-scores, top_n - 1)[:top_n]
+            best = best[np.argsort(-scores[best])]
+        if rows is not None:
+            best = rows[best]
+        return [ids[i] for i in best]
+
+    @staticmethod
+    def centroid(embeddings: np.ndarray) -> Optional[np.ndarray]:
+        """Нормированный центроид нормированных эмбеддингов"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.size == 0:
+            return None
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        mean = (embeddings / norms).mean(axis=0)
+        return mean / (np.linalg.norm(mean) or 1.0)
@@ -1,99 +1,500 @@
 from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.text.paragraph import Paragraph
 import re
-from typing import List, Dict, Any, Optional
+import zipfile
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Iterator, Tuple, Callable
+
+from agents.heading_classifier import classify_heading
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_BODY = f'{W_NS}body'
+W_P = f'{W_NS}p'
+W_TBL = f'{W_NS}tbl'
+W_TR = f'{W_NS}tr'
+W_TC = f'{W_NS}tc'
+W_T = f'{W_NS}t'
+W_TAB = f'{W_NS}tab'
+W_PTAB = f'{W_NS}ptab'
+W_BR = f'{W_NS}br'
+W_CR = f'{W_NS}cr'
+W_NO_BREAK_HYPHEN = f'{W_NS}noBreakHyphen'
+W_PSTYLE = f'{W_NS}pStyle'
+W_NUMPR = f'{W_NS}numPr'
+W_GRID_SPAN = f'{W_NS}gridSpan'
+W_VMERGE = f'{W_NS}vMerge'
+W_STYLE = f'{W_NS}style'
+W_NAME = f'{W_NS}name'
+W_VAL = f'{W_NS}val'
+W_TYPE = f'{W_NS}type'
+W_DEFAULT = f'{W_NS}default'
+W_STYLE_ID = f'{W_NS}styleId'
+
+PARSE_MODES = ('document', 'streaming')
+
+# Виды блоков тела документа
+PARAGRAPH, LIST_ITEM, TABLE_ROW = 'paragraph', 'list_item', 'table_row'
+
+SENTENCE_END = re.compile(r'[.!?:;]$')
+HEADER_FOOTER_PART = re.compile(r'^word/(header|footer)\d*\.xml$')
+
+
+@lru_cache(maxsize=256)
+def is_list_style(style_name: Optional[str]) -> bool:
+    """Стиль элемента списка («List Bullet», «List Number», «Список»)"""
+    return bool(style_name) and ('list' in style_name.lower() or 'спис' in style_name.lower())
+
+
+def _cell_text(text: str) -> str:
+    return ' '.join(text.split())
+
+
+def _paragraph_text(paragraph) -> str:
+    """Текст абзаца XML (w:p) без вложенных абзацев (надписей)"""
+    parts = []
+    for child in paragraph:
+        tag = child.tag
+        if tag == W_P:
+            continue
+        if tag == W_T:
+            parts.append(child.text or '')
+        elif tag in (W_TAB, W_PTAB):
+            parts.append('\t')
+        elif tag == W_CR or (tag == W_BR and child.get(W_TYPE, 'textWrapping') == 'textWrapping'):
+            parts.append('\n')
+        elif tag == W_NO_BREAK_HYPHEN:
+            parts.append('-')
+        else:
+            parts.append(_paragraph_text(child))
+    return ''.join(parts)
+
+
+def _block_texts(element) -> Iterator[str]:
+    """Тексты абзацев внутри элемента (ячейки) в порядке документа, включая вложенные таблицы"""
+    for child in element:
+        if child.tag == W_P:
+            yield _paragraph_text(child)
+        else:
+            yield from _block_texts(child)
+
+
+def table_rows(table) -> List[List[Optional[str]]]:
+    """
+    Ячейки таблицы XML (w:tbl) по строкам и столбцам сетки. Продолжение
+    объединения по горизонтали - None, по вертикали - текст верхней ячейки.
+    """
+    rows = []
+    merged_above: Dict[int, str] = {}
+    for tr in table.findall(W_TR):
+        row: List[Optional[str]] = []
+        for tc in tr.findall(W_TC):
+            column = len(row)
+            tc_pr = tc.find(f'{W_NS}tcPr')
+            span_el = tc_pr.find(W_GRID_SPAN) if tc_pr is not None else None
+            vmerge_el = tc_pr.find(W_VMERGE) if tc_pr is not None else None
+            span = int(span_el.get(W_VAL, 1)) if span_el is not None else 1
+            if vmerge_el is not None and vmerge_el.get(W_VAL, 'continue') == 'continue':
+                text = merged_above.get(column, '')
+            else:
+                text = '\n'.join(_block_texts(tc))
+                merged_above[column] = text
+            row.append(text)
+            row.extend([None] * (span - 1))
+        rows.append(row)
+    return rows
+
+
+def table_rows_text(rows: List[List[Optional[str]]]) -> List[str]:
+    """
+    Таблица -> компактный текст по строкам. Первая строка - шапка, каждая
+    следующая строка превращается в «Шапка: значение; ...», так что число
+    в строке остается рядом с названием своего столбца (название объединенной
+    ячейки шапки распространяется на все ее столбцы). Строка из одной ячейки
+    на всю ширину (примечание) выводится без названия столбца.
+    """
+    rows = [[_cell_text(cell) if cell is not None else None for cell in row] for row in rows]
+    rows = [row for row in rows if any(row)]
+    if not rows:
+        return []
+
+    header: List[str] = []
+    data = rows
+    if len(rows) > 1 and any(rows[0]):
+        for cell in rows[0]:
+            header.append(cell if cell is not None else (header[-1] if header else ''))
+        data = rows[1:]
+
+    lines = []
+    if header:
+        # Шапка отдельной строкой - названия столбцов тоже ищутся
+        lines.append(' | '.join(dict.fromkeys(name for name in header if name)))
+
+    for row in data:
+        cells = [(column, value) for column, value in enumerate(row) if value]
+        if len(cells) == 1 and all(value is None for value in row[1:]) and len(row) > 1:
+            lines.append(cells[0][1])
+            continue
+        parts = []
+        for column, value in cells:
+            name = header[column] if column < len(header) else ''
+            parts.append(f"{name}: {value}" if name and name != value else value)
+        if parts:
+            lines.append('; '.join(parts) if header else ' | '.join(parts))
+
+    return [line if SENTENCE_END.search(line) else line + '.' for line in lines]
+
+
+def text_chars(text: str) -> int:
+    """Число символов текста без пробелов и переносов - мера для сравнения исходного и проиндексированного текста"""
+    return sum(len(word) for word in text.split())
+
+
+def node_children(node: Dict) -> List[Dict]:
+    """Дочерние узлы: у главы - sections, у раздела и глубже - subsections"""
+    return node.get('sections') or node.get('subsections') or []
+
+
+def iter_nodes(nodes: List[Dict], path: Tuple[Dict, ...] = ()) -> Iterator[Tuple[Dict, ...]]:
+    """Обход дерева в порядке документа: путь от главы до каждого узла"""
+    for node in nodes:
+        node_path = path + (node,)
+        yield node_path
+        yield from iter_nodes(node_children(node), node_path)
+
+
+def node_metadata(path) -> Dict[str, Any]:
+    """Метаданные чанков узла по пути от главы до него (глава, раздел, подраздел любой глубины)"""
+    chapter = path[0]
+    node = path[-1]
+    metadata = {
+        'chapter_id': chapter['id'],
+        'chapter_title': chapter['title'],
+        'level': len(path),
+        'type': 'preamble' if chapter.get('preamble') else 'chapter'
+    }
+    if len(path) > 1:
+        section = path[1]
+        metadata.update(section_id=section['id'], section_title=section['title'], type='section')
+    if len(path) > 2:
+        metadata.update(subsection_id=node['id'], subsection_title=node['title'], type='subsection')
+    return metadata
+
+
+def collect_sections(structure: Dict) -> Tuple[List[str], List[Dict]]:
+    """Тексты всех узлов структуры (глав, разделов, подразделов) и их метаданные"""
+    section_texts = []
+    section_meta = []
+    for path in iter_nodes(structure['chapters']):
+        if path[-1].get('content'):
+            section_texts.append(path[-1]['content'])
+            section_meta.append(node_metadata(path))
+    return section_texts, section_meta
+
 
 class DocParserAgent:
-    """Агент для парсинга Word документов и извлечения иерархии"""
-    
-    def __init__(self):
-        self.structure = {}
-    
-    def parse_with_hierarchy(self, docx_path: str) -> Dict[str, Any]:
-        """Извлечение структуры документа с иерархией глав/разделов"""
+    """
+    Агент для парсинга Word документов и извлечения иерархии.
+    Тело документа обходится за один проход: абзацы, элементы списков и таблицы
+    (построчно, с названиями столбцов) - в порядке документа; колонтитулы
+    сохраняются в структуре (headers/footers).
+    mode='document' - чтение через python-docx (весь документ в памяти);
+    mode='streaming' - потоковое чтение word/document.xml: блоки отдаются
+    по одному, прочитанные элементы XML сразу освобождаются.
+    Состояние разбора (счетчики, колонтитулы) хранится в каждом вызове отдельно,
+    поэтому один агент можно использовать из нескольких потоков.
+    """
+
+    def __init__(self, mode: str = 'document'):
+        if mode not in PARSE_MODES:
+            raise ValueError(f"Неизвестный режим парсинга: {mode}. Доступны: {', '.join(PARSE_MODES)}")
+        self.mode = mode
+
+    def parse_with_hierarchy(self, docx_path: str, streaming: Optional[bool] = None,
+                             on_node: Optional[Callable[[Dict, Tuple[Dict, ...]], None]] = None,
+                             keep_content: bool = True) -> Dict[str, Any]:
+        """
+        Извлечение структуры документа с иерархией глав/разделов/подразделов.
+        on_node(node, path) вызывается для каждого узла (path - от главы до узла), как только
+        его текст собран; при keep_content=False текст в структуре не хранится
+        (остается длина content_chars) - так документ можно чанковать по мере чтения.
+        """
+        stats = self._new_stats()
+        events = self.iter_events(docx_path, streaming, stats)
+        hierarchy = self._build_hierarchy(events, docx_path.split('/')[-1],
+                                          on_node=on_node, keep_content=keep_content)
+        hierarchy['total_paragraphs'] = stats['paragraphs']
+        hierarchy['total_tables'] = stats['tables']
+        hierarchy['headers'] = stats['headers']
+        hierarchy['footers'] = stats['footers']
+        return hierarchy
+
+    @staticmethod
+    def _new_stats() -> Dict[str, Any]:
+        return {'paragraphs': 0, 'tables': 0, 'headers': [], 'footers': []}
+
+    def iter_events(self, docx_path: str, streaming: Optional[bool] = None,
+                    stats: Optional[Dict[str, Any]] = None) -> Iterator[Tuple[int, str]]:
+        """
+        События документа в порядке чтения: (уровень заголовка, текст),
+        уровень 0 - обычный текст (абзац, элемент списка «- ...», строка таблицы).
+        Пустые блоки пропускаются. В stats записываются число абзацев и таблиц
+        и колонтитулы документа.
+        """
+        streaming = self.mode == 'streaming' if streaming is None else streaming
+        stats = self._new_stats() if stats is None else stats
+        blocks = (self._iter_xml_blocks(docx_path, stats) if streaming
+                  else self._iter_docx_blocks(docx_path, stats))
+        for kind, text, style_name in blocks:
+            text = text.strip()
+            if not text:
+                continue
+            if kind == TABLE_ROW:
+                yield 0, text
+                continue
+            level = self._classify(text, style_name)
+            if level == 0 and (kind == LIST_ITEM or is_list_style(style_name)):
+                text = f"- {text}"
+            yield level, text
+
+    def _iter_docx_blocks(self, docx_path: str, stats: Dict[str, Any]) -> Iterator[Tuple[str, str, Optional[str]]]:
+        """Блоки тела документа через python-docx: (вид, текст, имя стиля)"""
         try:
             doc = Document(docx_path)
         except Exception as e:
             raise Exception(f"Не удалось открыть файл {docx_path}: {e}")
-        
+
+        # Имена стилей по styleId - один раз, а не через paragraph.style на каждый абзац
+        style_names = {s.style_id: s.name for s in doc.styles if s.type == WD_STYLE_TYPE.PARAGRAPH}
+        default_style = doc.styles.default(WD_STYLE_TYPE.PARAGRAPH)
+        default_style = default_style.name if default_style is not None else None
+
+        stats['headers'], stats['footers'] = self._docx_headers_footers(doc)
+        for element in doc.element.body.iterchildren():
+            if element.tag == W_P:
+                stats['paragraphs'] += 1
+                pPr = element.pPr
+                kind = LIST_ITEM if pPr is not None and pPr.numPr is not None else PARAGRAPH
+                yield kind, Paragraph(element, doc).text, style_names.get(element.style, default_style)
+            elif element.tag == W_TBL:
+                stats['tables'] += 1
+                for line in table_rows_text(table_rows(element)):
+                    yield TABLE_ROW, line, None
+
+    @staticmethod
+    def _docx_headers_footers(doc) -> Tuple[List[str], List[str]]:
+        """Уникальные строки колонтитулов всех разделов документа"""
+        found = {'header': {}, 'footer': {}}
+        for section in doc.sections:
+            for kind in found:
+                for variant in (kind, f'first_page_{kind}', f'even_page_{kind}'):
+                    try:
+                        part = getattr(section, variant)
+                        if part.is_linked_to_previous and variant != kind:
+                            continue
+                        texts = list(_block_texts(part._element))
+                    except Exception:
+                        continue
+                    for text in texts:
+                        text = _cell_text(text)
+                        if text:
+                            found[kind][text] = None
+        return list(found['header']), list(found['footer'])
+
+    def _iter_xml_blocks(self, docx_path: str, stats: Dict[str, Any]) -> Iterator[Tuple[str, str, Optional[str]]]:
+        """
+        Потоковое чтение тела документа (iterparse по word/document.xml):
+        абзацы и таблицы в порядке документа. Объединенные ячейки повторяются,
+        как в python-docx; вложенные абзацы (надписи) пропускаются, вложенные
+        таблицы входят в текст ячейки. После каждого элемента верхнего уровня
+        тело документа очищается, поэтому память не растет с размером файла.
+        """
+        try:
+            archive = zipfile.ZipFile(docx_path)
+        except Exception as e:
+            raise Exception(f"Не удалось открыть файл {docx_path}: {e}")
+
+        with archive:
+            style_names, default_style = self._read_styles(archive)
+            stats['headers'], stats['footers'] = self._xml_headers_footers(archive)
+            with archive.open('word/document.xml') as xml_file:
+                body = None
+                depth = table_depth = paragraph_depth = 0
+                parts: List[str] = []
+                style_id = None
+                is_list = False
+
+                for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+                    tag = elem.tag
+                    if event == 'start':
+                        depth += 1
+                        if tag == W_TBL:
+                            table_depth += 1
+                        elif table_depth:
+                            continue
+                        elif tag == W_P:
+                            paragraph_depth += 1
+                            if paragraph_depth == 1:
+                                parts, style_id, is_list = [], None, False
+                        elif tag == W_BODY:
+                            body = elem
+                        continue
+
+                    depth -= 1
+                    if tag == W_TBL:
+                        # Таблица верхнего уровня прочитана целиком - разбираем ее элемент
+                        table_depth -= 1
+                        if table_depth == 0:
+                            stats['tables'] += 1
+                            for line in table_rows_text(table_rows(elem)):
+                                yield TABLE_ROW, line, None
+                    elif table_depth:
+                        pass
+                    elif paragraph_depth == 1:
+                        if tag == W_T:
+                            parts.append(elem.text or '')
+                        elif tag in (W_TAB, W_PTAB):
+                            parts.append('\t')
+                        elif tag == W_CR or (tag == W_BR and elem.get(W_TYPE, 'textWrapping') == 'textWrapping'):
+                            parts.append('\n')
+                        elif tag == W_NO_BREAK_HYPHEN:
+                            parts.append('-')
+                        elif tag == W_PSTYLE:
+                            style_id = elem.get(W_VAL)
+                        elif tag == W_NUMPR:
+                            is_list = True
+
+                    if tag == W_P and not table_depth:
+                        paragraph_depth -= 1
+                        if paragraph_depth == 0:
+                            stats['paragraphs'] += 1
+                            yield (LIST_ITEM if is_list else PARAGRAPH), ''.join(parts), \
+                                style_names.get(style_id, default_style)
+
+                    # Элемент верхнего уровня прочитан - освобождаем его
+                    if depth == 2 and body is not None:
+                        body.clear()
+
+    @staticmethod
+    def _xml_headers_footers(archive: zipfile.ZipFile) -> Tuple[List[str], List[str]]:
+        """Уникальные строки колонтитулов (word/header*.xml, word/footer*.xml)"""
+        found = {'header': {}, 'footer': {}}
+        for name in sorted(archive.namelist()):
+            match = HEADER_FOOTER_PART.match(name)
+            if not match:
+                continue
+            root = ET.fromstring(archive.read(name))
+            for paragraph in root.iter(W_P):
+                text = _cell_text(''.join(t.text or '' for t in paragraph.iter(W_T)))
+                if text:
+                    found[match.group(1)][text] = None
+        return list(found['header']), list(found['footer'])
+
+    @staticmethod
+    def _read_styles(archive: zipfile.ZipFile) -> Tuple[Dict[str, str], Optional[str]]:
+        """Имена стилей абзацев по styleId и стиль абзаца по умолчанию (word/styles.xml)"""
+        names: Dict[str, str] = {}
+        default = None
+        try:
+            root = ET.fromstring(archive.read('word/styles.xml'))
+        except KeyError:
+            return names, default
+        for style in root.iter(W_STYLE):
+            if style.get(W_TYPE) != 'paragraph':
+                continue
+            name = style.find(W_NAME)
+            name = name.get(W_VAL) if name is not None else style.get(W_STYLE_ID)
+            names[style.get(W_STYLE_ID)] = name
+            if style.get(W_DEFAULT) in ('1', 'true'):
+                default = name
+        return names, default
+
+    def _build_hierarchy(self, events: Iterator[Tuple[int, str]], document_name: str,
+                         on_node: Optional[Callable[[Dict, Tuple[Dict, ...]], None]] = None,
+                         keep_content: bool = True) -> Dict[str, Any]:
+        """
+        Сборка дерева из потока событий (уровень, текст). Глубина не ограничена:
+        заголовок становится дочерним узлом ближайшего заголовка более высокого
+        уровня, а текст принадлежит последнему заголовку перед ним.
+        Пропуски уровней (глава -> заголовок 3) не создают пустых узлов.
+        Текст не теряется: то, что идет до первого заголовка, попадает
+        в узел «Начало документа» (ch_0). В coverage - объем исходного текста
+        (символы без пробелов) для проверки полноты индекса.
+        """
         hierarchy = {
-            'document': docx_path.split('/')[-1],
+            'document': document_name,
             'chapters': [],
-            'total_paragraphs': len(doc.paragraphs)
+            'total_paragraphs': 0
         }
-        
-        current_chapter = None
-        current_section = None
-        content_buffer = []
-        
-        for para in doc.paragraphs:
-            text = para.text.strip()
-            if not text:
-                continue
-            
-            level = self._detect_heading_level(para)
-            
-            if level == 1:  # Глава
-                if current_chapter and content_buffer:
-                    current_chapter['content'] = '\n'.join(content_buffer)
-                    hierarchy['chapters'].append(current_chapter)
-                
-                current_chapter = {
-                    'id': f"ch_{len(hierarchy['chapters']) + 1}",
-                    'title': text,
-                    'level': 1,
+        coverage = {'source_chars': 0, 'heading_chars': 0}
+
+        path: List[Dict] = []  # от главы до текущего узла
+        content_buffer: List[str] = []
+
+        def flush():
+            if not content_buffer and not path:
+                return
+            if not path:
+                preamble = {
+                    'id': 'ch_0',
+                    'title': 'Начало документа',
+                    'level': 0,
+                    'preamble': True,
                     'sections': [],
                     'content': ''
                 }
-                content_buffer = []
-                
-            elif level == 2 and current_chapter:  # Раздел
-                if current_section and content_buffer:
-                    current_section['content'] = '\n'.join(content_buffer)
-                    current_chapter['sections'].append(current_section)
-                
-                current_section = {
-                    'id': f"{current_chapter['id']}_sec_{len(current_chapter['sections']) + 1}",
-                    'title': text,
-                    'level': 2,
-                    'subsections': [],
-                    'content': ''
-                }
-                content_buffer = []
-                
-            elif level >= 3 and current_section:  # Подраздел
-                subsection = {
-                    'id': f"{current_section['id']}_sub_{len(current_section['subsections']) + 1}",
-                    'title': text,
-                    'level': level,
-                    'content': ''
-                }
-                current_section['subsections'].append(subsection)
-                
-            else:  # Обычный текст
+                hierarchy['chapters'].append(preamble)
+                path.append(preamble)
+            node = path[-1]
+            node['content'] = '\n'.join(content_buffer)
+            content_buffer.clear()
+            if on_node:
+                on_node(node, tuple(path))
+            if not keep_content:
+                node['content_chars'] = len(node['content'])
+                node['content'] = ''
+
+        for level, text in events:
+            if level == 0:  # Обычный текст
                 content_buffer.append(text)
-        
-        if current_chapter and content_buffer:
-            current_chapter['content'] = '\n'.join(content_buffer)
-            hierarchy['chapters'].append(current_chapter)
-        
+                coverage['source_chars'] += text_chars(text)
+                continue
+
+            coverage['heading_chars'] += text_chars(text)
+            flush()
+            while path and (path[-1]['level'] >= level or path[-1].get('preamble')):
+                path.pop()
+
+            if not path:  # Глава
+                siblings = hierarchy['chapters']
+                node_id = f"ch_{sum(1 for node in siblings if not node.get('preamble')) + 1}"
+            elif len(path) == 1:  # Раздел
+                siblings = path[-1]['sections']
+                node_id = f"{path[-1]['id']}_sec_{len(siblings) + 1}"
+            else:  # Подраздел любой глубины
+                siblings = path[-1]['subsections']
+                node_id = f"{path[-1]['id']}_sub_{len(siblings) + 1}"
+
+            node = {
+                'id': node_id,
+                'title': text,
+                'level': level,
+                'sections' if not path else 'subsections': [],
+                'content': ''
+            }
+            siblings.append(node)
+            path.append(node)
+
+        flush()
+        hierarchy['coverage'] = coverage
         return hierarchy
-    
+
     def _detect_heading_level(self, paragraph) -> int:
         """Определение уровня заголовка"""
-        if paragraph.style and paragraph.style.name:
-            style_name = paragraph.style.name.lower()
-            if 'heading' in style_name:
-                try:
-                    return int(style_name.replace('heading', '').strip())
-                except:
-                    pass
-        
-        text = paragraph.text.strip()
-        if re.match(r'^\d+\.', text):
-            return 1
-        elif re.match(r'^\d+\.\d+\.', text):
-            return 2
-        elif re.match(r'^\d+\.\d+\.\d+\.', text):
-            return 3
-        
-        return 0
\ No newline at end of file
+        style_name = paragraph.style.name if paragraph.style else None
+        return self._classify(paragraph.text.strip(), style_name)
+
+    def _classify(self, text: str, style_name: Optional[str]) -> int:
+        """Уровень заголовка по имени стиля и тексту абзаца (0 - обычный текст)"""
+        return classify_heading(text, style_name)
@@ -0,0 +1,283 @@
+# agents/embedding_cache.py
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Дисковый кэш эмбеддингов с адресацией по содержимому.
+    Ключ - (имя модели, sha1 нормализованного текста), значения хранятся
+    в memory-mapped файле float32, вытеснение - LRU при достижении лимита размера.
+    Индекс на диск сбрасывается не после каждого пакета, а раз в flush_every
+    новых векторов или flush_interval_s секунд, и всегда - при close()/выходе.
+    Строки memmap перезаписываются сразу (в том числе вытесненные), поэтому
+    у каждой строки хранится метка ключа (tags.u64): если после сбоя индекс
+    указывает на строку с вектором другого текста, метка не совпадет и это промах.
+    """
+
+    INITIAL_ROWS = 1024
+
+    def __init__(self, cache_dir: str, model_name: str, max_size_mb: int = 512,
+                 flush_every: int = 4096, flush_interval_s: float = 30.0):
+        self.model_name = model_name
+        self.max_size_mb = max_size_mb
+        self.flush_every = flush_every
+        self.flush_interval_s = flush_interval_s
+        self.dir = os.path.join(cache_dir, re.sub(r'[^\w.-]+', '_', model_name))
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        self.tags_path = os.path.join(self.dir, "tags.u64")
+        self.index_path = os.path.join(self.dir, "index.json")
+
+        self.dim = None
+        self.capacity = 0
+        self._rows = 0
+        self._vectors = None
+        self._tags = None  # метка ключа для каждой строки (0 - строка пуста)
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # ключ -> строка, порядок LRU
+        self._next_row = 0  # первая ни разу не занятая строка
+        self._free: List[int] = []  # освобожденные строки
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._pending = 0  # векторов, добавленных после последнего сброса
+        self._last_flush = time.monotonic()
+        atexit.register(self.close)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0  # записи индекса, чья строка перезаписана другим ключом
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """Нормализация текста: Unicode NFC и схлопывание пробелов"""
+        return ' '.join(unicodedata.normalize('NFC', text).split())
+
+    def make_key(self, text: str) -> str:
+        payload = f"{self.model_name}\x00{self.normalize_text(text)}"
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _tag(key: str) -> int:
+        """Метка строки: первые 64 бита ключа (0 зарезервирован за пустой строкой)"""
+        return int(key[:16], 16) or 1
+
+    # ---------- хранилище ----------
+
+    def _open(self, dim: int):
+        """Открытие (или создание) хранилища для векторов размерности dim"""
+        if self._vectors is not None and self.dim == dim:
+            return
+
+        os.makedirs(self.dir, exist_ok=True)
+        self.dim = dim
+        self.capacity = max(1, (self.max_size_mb * 1024 * 1024) // (dim * 4))
+
+        index = None
+        if os.path.exists(self.index_path) and os.path.exists(self.vectors_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+            except Exception as e:
+                print(f"⚠️ Индекс кэша эмбеддингов поврежден, кэш сброшен: {e}")
+
+        if (index and index.get('dim') == dim and index.get('model') == self.model_name
+                and index.get('rows', 0) <= self.capacity
+                and os.path.exists(self.tags_path)
+                and os.path.getsize(self.tags_path) == index['rows'] * 8):
+            self._rows = index['rows']
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+',
+                                      shape=(self._rows, dim))
+            self._tags = np.memmap(self.tags_path, dtype=np.uint64, mode='r+', shape=(self._rows,))
+            for key, row in index['entries']:
+                self._entries[key] = row
+            used = set(self._entries.values())
+            self._next_row = max(used) + 1 if used else 0
+            self._free = [row for row in range(self._next_row) if row not in used]
+            print(f"✅ Кэш эмбеддингов открыт: {len(self._entries)} векторов ({self.dir})")
+        else:
+            self._rows = min(self.INITIAL_ROWS, self.capacity)
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='w+',
+                                      shape=(self._rows, dim))
+            self._tags = np.memmap(self.tags_path, dtype=np.uint64, mode='w+', shape=(self._rows,))
+            self._entries.clear()
+            self._next_row = 0
+            self._free = []
+            self._dirty = True
+
+    def _ensure_rows(self, rows: int):
+        """Расширение memmap-файла (удвоением, но не больше лимита)"""
+        if rows <= self._rows:
+            return
+        new_rows = min(self.capacity, max(rows, self._rows * 2))
+        self._vectors.flush()
+        self._tags.flush()
+        self._vectors = self._tags = None
+        with open(self.vectors_path, 'r+b') as f:
+            f.truncate(new_rows * self.dim * 4)
+        with open(self.tags_path, 'r+b') as f:
+            f.truncate(new_rows * 8)
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+',
+                                  shape=(new_rows, self.dim))
+        self._tags = np.memmap(self.tags_path, dtype=np.uint64, mode='r+', shape=(new_rows,))
+        self._rows = new_rows
+
+    def _allocate_row(self) -> int:
+        """Свободная строка: освобожденная, новая, пока есть место, иначе - вытеснение LRU"""
+        if self._free:
+            return self._free.pop()
+        if self._next_row < self.capacity:
+            row = self._next_row
+            self._ensure_rows(row + 1)
+            self._next_row += 1
+            return row
+        _, row = self._entries.popitem(last=False)
+        self.evictions += 1
+        return row
+
+    def _write_row(self, row: int, key: str, vector: np.ndarray):
+        """
+        Запись вектора: метка сбрасывается до записи и ставится после,
+        чтобы прерванная запись не выглядела вектором прежнего ключа
+        """
+        self._tags[row] = 0
+        self._vectors[row] = vector
+        self._tags[row] = self._tag(key)
+
+    # ---------- API ----------
+
+    def get_many(self, keys: List[str]) -> Dict[int, np.ndarray]:
+        """Поиск векторов по ключам: {позиция в keys: вектор}"""
+        found = {}
+        with self._lock:
+            if self._vectors is None:
+                self.misses += len(keys)
+                return found
+            for i, key in enumerate(keys):
+                row = self._entries.get(key)
+                if row is None:
+                    self.misses += 1
+                    continue
+                if int(self._tags[row]) != self._tag(key):
+                    # Строка перезаписана другим ключом после последнего сброса индекса
+                    del self._entries[key]
+                    self._free.append(row)
+                    self._dirty = True
+                    self.stale += 1
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(key)
+                found[i] = np.array(self._vectors[row])
+                self.hits += 1
+        return found
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        """Сохранение векторов в кэш"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+
+        with self._lock:
+            self._open(vectors.shape[1])
+            for key, vector in zip(keys, vectors):
+                row = self._entries.get(key)
+                if row is None:
+                    row = self._allocate_row()
+                    self._entries[key] = row
+                else:
+                    self._entries.move_to_end(key)
+                self._write_row(row, key, vector)
+            self._dirty = True
+            self._pending += len(keys)
+
+    def flush(self):
+        """Сброс векторов и индекса на диск"""
+        with self._lock:
+            if self._vectors is None or not self._dirty:
+                return
+            self._vectors.flush()
+            self._tags.flush()
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'model': self.model_name,
+                    'dim': self.dim,
+                    'rows': self._rows,
+                    'entries': list(self._entries.items())
+                }, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+            self._pending = 0
+            self._last_flush = time.monotonic()
+
+    def maybe_flush(self):
+        """Сброс на диск, если накопилось flush_every векторов или прошло flush_interval_s"""
+        with self._lock:
+            due = self._dirty and (self._pending >= self.flush_every
+                                   or time.monotonic() - self._last_flush >= self.flush_interval_s)
+        if due:
+            self.flush()
+
+    def close(self):
+        """Сброс несохраненных векторов (при завершении работы)"""
+        self.flush()
+
+    def encode(self, embedder, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """Эмбеддинги для texts: из кэша, недостающие - через embedder.encode"""
+        if len(texts) == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+
+        keys = [self.make_key(t) for t in texts]
+        if self._vectors is None:
+            # Размерность известна только после загрузки модели
+            with self._lock:
+                self._open(embedder.get_sentence_embedding_dimension())
+
+        found = self.get_many(keys)
+
+        # Одинаковые тексты внутри запроса кодируем один раз
+        missing: Dict[str, List[int]] = {}
+        for i, key in enumerate(keys):
+            if i not in found:
+                missing.setdefault(key, []).append(i)
+
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, vector in found.items():
+            result[i] = vector
+
+        if missing:
+            miss_keys = list(missing.keys())
+            miss_texts = [texts[missing[k][0]] for k in miss_keys]
+            encoded = np.asarray(
+                embedder.encode(miss_texts, batch_size=batch_size),
+                dtype=np.float32
+            )
+            for key, vector in zip(miss_keys, encoded):
+                for i in missing[key]:
+                    result[i] = vector
+            self.put_many(miss_keys, encoded)
+            self.maybe_flush()
+
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'model': self.model_name,
+            'entries': len(self._entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'evictions': self.evictions,
+            'stale': self.stale
+        }
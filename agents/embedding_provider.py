@@ -0,0 +1,155 @@
+# agents/embedding_provider.py
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from agents.embedding_cache import EmbeddingCache
+
+FALLBACK_MODEL = "all-MiniLM-L6-v2"
+
+
+class SharedEmbedder:
+    """
+    Ленивая обертка над SentenceTransformer.
+    Один экземпляр на модель в процессе - его получают все агенты.
+    Веса загружаются при первом encode() или явном вызове load()/warmup().
+    """
+
+    def __init__(self, model_name: str = FALLBACK_MODEL, device: Optional[str] = None):
+        self.model_name = model_name
+        self.device = device
+        self.active_model_name = None  # с учетом fallback
+        self._model = None
+        self._lock = threading.Lock()
+        self._warmup_thread = None
+        self._cache_dir = None
+        self._cache_max_mb = 0
+        self.cache: Optional[EmbeddingCache] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self):
+        """Загрузка модели (потокобезопасно, ровно один раз)"""
+        if self._model is not None:
+            return self._model
+
+        with self._lock:
+            if self._model is not None:
+                return self._model
+
+            from sentence_transformers import SentenceTransformer
+
+            print(f"📦 Загрузка модели эмбеддингов: {self.model_name}")
+            try:
+                self._model = SentenceTransformer(self.model_name, device=self.device)
+                self.active_model_name = self.model_name
+                print(f"✅ Модель эмбеддингов загружена: {self.model_name}")
+            except Exception as e:
+                if self.model_name == FALLBACK_MODEL:
+                    print(f"❌ Критическая ошибка загрузки модели: {e}")
+                    raise
+                print(f"⚠️ Ошибка загрузки {self.model_name}: {e}")
+                print(f"📦 Пробую fallback модель: {FALLBACK_MODEL}")
+                self._model = SentenceTransformer(FALLBACK_MODEL, device=self.device)
+                self.active_model_name = FALLBACK_MODEL
+                print(f"✅ Fallback модель загружена")
+
+        return self._model
+
+    def warmup(self, background: bool = True) -> Optional[threading.Thread]:
+        """Загрузка модели заранее, по умолчанию в фоновом потоке"""
+        if self.is_loaded:
+            return None
+        if not background:
+            self.load()
+            return None
+
+        if self._warmup_thread is None or not self._warmup_thread.is_alive():
+            self._warmup_thread = threading.Thread(
+                target=self._safe_load,
+                name=f"embedder-warmup-{self.model_name}",
+                daemon=True
+            )
+            self._warmup_thread.start()
+        return self._warmup_thread
+
+    def _safe_load(self):
+        try:
+            self.load()
+        except Exception as e:
+            print(f"❌ Фоновая загрузка модели {self.model_name} не удалась: {e}")
+
+    def encode(self, sentences, **kwargs):
+        """Прямой вызов SentenceTransformer.encode"""
+        return self.load().encode(sentences, **kwargs)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.load().get_sentence_embedding_dimension()
+
+    def enable_cache(self, cache_dir: Optional[str], max_size_mb: int = 512):
+        """Подключение дискового кэша эмбеддингов (None - отключить)"""
+        self._cache_dir = cache_dir
+        self._cache_max_mb = max_size_mb
+        self.cache = None
+
+    def _get_cache(self) -> Optional[EmbeddingCache]:
+        if self._cache_dir is None:
+            return None
+        if self.cache is None:
+            self.load()
+            with self._lock:
+                if self.cache is None:
+                    # Ключ кэша - реально загруженная модель (с учетом fallback)
+                    self.cache = EmbeddingCache(self._cache_dir, self.active_model_name,
+                                                max_size_mb=self._cache_max_mb)
+        return self.cache
+
+    def encode_cached(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """
+        Эмбеддинги списка текстов через дисковый кэш:
+        кодируются только тексты, которых еще нет в кэше
+        """
+        cache = self._get_cache()
+        if cache is None:
+            return np.asarray(self.encode(texts, batch_size=batch_size), dtype=np.float32)
+        return cache.encode(self, texts, batch_size=batch_size)
+
+    def flush_cache(self):
+        """Сброс дискового кэша эмбеддингов (после загрузки документов и при остановке)"""
+        if self.cache is not None:
+            self.cache.flush()
+
+    def cache_stats(self) -> Optional[Dict]:
+        return self.cache.stats() if self.cache else None
+
+    def __repr__(self):
+        state = "loaded" if self.is_loaded else "lazy"
+        return f"SharedEmbedder(model={self.model_name}, device={self.device}, {state})"
+
+
+_registry: Dict[Tuple[str, Optional[str]], SharedEmbedder] = {}
+_registry_lock = threading.Lock()
+
+
+def get_embedder(model_name: str = FALLBACK_MODEL, device: Optional[str] = None) -> SharedEmbedder:
+    """Получение общего эмбеддера для модели (создается один раз на процесс)"""
+    key = (model_name, device)
+    with _registry_lock:
+        embedder = _registry.get(key)
+        if embedder is None:
+            embedder = SharedEmbedder(model_name, device=device)
+            _registry[key] = embedder
+        return embedder
+
+
+def registered_embedders() -> List[Dict]:
+    """Список зарегистрированных эмбеддеров (для отладки)"""
+    with _registry_lock:
+        return [
+            {"model": e.model_name, "device": e.device, "loaded": e.is_loaded,
+             "cache": e.cache_stats()}
+            for e in _registry.values()
+        ]
@@ -0,0 +1,104 @@
+# agents/heading_classifier.py
+import re
+from functools import lru_cache
+from typing import Optional
+
+# Максимальная длина заголовка, распознаваемого по тексту (без стиля)
+MAX_HEADING_CHARS = 200
+
+ROMAN_VALUES = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100, 'D': 500, 'M': 1000}
+
+# Все виды нумерации заголовков - одна альтернатива, скомпилированная один раз:
+#   «Глава 3», «Раздел 2.1», «Часть IV», «Chapter 1» - с ключевым словом;
+#   «2.», «2.3», «2.3.1.4.» - десятичная нумерация любой глубины;
+#   «IV.» - римская цифра с точкой.
+OUTLINE_PATTERN = re.compile(r"""
+    ^(?:
+        (?P<named>(?i:глава|раздел|часть|chapter|section|part))\s+
+            (?P<named_number>\d{1,3}(?:\.\d{1,3})*|[IVXLCDM]{1,7})[.:]?
+      | (?P<number>\d{1,3}(?:\.\d{1,3}){0,9})(?P<dot>\.)?
+      | (?P<roman>[IVXLCDM]{1,7})\.
+    )
+    (?:\s+|$)
+    (?P<title>.*)$
+""", re.X | re.S)
+
+# Стили заголовков: «Heading 2», «heading 2», «Заголовок 2»
+HEADING_STYLE = re.compile(r'^(?:heading|заголовок)\s*(\d+)$', re.I)
+
+
+@lru_cache(maxsize=256)
+def style_heading_level(style_name: Optional[str]) -> Optional[int]:
+    """Уровень заголовка по имени стиля («Heading 2» -> 2), None - не заголовок"""
+    if not style_name:
+        return None
+    match = HEADING_STYLE.match(style_name.strip())
+    return int(match.group(1)) if match else None
+
+
+def is_roman(value: str) -> bool:
+    """Корректное римское число (I, IV, XII), а не просто набор букв I/V/X..."""
+    total = 0
+    previous = 0
+    for char in reversed(value.upper()):
+        current = ROMAN_VALUES[char]
+        total += -current if current < previous else current
+        previous = max(previous, current)
+    return 0 < total < 4000 and _to_roman(total) == value.upper()
+
+
+def _to_roman(number: int) -> str:
+    result = []
+    for value, letters in ((1000, 'M'), (900, 'CM'), (500, 'D'), (400, 'CD'), (100, 'C'), (90, 'XC'),
+                           (50, 'L'), (40, 'XL'), (10, 'X'), (9, 'IX'), (5, 'V'), (4, 'IV'), (1, 'I')):
+        count, number = divmod(number, value)
+        result.append(letters * count)
+    return ''.join(result)
+
+
+def _looks_like_title(title: str) -> bool:
+    """Текст после номера похож на заголовок: с заглавной буквы и не законченная фраза"""
+    if not title or not (title[0].isupper() or title[0] in '«"'):
+        return False
+    return not title.rstrip().endswith(('.', ';', ','))
+
+
+def classify_heading(text: str, style_name: Optional[str] = None) -> int:
+    """
+    Уровень заголовка абзаца (0 - обычный текст).
+    Стиль заголовка важнее текста; без стиля уровень берется из нумерации:
+    «2.3. Область применения» -> 2, «Глава 3» -> 1, «IV. Итоги» -> 1.
+    Нумерованные строки, похожие на предложения («1. Включите прибор.»,
+    «3.5 кг»), и слишком длинные абзацы заголовками не считаются.
+    """
+    level = style_heading_level(style_name)
+    if level is not None:
+        return level
+
+    if len(text) > MAX_HEADING_CHARS:
+        return 0
+    match = OUTLINE_PATTERN.match(text)
+    if match is None:
+        return 0
+
+    title = match.group('title')
+    if match.group('named'):
+        # «Раздел 2 содержит...» - предложение, а не заголовок
+        title = title.lstrip('-–—: ')
+        if title and not _looks_like_title(title):
+            return 0
+        number = match.group('named_number')
+        if number[0].isdigit():
+            return number.count('.') + 1
+        return 1 if is_roman(number) else 0
+
+    if not _looks_like_title(title):
+        return 0
+    if match.group('roman'):
+        return 1 if is_roman(match.group('roman')) else 0
+
+    number = match.group('number')
+    # Одно число без точки («2024 год») - не нумерация
+    if '.' not in number and not match.group('dot'):
+        return 0
+    return number.count('.') + 1
@@ -0,0 +1,236 @@
+# agents/ingest_pipeline.py
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from agents.doc_parser import node_metadata, text_chars
+
+_DONE = object()  # маркер конца потока между стадиями
+
+
+def assemble_chunks(chunked_sections: List[List[str]], section_vectors: List[List],
+                    section_meta: List[Dict]):
+    """Плоские списки чанков, метаданных и векторов из результатов по разделам"""
+    chunks = []
+    metadata = []
+    chunk_vectors = []
+    for section_chunks, vectors, meta in zip(chunked_sections, section_vectors, section_meta):
+        for chunk_index, (chunk, vector) in enumerate(zip(section_chunks, vectors)):
+            chunks.append(chunk)
+            # Порядковый номер в разделе - для склейки соседних чанков в контексте
+            metadata.append(dict(meta, chunk_index=chunk_index))
+            chunk_vectors.append(vector)
+    return chunks, metadata, chunk_vectors
+
+
+def coverage_report(structure: Dict, indexed_chars: int) -> Dict[str, Any]:
+    """
+    Полнота индекса: символы текста документа (без пробелов, без заголовков -
+    они хранятся в метаданных) против символов в чанках индекса.
+    Считается по ходу загрузки, повторного чтения документа не требуется.
+    """
+    source = structure.get('coverage', {})
+    source_chars = source.get('source_chars', 0)
+    return {
+        'source_chars': source_chars,
+        'heading_chars': source.get('heading_chars', 0),
+        'indexed_chars': indexed_chars,
+        'ratio': round(indexed_chars / source_chars, 4) if source_chars else 1.0
+    }
+
+
+class PipelineStopped(Exception):
+    """Одна из стадий завершилась с ошибкой - остальные останавливаются"""
+
+
+class IngestPipeline:
+    """
+    Конвейерная загрузка документа: парсинг -> чанкование -> кодирование -> запись в Chroma.
+    Каждая стадия - отдельный поток, между стадиями - очереди ограниченного размера,
+    поэтому кодирование (CPU/GPU) и collection.add (I/O) идут одновременно,
+    а время загрузки приближается ко времени самой медленной стадии, а не к их сумме.
+    Ограниченные очереди удерживают в памяти лишь несколько пакетов.
+    """
+
+    STAGES = ('parse', 'chunk', 'embed', 'write')
+
+    def __init__(self, parser, chunker, vector_agent, pooling: str = 'encode',
+                 section_batch_chars: int = 50000, queue_size: int = 4):
+        self.parser = parser
+        self.chunker = chunker
+        self.vector = vector_agent
+        self.pooling = pooling
+        self.section_batch_chars = section_batch_chars
+        self.queue_size = queue_size
+
+    def run(self, docx_path: str, document_id: str, streaming: bool = True,
+            progress: Optional[Callable] = None) -> Dict[str, Any]:
+        """
+        Загрузка документа. Возвращает структуру, число чанков, дельту индекса,
+        полноту индекса (coverage) и время работы каждой стадии (busy_s) -
+        по нему видно узкое место.
+        progress(stage, **counters) - как у RAGOrchestrator.process_document.
+        """
+        progress = progress or (lambda stage, **counters: None)
+        sections: "queue.Queue" = queue.Queue(self.queue_size)
+        chunk_batches: "queue.Queue" = queue.Queue(self.queue_size)
+        encoded_batches: "queue.Queue" = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        errors: List[BaseException] = []
+        busy = {stage: 0.0 for stage in self.STAGES}
+        state: Dict[str, Any] = {'structure': None, 'sections': 0, 'chunks': 0, 'indexed_chars': 0}
+        session = self.vector.begin_index(document_id)
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+            raise PipelineStopped()
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            raise PipelineStopped()
+
+        def stage(name, body, output):
+            def target():
+                try:
+                    body()
+                except PipelineStopped:
+                    return
+                except BaseException as e:
+                    print(f"❌ Стадия {name}: {e}")
+                    errors.append(e)
+                    stop.set()
+                    return
+                if output is not None:
+                    try:
+                        put(output, _DONE)
+                    except PipelineStopped:
+                        pass
+            return threading.Thread(target=target, name=f"ingest-{name}", daemon=True)
+
+        # 1. Парсинг: готовые главы/разделы копятся в пакет до section_batch_chars символов
+        def parse():
+            batch_texts, batch_meta = [], []
+            batch_chars = 0
+            started = time.perf_counter()
+
+            def on_node(node, path):
+                nonlocal batch_texts, batch_meta, batch_chars, started
+                if not node.get('content'):
+                    return
+                batch_texts.append(node['content'])
+                batch_meta.append(node_metadata(path))
+                batch_chars += len(node['content'])
+                if batch_chars >= self.section_batch_chars:
+                    busy['parse'] += time.perf_counter() - started
+                    put(sections, (batch_texts, batch_meta))
+                    started = time.perf_counter()
+                    batch_texts, batch_meta, batch_chars = [], [], 0
+
+            state['structure'] = self.parser.parse_with_hierarchy(
+                docx_path, streaming=streaming, on_node=on_node, keep_content=not streaming
+            )
+            busy['parse'] += time.perf_counter() - started
+            if batch_texts:
+                put(sections, (batch_texts, batch_meta))
+            progress('parsed', chapters=len(state['structure']['chapters']))
+
+        # 2. Чанкование пакета разделов (с эмбеддингами предложений)
+        def chunk():
+            while True:
+                item = get(sections)
+                if item is _DONE:
+                    return
+                texts, meta = item
+                started = time.perf_counter()
+                if self.pooling == 'encode':
+                    chunked = self.chunker.chunk_document(texts)
+                    vectors = [[None] * len(c) for c in chunked]
+                else:
+                    chunked, vectors = self.chunker.chunk_document(texts, pooling=self.pooling)
+                batch = assemble_chunks(chunked, vectors, meta)
+                busy['chunk'] += time.perf_counter() - started
+                state['sections'] += len(texts)
+                progress('chunking', sections_done=state['sections'], sections_total=None)
+                if batch[0]:
+                    put(chunk_batches, batch)
+
+        # 3. Кодирование чанков без готовых векторов (только новых для индекса)
+        def embed():
+            while True:
+                item = get(chunk_batches)
+                if item is _DONE:
+                    return
+                chunks, metadata, vectors = item
+                started = time.perf_counter()
+                missing = [i for i in self.vector.new_chunk_positions(session, chunks, metadata)
+                           if vectors[i] is None]
+                if missing:
+                    encoded = self.vector.embedder.encode_cached([chunks[i] for i in missing],
+                                                                 batch_size=self.vector.batch_size)
+                    for i, vector in zip(missing, encoded):
+                        vectors[i] = vector
+                busy['embed'] += time.perf_counter() - started
+                put(encoded_batches, item)
+
+        # 4. Запись в коллекцию
+        def write():
+            while True:
+                item = get(encoded_batches)
+                if item is _DONE:
+                    return
+                chunks, metadata, vectors = item
+                started = time.perf_counter()
+                self.vector.write_batch(session, chunks, metadata, vectors)
+                busy['write'] += time.perf_counter() - started
+                state['chunks'] += len(chunks)
+                state['indexed_chars'] += sum(text_chars(chunk) for chunk in chunks)
+                progress('embedding', chunks=state['chunks'], chunks_embedded=state['chunks'],
+                         chunks_to_embed=None)
+
+        started = time.perf_counter()
+        threads = [
+            stage('parse', parse, sections),
+            stage('chunk', chunk, chunk_batches),
+            stage('embed', embed, encoded_batches),
+            stage('write', write, None)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # Прежний индекс документа остается рабочим
+            self.vector.abort_index(session)
+            raise errors[0]
+
+        structure = state['structure']
+        try:
+            index_delta = self.vector.finish_index(session, {
+                'filename': structure['document'],
+                'chapters_count': len(structure['chapters'])
+            })
+        except Exception:
+            self.vector.abort_index(session)
+            raise
+        elapsed = time.perf_counter() - started
+        timing = {f"{name}_busy_s": round(value, 3) for name, value in busy.items()}
+        timing['elapsed_s'] = round(elapsed, 3)
+        print(f"⏱️ Конвейер: {elapsed:.2f} с; занятость стадий: "
+              + ", ".join(f"{name} {busy[name]:.2f} с" for name in self.STAGES))
+        return {
+            'structure': structure,
+            'chunks_count': len(session['ids']),
+            'index_delta': index_delta,
+            'coverage': coverage_report(structure, state['indexed_chars']),
+            'timing': timing
+        }
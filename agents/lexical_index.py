@@ -0,0 +1,197 @@
+# agents/lexical_index.py
+import re
+import os
+from array import array
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    from nltk.stem.snowball import SnowballStemmer
+    _russian_stemmer = SnowballStemmer("russian")
+    _english_stemmer = SnowballStemmer("english")
+except Exception:
+    _russian_stemmer = _english_stemmer = None
+
+# Слова, номера и коды: "статья", "12.3.4", "ГОСТ-12345", "п/п"
+TOKEN_PATTERN = re.compile(r"\w+(?:[./\-]\w+)*")
+CYRILLIC_PATTERN = re.compile(r"[а-я]")
+
+
+@lru_cache(maxsize=200000)
+def _stem(word: str) -> str:
+    if len(word) <= 3 or any(ch.isdigit() for ch in word):
+        return word
+    if _russian_stemmer is None:
+        return word
+    if CYRILLIC_PATTERN.search(word):
+        return _russian_stemmer.stem(word)
+    return _english_stemmer.stem(word)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Токены для BM25: нижний регистр, ё -> е, стемминг Snowball для слов.
+    Составные коды сохраняются целиком и дополнительно разбиваются на части,
+    чтобы "12345" находил "ГОСТ-12345".
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower().replace('ё', 'е')):
+        token = match.group()
+        if token.isalpha():
+            tokens.append(_stem(token))
+            continue
+        tokens.append(token)
+        parts = re.split(r"[./\-]", token)
+        if len(parts) > 1:
+            tokens.extend(_stem(p) for p in parts if p)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    Инвертированный индекс BM25 по чанкам одного документа.
+    Постинги хранятся в массивах numpy (CSR: indptr / chunk / weight) с заранее
+    посчитанным весом BM25 и отсортированы по убыванию веса внутри терма,
+    поэтому для частых термов достаточно взять первые max_postings записей.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, max_postings: int = 2048):
+        self.k1 = k1
+        self.b = b
+        self.max_postings = max_postings
+        self.vocab: Dict[str, int] = {}
+        self.chunk_ids: List[str] = []
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.postings = np.zeros(0, dtype=np.int32)
+        self.weights = np.zeros(0, dtype=np.float32)
+        self._rows: Optional[Dict[str, int]] = None  # chunk_id -> номер чанка (лениво)
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def build(self, chunk_ids: List[str], texts: Iterable[str]) -> "LexicalIndex":
+        """
+        Построение индекса с нуля по текстам чанков. texts читаются один раз
+        (можно передать генератор), строки постингов копятся в компактных
+        массивах array, а не в списках Python - на миллионе чанков это
+        десятки миллионов записей.
+        """
+        self.chunk_ids = list(chunk_ids)
+        self._rows = None
+        self.vocab = {}
+        term_rows, chunk_rows, tf_rows = array('i'), array('i'), array('f')
+        length_rows = array('f')
+
+        for i, text in enumerate(texts):
+            tokens = tokenize(text)
+            length_rows.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_rows.append(self.vocab.setdefault(term, len(self.vocab)))
+                chunk_rows.append(i)
+                tf_rows.append(tf)
+
+        terms = np.frombuffer(term_rows, dtype=np.int32)
+        chunks = np.frombuffer(chunk_rows, dtype=np.int32)
+        tf = np.frombuffer(tf_rows, dtype=np.float32)
+        lengths = np.frombuffer(length_rows, dtype=np.float32)
+
+        n = max(len(lengths), 1)
+        df = np.bincount(terms, minlength=len(self.vocab)).astype(np.float32)
+        idf = np.log1p((n - df + 0.5) / (df + 0.5))
+        avg_length = float(lengths.mean()) if len(lengths) and lengths.mean() > 0 else 1.0
+        norm = self.k1 * (1 - self.b + self.b * lengths[chunks] / avg_length)
+        weights = idf[terms] * tf * (self.k1 + 1) / (tf + norm)
+
+        # Группировка по терму, внутри терма - по убыванию веса
+        order = np.lexsort((-weights, terms))
+        self.postings = chunks[order]
+        self.weights = weights[order].astype(np.float32)
+        self.indptr = np.concatenate([[0], np.cumsum(df.astype(np.int64))])
+        return self
+
+    def mask(self, chunk_ids: Iterable[str]) -> np.ndarray:
+        """Маска чанков (по номеру в индексе) для ограничения поиска областью фильтра"""
+        if self._rows is None:
+            self._rows = {chunk_id: i for i, chunk_id in enumerate(self.chunk_ids)}
+        mask = np.zeros(len(self.chunk_ids), dtype=bool)
+        rows = [self._rows[chunk_id] for chunk_id in chunk_ids if chunk_id in self._rows]
+        mask[rows] = True
+        return mask
+
+    def search(self, query: str, top_k: int = 10,
+               mask: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """
+        Топ чанков по BM25: [(chunk_id, score)].
+        mask - чанки, среди которых искать (фильтр по главе и т.п.): постинги
+        отбираются по маске до отсечения max_postings, поэтому частые термы
+        не вытесняют подходящие чанки за пределы выборки.
+        """
+        term_ids = {self.vocab[t] for t in tokenize(query) if t in self.vocab}
+        if not term_ids:
+            return []
+
+        chunk_parts, weight_parts = [], []
+        for term_id in term_ids:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            if mask is None:
+                end = min(end, start + self.max_postings)
+                chunk_parts.append(self.postings[start:end])
+                weight_parts.append(self.weights[start:end])
+            else:
+                keep = mask[self.postings[start:end]]
+                chunk_parts.append(self.postings[start:end][keep][:self.max_postings])
+                weight_parts.append(self.weights[start:end][keep][:self.max_postings])
+
+        chunks = np.concatenate(chunk_parts)
+        weights = np.concatenate(weight_parts)
+        if len(chunk_parts) == 1:
+            candidates, scores = chunks, weights
+        else:
+            candidates, inverse = np.unique(chunks, return_inverse=True)
+            scores = np.bincount(inverse, weights=weights).astype(np.float32)
+
+        k = min(top_k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.chunk_ids[candidates[i]], float(scores[i])) for i in top]
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        terms = sorted(self.vocab, key=self.vocab.get)
+        np.savez(
+            path,
+            terms=np.array(terms, dtype=str),
+            chunk_ids=np.array(self.chunk_ids, dtype=str),
+            indptr=self.indptr,
+            postings=self.postings,
+            weights=self.weights,
+            params=np.array([self.k1, self.b, self.max_postings], dtype=np.float64)
+        )
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        if not os.path.exists(path):
+            return None
+        data = np.load(path, allow_pickle=False)
+        k1, b, max_postings = data['params'].tolist()
+        index = cls(k1=k1, b=b, max_postings=int(max_postings))
+        index.vocab = {term: i for i, term in enumerate(data['terms'].tolist())}
+        index.chunk_ids = data['chunk_ids'].tolist()
+        index.indptr = data['indptr']
+        index.postings = data['postings']
+        index.weights = data['weights']
+        return index
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """Слияние ранжирований (RRF): score = сумма 1 / (k + ранг)"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
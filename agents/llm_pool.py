@@ -0,0 +1,342 @@
+# agents/llm_pool.py
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+import httpx
+import requests
+
+
+def parse_models(data: Dict[str, Any]) -> List[str]:
+    """Список моделей из ответа GET /models (формат OpenAI или LM Studio)"""
+    if 'data' in data:
+        return [m['id'] for m in data['data']]
+    if 'models' in data:
+        return data['models']
+    return []
+
+
+class LLMBackend:
+    """
+    Состояние одного сервера генерации: число запросов в работе, задержка,
+    результат проверки здоровья и автомат circuit breaker
+    (closed -> open после failure_threshold ошибок подряд -> half_open после cooldown).
+    """
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.healthy = True
+        self.models: List[str] = []
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.latency_ms: Optional[float] = None  # скользящее среднее
+        self.requests = 0
+        self.failures = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'state': self.state,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'latency_ms': round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            'requests': self.requests,
+            'failures': self.failures,
+            'models': self.models
+        }
+
+
+class LLMPool:
+    """
+    Пул OpenAI-совместимых серверов генерации (LM Studio, llama.cpp).
+    Запрос уходит на доступный сервер с наименьшим числом запросов в работе;
+    при ошибке соединения или ответе 5xx - на следующий. Серверы периодически
+    проверяются через GET /models. Для асинхронных запросов возможен
+    хеджированный запрос: если ответа нет за hedge_after_ms, тот же запрос
+    отправляется на второй сервер, используется первый ответ.
+    """
+
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, urls: List[str], timeout: float = 180,
+                 failure_threshold: int = 3, cooldown: float = 30,
+                 health_interval: Optional[float] = 30,
+                 hedge_after_ms: Optional[float] = None,
+                 http2: bool = False):
+        if not urls:
+            raise ValueError("Пул LLM: не задан ни один сервер")
+        self.backends = [LLMBackend(url) for url in urls]
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health_interval = health_interval
+        self.hedge_after_ms = hedge_after_ms
+        self.hedged = 0
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json"})
+
+        # HTTP/2 требует пакет h2 (httpx[http2]); без него - HTTP/1.1
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                http2 = False
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_keepalive_connections=10 * len(urls), max_connections=20 * len(urls)),
+            headers={"Content-Type": "application/json"},
+            http2=http2
+        )
+
+        self._stop = threading.Event()
+        self._health_thread = None
+        if health_interval:
+            self._health_thread = threading.Thread(target=self._health_loop, name="llm-health", daemon=True)
+            self._health_thread.start()
+
+        print(f"✅ Пул LLM: {', '.join(b.url for b in self.backends)}")
+
+    @property
+    def primary_url(self) -> str:
+        return self.backends[0].url
+
+    # ---------- выбор сервера и учет результатов ----------
+
+    def _is_available(self, backend: LLMBackend, now: float) -> bool:
+        """Сервер можно выбрать (состояние при этом не меняется)"""
+        if not backend.healthy:
+            return False
+        return backend.state != 'open' or now - backend.opened_at >= self.cooldown
+
+    def _acquire(self, exclude=()) -> Optional[LLMBackend]:
+        """Доступный сервер с наименьшим числом запросов в работе (затем - по задержке)"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b not in exclude and self._is_available(b, now)]
+            if not candidates:
+                # Все серверы помечены недоступными - пробуем любой, чем не пробовать ни одного
+                candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            backend = min(candidates, key=lambda b: (
+                b.outstanding, b.latency_ms if b.latency_ms is not None else 0.0
+            ))
+            if backend.state == 'open' and now - backend.opened_at >= self.cooldown:
+                backend.state = 'half_open'  # пробный запрос после паузы - только выбранному
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def _release(self, backend: LLMBackend, ok: Optional[bool], latency_ms: Optional[float] = None):
+        """
+        Учет завершения запроса. ok=None - запрос отменен на нашей стороне
+        (проигравший хедж, отключившийся клиент): о сервере это ничего не говорит,
+        состояние circuit breaker не меняется
+        """
+        with self._lock:
+            backend.outstanding = max(0, backend.outstanding - 1)
+            if ok is None:
+                return
+            if ok:
+                backend.consecutive_failures = 0
+                backend.state = 'closed'
+                if latency_ms is not None:
+                    backend.latency_ms = latency_ms if backend.latency_ms is None else (
+                        (1 - self.LATENCY_SMOOTHING) * backend.latency_ms + self.LATENCY_SMOOTHING * latency_ms
+                    )
+                return
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            if backend.state == 'half_open' or backend.consecutive_failures >= self.failure_threshold:
+                if backend.state != 'open':
+                    print(f"⚠️ LLM сервер {backend.url} временно исключен из пула")
+                backend.state = 'open'
+                backend.opened_at = time.monotonic()
+
+    # ---------- синхронные запросы ----------
+
+    def post(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None) -> requests.Response:
+        """
+        POST на сервер пула с переключением на следующий при ошибке соединения или 5xx.
+        Возвращает последний полученный ответ или пробрасывает последнюю ошибку.
+        """
+        tried = []
+        last_error: Optional[Exception] = None
+        last_response = None
+        while len(tried) < len(self.backends):
+            backend = self._acquire(exclude=tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            started = time.perf_counter()
+            try:
+                response = self.session.post(f"{backend.url}{path}", json=payload,
+                                             timeout=timeout or self.timeout)
+            except requests.exceptions.RequestException as e:
+                self._release(backend, ok=False)
+                print(f"⚠️ LLM сервер {backend.url}: {e}")
+                last_error = e
+                continue
+            ok = response.status_code < 500
+            self._release(backend, ok, (time.perf_counter() - started) * 1000)
+            if ok:
+                return response
+            last_response = response
+        if last_response is not None:
+            return last_response
+        raise last_error or requests.exceptions.ConnectionError("Нет доступных LLM серверов")
+
+    # ---------- асинхронные запросы ----------
+
+    async def _apost_once(self, backend: LLMBackend, path: str, payload: Dict[str, Any]) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await self.client.post(f"{backend.url}{path}", json=payload)
+        except asyncio.CancelledError:
+            self._release(backend, ok=None)  # отменен хеджированным соседом - не ошибка сервера
+            raise
+        except Exception:
+            self._release(backend, ok=False)
+            raise
+        self._release(backend, response.status_code < 500, (time.perf_counter() - started) * 1000)
+        return response
+
+    async def apost(self, path: str, payload: Dict[str, Any]) -> httpx.Response:
+        """
+        Асинхронный POST: переключение на следующий сервер при ошибке и,
+        если задан hedge_after_ms, дублирующий запрос на второй сервер
+        """
+        tried: List[LLMBackend] = []
+        last_error: Optional[Exception] = None
+        last_response = None
+        tasks: set = set()
+
+        try:
+            while len(tried) < len(self.backends):
+                backend = self._acquire(exclude=tried)
+                if backend is None:
+                    break
+                tried.append(backend)
+                tasks = {asyncio.ensure_future(self._apost_once(backend, path, payload))}
+
+                if self.hedge_after_ms and len(tried) < len(self.backends):
+                    done, _ = await asyncio.wait(tasks, timeout=self.hedge_after_ms / 1000)
+                    if not done:
+                        hedge = self._acquire(exclude=tried)
+                        if hedge is not None:
+                            tried.append(hedge)
+                            self.hedged += 1
+                            tasks.add(asyncio.ensure_future(self._apost_once(hedge, path, payload)))
+
+                while tasks:
+                    done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        try:
+                            response = task.result()
+                        except Exception as e:
+                            last_error = e
+                            continue
+                        if response.status_code < 500:
+                            return response
+                        last_response = response
+        finally:
+            # Оставшиеся запросы (хедж-сосед или все, если отменили сам apost) не должны
+            # висеть на серверах и занимать outstanding
+            for task in tasks:
+                task.cancel()
+
+        if last_response is not None:
+            return last_response
+        raise last_error or httpx.ConnectError("Нет доступных LLM серверов")
+
+    @asynccontextmanager
+    async def stream(self, path: str, payload: Dict[str, Any]):
+        """
+        Потоковый POST. Переключение на другой сервер возможно только до начала
+        ответа: любая ошибка HTTP (соединение, таймаут, обрыв) или статус 5xx
+        """
+        tried: List[LLMBackend] = []
+        last_error: Optional[Exception] = None
+        while len(tried) < len(self.backends):
+            backend = self._acquire(exclude=tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            started = time.perf_counter()
+            streaming = False
+            released = False
+            try:
+                async with self.client.stream("POST", f"{backend.url}{path}", json=payload) as response:
+                    if response.status_code >= 500 and len(tried) < len(self.backends):
+                        released = True
+                        self._release(backend, ok=False)
+                        continue
+                    streaming = True
+                    try:
+                        yield response
+                    except httpx.HTTPError:
+                        released = True
+                        self._release(backend, ok=False)  # обрыв ответа сервера
+                        raise
+                    except BaseException:
+                        released = True
+                        self._release(backend, ok=None)  # отмена или ошибка у получателя
+                        raise
+                    released = True
+                    self._release(backend, response.status_code < 500, (time.perf_counter() - started) * 1000)
+                    return
+            except httpx.HTTPError as e:
+                if not released:
+                    self._release(backend, ok=False)
+                if streaming:
+                    raise
+                last_error = e
+            except BaseException:
+                if not released:
+                    self._release(backend, ok=None)
+                raise
+        raise last_error or httpx.ConnectError("Нет доступных LLM серверов")
+
+    # ---------- проверка здоровья ----------
+
+    def check_backend(self, backend: LLMBackend) -> bool:
+        """GET /models: сервер жив и отдает список моделей"""
+        try:
+            response = self.session.get(f"{backend.url}/models", timeout=5)
+            healthy = response.status_code == 200
+            if healthy:
+                backend.models = parse_models(response.json())
+        except Exception:
+            healthy = False
+        with self._lock:
+            if healthy != backend.healthy:
+                print(f"{'✅' if healthy else '⚠️'} LLM сервер {backend.url}: "
+                      f"{'доступен' if healthy else 'не отвечает'}")
+            backend.healthy = healthy
+        return healthy
+
+    def check_all(self) -> List[Dict[str, Any]]:
+        for backend in self.backends:
+            self.check_backend(backend)
+        return [backend.to_dict() for backend in self.backends]
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_interval):
+            self.check_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'backends': [backend.to_dict() for backend in self.backends],
+                'hedged_requests': self.hedged
+            }
+
+    async def aclose(self):
+        self._stop.set()
+        await self.client.aclose()
@@ -0,0 +1,109 @@
+# agents/node_index.py
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class NodeIndex:
+    """
+    Векторы узлов дерева документа (глав и разделов) для поиска «сверху вниз»:
+    вектор узла - смесь эмбеддинга заголовка и центроида векторов его чанков.
+    Сначала выбираются ближайшие к запросу узлы, затем чанки ищутся только в них.
+    """
+
+    def __init__(self, title_weight: float = 0.3):
+        self.title_weight = title_weight
+        self.kinds: List[str] = []      # 'chapter' | 'section'
+        self.node_ids: List[str] = []
+        self.titles: List[str] = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def build(self, metadatas: List[Dict], embeddings, embedder) -> "NodeIndex":
+        """
+        metadatas/embeddings - все чанки документа; embedder кодирует заголовки.
+        Глава охватывает и чанки своих разделов.
+        """
+        groups: "OrderedDict[tuple, Dict]" = OrderedDict()
+        for row, meta in enumerate(metadatas):
+            chapter_id = meta.get('chapter_id')
+            if chapter_id is None:
+                continue
+            chapter_title = meta.get('chapter_title') or ''
+            groups.setdefault(('chapter', chapter_id), {'title': chapter_title, 'rows': []})['rows'].append(row)
+            if meta.get('section_id'):
+                title = f"{chapter_title}. {meta.get('section_title') or ''}".strip('. ')
+                groups.setdefault(('section', meta['section_id']), {'title': title, 'rows': []})['rows'].append(row)
+
+        if not groups:
+            return self
+
+        embeddings = _normalize(embeddings)
+        centroids = _normalize(np.stack([embeddings[g['rows']].mean(axis=0) for g in groups.values()]))
+        titles = [g['title'] for g in groups.values()]
+        title_vectors = _normalize(embedder.encode_cached(titles)) if any(titles) else np.zeros_like(centroids)
+        has_title = np.array([bool(t) for t in titles])[:, None]
+        weight = np.where(has_title, self.title_weight, 0.0).astype(np.float32)
+
+        self.kinds = [kind for kind, _ in groups]
+        self.node_ids = [node_id for _, node_id in groups]
+        self.titles = titles
+        self.counts = np.array([len(g['rows']) for g in groups.values()], dtype=np.int64)
+        self.vectors = _normalize(weight * title_vectors + (1 - weight) * centroids)
+        return self
+
+    def select(self, query_embedding, top_nodes: int = 5) -> Optional[Dict]:
+        """
+        Фильтр Chroma (where) по top_nodes ближайшим узлам; None - если узлов
+        слишком мало, чтобы сужение имело смысл
+        """
+        if len(self) <= top_nodes:
+            return None
+        query = _normalize(np.asarray(query_embedding).ravel())
+        scores = self.vectors @ query
+        top = np.argpartition(-scores, top_nodes - 1)[:top_nodes]
+
+        chapters = sorted(self.node_ids[i] for i in top if self.kinds[i] == 'chapter')
+        sections = sorted(self.node_ids[i] for i in top if self.kinds[i] == 'section')
+        conditions = []
+        if chapters:
+            conditions.append({'chapter_id': {'$in': chapters}})
+        if sections:
+            conditions.append({'section_id': {'$in': sections}})
+        return conditions[0] if len(conditions) == 1 else {'$or': conditions}
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(
+            path,
+            kinds=np.array(self.kinds, dtype=str),
+            node_ids=np.array(self.node_ids, dtype=str),
+            titles=np.array(self.titles, dtype=str),
+            counts=self.counts,
+            vectors=self.vectors,
+            title_weight=np.array([self.title_weight], dtype=np.float64)
+        )
+
+    @classmethod
+    def load(cls, path: str) -> Optional["NodeIndex"]:
+        if not os.path.exists(path):
+            return None
+        data = np.load(path, allow_pickle=False)
+        index = cls(title_weight=float(data['title_weight'][0]))
+        index.kinds = data['kinds'].tolist()
+        index.node_ids = data['node_ids'].tolist()
+        index.titles = data['titles'].tolist()
+        index.counts = data['counts']
+        index.vectors = data['vectors']
+        return index
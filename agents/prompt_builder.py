@@ -0,0 +1,89 @@
+# agents/prompt_builder.py
+from typing import List, Dict, Optional
+
+from agents.context_packer import ContextPacker
+
+SYSTEM_PROMPT = """Ты - ассистент по анализу документов. 
+        Используй предоставленные фрагменты документа для ответа.
+        Обязательно указывай номера глав и разделов в ответе.
+        Если информации недостаточно - так и скажи.
+        Отвечай на том же языке, на котором задан вопрос."""
+
+
+def format_context(chunks: List[Dict], packer: Optional[ContextPacker] = None) -> str:
+    """Форматирование контекста в пределах бюджета токенов (см. ContextPacker)"""
+    return (packer or ContextPacker()).format(chunks)
+
+
+PROMPT_LAYOUTS = ('question_first', 'prefix_stable')
+
+
+def build_messages(query: str, context_text: str, system_prompt: str = SYSTEM_PROMPT,
+                   layout: str = 'question_first') -> List[Dict]:
+    """
+    Сообщения чата в формате OpenAI API.
+    layout='prefix_stable' - вопрос в самом конце: системный промпт и контекст
+    образуют общий префикс запросов к одному разделу, и сервер (LM Studio /
+    llama.cpp) переиспользует его KV-кэш вместо повторного prefill.
+    """
+    if layout == 'prefix_stable':
+        content = f"""Контекст из документа:
+{context_text}
+
+Ответь на вопрос, используя только предоставленный контекст.
+Укажи источники (глава, раздел) в ответе.
+
+Вопрос: {query}
+"""
+    else:
+        content = f"""
+Вопрос: {query}
+
+Контекст из документа:
+{context_text}
+
+Ответь на вопрос, используя только предоставленный контекст.
+Укажи источники (глава, раздел) в ответе.
+"""
+    return [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": content
+        }
+    ]
+
+
+class GenerationError(str):
+    """
+    Сообщение об ошибке генерации (таймаут, сервер недоступен, ошибка API).
+    Показывается пользователю вместо ответа, но по типу отличается от ответа
+    модели - такие результаты не попадают в кэш ответов.
+    """
+
+
+def parse_usage(data: Dict) -> Dict:
+    """
+    Токены промпта и ответа из ответа сервера: usage в формате OpenAI
+    (prompt_tokens_details.cached_tokens) или timings llama.cpp (cache_n, prompt_n)
+    """
+    usage = data.get('usage') or {}
+    timings = data.get('timings') or {}
+    result = {}
+    if usage.get('prompt_tokens') is not None:
+        result['prompt_tokens'] = usage['prompt_tokens']
+    if usage.get('completion_tokens') is not None:
+        result['completion_tokens'] = usage['completion_tokens']
+    cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+    if cached is None:
+        cached = timings.get('cache_n')
+    if cached is not None:
+        result['cached_tokens'] = cached
+    if 'prompt_tokens' not in result and timings.get('prompt_n') is not None:
+        result['prompt_tokens'] = timings['prompt_n'] + (timings.get('cache_n') or 0)
+    if timings.get('prompt_ms') is not None:
+        result['prefill_ms'] = round(timings['prompt_ms'], 1)
+    return result
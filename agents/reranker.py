@@ -0,0 +1,166 @@
+# agents/reranker.py
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+DEFAULT_RERANK_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"  # многоязычная, CPU
+
+
+class RerankerAgent:
+    """
+    Переранжирование найденных чанков локальным cross-encoder.
+    Пары (вопрос, чанк) оцениваются одним пакетом, оценки кэшируются.
+    Если оценка не укладывается в latency_budget_ms, возвращается исходный
+    порядок векторного поиска (а досчитанные оценки попадают в кэш).
+    Очередь оценок ограничена max_pending: когда поток занят, новые запросы
+    сразу получают порядок поиска, а не копятся за чужими оценками.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_RERANK_MODEL, device: str = "cpu",
+                 batch_size: int = 32, cache_size: int = 20000,
+                 latency_budget_ms: float = 1000, max_length: int = 512,
+                 max_pending: int = 1):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.latency_budget_ms = latency_budget_ms
+        self.max_length = max_length
+
+        self._model = None
+        self._load_failed = False
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, float]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Один поток: оценка не блокирует запрос дольше бюджета
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+        # Оценки в работе и в очереди потока (в том числе отставшие от бюджета)
+        self._pending = threading.BoundedSemaphore(max(1, max_pending))
+
+        self.reranked = 0
+        self.fallbacks = 0
+        self.busy_skips = 0
+        self.cache_hits = 0
+        self.pairs_scored = 0
+        self.last_latency_ms = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self):
+        """Загрузка модели (потокобезопасно, ровно один раз)"""
+        if self._model is not None or self._load_failed:
+            return self._model
+
+        with self._lock:
+            if self._model is not None or self._load_failed:
+                return self._model
+            print(f"📦 Загрузка модели переранжирования: {self.model_name}")
+            try:
+                from sentence_transformers import CrossEncoder
+                self._model = CrossEncoder(self.model_name, device=self.device, max_length=self.max_length)
+                print(f"✅ Модель переранжирования загружена: {self.model_name}")
+            except Exception as e:
+                self._load_failed = True
+                print(f"⚠️ Переранжирование отключено, модель не загружена: {e}")
+        return self._model
+
+    def warmup(self, background: bool = True):
+        if background:
+            self._executor.submit(self.load)
+        else:
+            self.load()
+
+    def _cache_key(self, query: str, chunk: Dict) -> str:
+        chunk_key = chunk.get('id') or chunk.get('text', '')
+        payload = f"{' '.join(query.lower().split())}\x00{chunk_key}"
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def _score_pairs(self, keys: List[str], pairs: List[List[str]]) -> Dict[str, float]:
+        """Оценка пар моделью (в потоке переранжирования) с записью в кэш"""
+        model = self.load()
+        if model is None:
+            raise RuntimeError("Модель переранжирования недоступна")
+        scores = np.asarray(model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False),
+                            dtype=np.float32).ravel()
+        scored = dict(zip(keys, scores.tolist()))
+        with self._cache_lock:
+            for key, score in scored.items():
+                self._cache[key] = score
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self.pairs_scored += len(pairs)
+        return scored
+
+    def rerank(self, query: str, chunks: List[Dict], top_k: int = 5) -> List[Dict]:
+        """Топ top_k чанков по оценке cross-encoder (или исходный порядок при сбое/таймауте)"""
+        if not chunks:
+            return chunks
+        started = time.perf_counter()
+
+        keys = [self._cache_key(query, chunk) for chunk in chunks]
+        scores: Dict[str, float] = {}
+        with self._cache_lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[key] = self._cache[key]
+            self.cache_hits += len(scores)
+
+        missing = [(key, chunk) for key, chunk in zip(keys, chunks) if key not in scores]
+        if missing:
+            unique = OrderedDict((key, chunk) for key, chunk in missing)
+            pairs = [[query, chunk.get('text', '')] for chunk in unique.values()]
+            if not self._pending.acquire(blocking=False):
+                # Поток занят прежними оценками - не ставим новую в очередь
+                self.busy_skips += 1
+                self.fallbacks += 1
+                return chunks[:top_k]
+            try:
+                future = self._executor.submit(self._score_pairs, list(unique.keys()), pairs)
+            except Exception as e:
+                self._pending.release()
+                self.fallbacks += 1
+                print(f"⚠️ Ошибка переранжирования: {e}")
+                return chunks[:top_k]
+            future.add_done_callback(lambda _: self._pending.release())
+            try:
+                scores.update(future.result(timeout=self.latency_budget_ms / 1000))
+            except FutureTimeoutError:
+                # Еще не начатая оценка (поток занят загрузкой модели) отменяется
+                future.cancel()
+                self.fallbacks += 1
+                print(f"⚠️ Переранжирование не уложилось в {self.latency_budget_ms} мс, порядок поиска сохранен")
+                return chunks[:top_k]
+            except Exception as e:
+                self.fallbacks += 1
+                print(f"⚠️ Ошибка переранжирования: {e}")
+                return chunks[:top_k]
+
+        order = sorted(range(len(chunks)), key=lambda i: scores[keys[i]], reverse=True)
+        self.reranked += 1
+        self.last_latency_ms = int((time.perf_counter() - started) * 1000)
+        return [dict(chunks[i], rerank_score=round(scores[keys[i]], 4)) for i in order[:top_k]]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'model': self.model_name,
+            'loaded': self.is_loaded,
+            'reranked': self.reranked,
+            'fallbacks': self.fallbacks,
+            'busy_skips': self.busy_skips,
+            'pairs_scored': self.pairs_scored,
+            'cache_hits': self.cache_hits,
+            'cache_entries': len(self._cache),
+            'last_latency_ms': self.last_latency_ms
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,142 @@
+# agents/semantic_boundaries.py
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+def adjacent_similarities(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Косинусная схожесть соседних предложений одним проходом:
+    построчное скалярное произведение нормированной матрицы и ее сдвига.
+    Элемент i - схожесть предложений i и i+1.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(embeddings) < 2:
+        return np.zeros(0, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    normed = embeddings / norms
+    return np.einsum('ij,ij->i', normed[:-1], normed[1:])
+
+
+def threshold_breaks(similarities: np.ndarray, threshold: float = 0.6, **_) -> np.ndarray:
+    """Разрыв там, где схожесть ниже фиксированного порога"""
+    return similarities < threshold
+
+
+def percentile_breaks(similarities: np.ndarray, percentile: float = 10.0, **_) -> np.ndarray:
+    """
+    Разрыв в самых «непохожих» переходах (нижний перцентиль по документу).
+    Отбор по рангу: ровно ceil(n * percentile / 100) переходов, чтобы
+    одинаковые значения (например, повторяющиеся шаблонные фразы) не
+    превращались в разрыв все разом.
+    """
+    n = len(similarities)
+    mask = np.zeros(n, dtype=bool)
+    count = min(n, int(np.ceil(n * percentile / 100.0)))
+    if count > 0:
+        mask[np.argsort(similarities, kind='stable')[:count]] = True
+    return mask
+
+
+def zscore_breaks(similarities: np.ndarray, window: int = 5, zscore: float = -1.0, **_) -> np.ndarray:
+    """
+    Разрыв, если схожесть резко падает относительно скользящего окна
+    из window предыдущих переходов (z-оценка ниже zscore)
+    """
+    n = len(similarities)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+
+    values = similarities.astype(np.float64)
+    csum = np.concatenate([[0.0], np.cumsum(values)])
+    csum_sq = np.concatenate([[0.0], np.cumsum(values * values)])
+
+    idx = np.arange(n)
+    start = np.maximum(0, idx - window)
+    count = idx - start
+    safe_count = np.maximum(count, 1)
+    mean = (csum[idx] - csum[start]) / safe_count
+    var = (csum_sq[idx] - csum_sq[start]) / safe_count - mean * mean
+    std = np.sqrt(np.maximum(var, 1e-12))
+
+    z = (values - mean) / std
+    # Для первых переходов окно еще не набрано - разрывы там не ставим
+    return (z < zscore) & (count >= 2)
+
+
+BOUNDARY_STRATEGIES: Dict[str, Callable[..., np.ndarray]] = {
+    'threshold': threshold_breaks,
+    'percentile': percentile_breaks,
+    'zscore': zscore_breaks,
+}
+
+
+def detect_boundaries(embeddings: np.ndarray, strategy: str = 'threshold', **params) -> np.ndarray:
+    """
+    Индексы предложений, с которых начинаются новые чанки (без 0).
+    strategy - имя из BOUNDARY_STRATEGIES.
+    """
+    if strategy not in BOUNDARY_STRATEGIES:
+        raise ValueError(f"Неизвестная стратегия разрыва: {strategy}. "
+                         f"Доступны: {', '.join(BOUNDARY_STRATEGIES)}")
+    similarities = adjacent_similarities(embeddings)
+    mask = BOUNDARY_STRATEGIES[strategy](similarities, **params)
+    return np.flatnonzero(mask) + 1
+
+
+def enforce_chunk_sizes(lengths: List[int], breaks: np.ndarray,
+                        min_size: int = 0, max_size: Optional[int] = None) -> List[int]:
+    """
+    Ограничение размера чанков (в символах) по границам предложений.
+    Слишком длинные чанки режутся, слишком короткие сливаются с меньшим
+    из соседей, если слияние не выходит за max_size.
+    Возвращает границы [0, ..., n].
+    """
+    n = len(lengths)
+    if n == 0:
+        return [0]
+
+    # +1 на пробел при склейке предложений
+    cum = np.concatenate([[0], np.cumsum(np.asarray(lengths, dtype=np.int64) + 1)])
+    bounds = [0] + [int(b) for b in breaks if 0 < b < n] + [n]
+
+    if max_size:
+        split_bounds = [0]
+        for end in bounds[1:]:
+            start = split_bounds[-1]
+            while cum[end] - cum[start] > max_size + 1 and end - start > 1:
+                cut = int(np.searchsorted(cum, cum[start] + max_size + 1, side='right')) - 1
+                cut = min(max(cut, start + 1), end - 1)
+                split_bounds.append(cut)
+                start = cut
+            split_bounds.append(end)
+        bounds = split_bounds
+
+    if min_size and len(bounds) > 2:
+        def size(i: int) -> int:
+            return int(cum[bounds[i + 1]] - cum[bounds[i]])
+
+        # Короткий чанк сливается с меньшим из соседей, если результат
+        # не превышает max_size; иначе остается как есть
+        i = 0
+        while i < len(bounds) - 1 and len(bounds) > 2:
+            if size(i) >= min_size:
+                i += 1
+                continue
+            options = []
+            if i > 0:
+                options.append((size(i - 1), i))
+            if i < len(bounds) - 2:
+                options.append((size(i + 1), i + 1))
+            if max_size:
+                options = [(s, b) for s, b in options if s + size(i) <= max_size + 1]
+            if not options:
+                i += 1
+                continue
+            _, drop = min(options)
+            del bounds[drop]
+            # Слитый чанк проверяем еще раз
+            i = max(drop - 1, 0)
+
+    return bounds
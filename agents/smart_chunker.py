@@ -1,10 +1,12 @@
 # agents/smart_chunker.py (исправленная версия)
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+import re
 import numpy as np
 import nltk
 import traceback
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+
+from agents.embedding_provider import get_embedder
+from agents.semantic_boundaries import detect_boundaries, enforce_chunk_sizes
 
 # Скачиваем ресурсы NLTK
 try:
@@ -16,27 +18,94 @@ except Exception as e:
         # Простая токенизация по предложениям
         return [s.strip() + '.' for s in text.split('.') if s.strip()]
 
+POOLING_MODES = ('mean', 'attention')
+
+# Запасное разбиение на предложения: после .!? и пробела (знаки остаются в тексте)
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?…])\s+')
+_tokenizer_warned = False
+
+
+def split_text_sentences(text: str) -> List[str]:
+    """
+    Предложения текста. Без данных punkt (офлайн nltk.download молча не
+    скачивает их, а sent_tokenize падает с LookupError при первом вызове) -
+    простое разбиение после .!? - загрузка документа не прерывается.
+    """
+    global _tokenizer_warned
+    try:
+        return sent_tokenize(text)
+    except Exception as e:
+        if not _tokenizer_warned:
+            print(f"⚠️ Ошибка токенизации: {e}")
+            _tokenizer_warned = True
+        return [s for s in SENTENCE_SPLIT.split(text) if s.strip()]
+
+
+def pool_sentence_embeddings(embeddings: np.ndarray, mode: str = 'mean',
+                             temperature: float = 0.1) -> np.ndarray:
+    """
+    Вектор чанка из уже посчитанных эмбеддингов его предложений.
+    mean - среднее нормированных векторов;
+    attention - взвешенное среднее, веса - softmax схожести предложения
+    с центроидом чанка (предложения «по теме» весят больше).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    normed = embeddings / norms
+    
+    pooled = normed.mean(axis=0)
+    if mode == 'attention' and len(normed) > 1:
+        scores = normed @ (pooled / (np.linalg.norm(pooled) or 1.0)) / temperature
+        weights = np.exp(scores - scores.max())
+        weights /= weights.sum()
+        pooled = weights @ normed
+    elif mode not in POOLING_MODES:
+        raise ValueError(f"Неизвестный режим пулинга: {mode}")
+    
+    return pooled / (np.linalg.norm(pooled) or 1.0)
+
+def split_sentences(texts: List[str]) -> Tuple[List[List[str]], Dict[int, List[str]]]:
+    """
+    Первый проход чанкования: короткие тексты (и тексты из одного предложения)
+    сразу становятся одним чанком, остальные разбиваются на предложения.
+    Возвращает (готовые чанки по текстам, предложения по номеру текста).
+    Не требует модели - можно выполнять в отдельном процессе.
+    """
+    results: List[List[str]] = [[] for _ in texts]
+    section_sentences: Dict[int, List[str]] = {}
+    for idx, text in enumerate(texts):
+        if not text or not text.strip():
+            continue
+        if len(text) < 100:  # Слишком короткий текст
+            results[idx] = [text]
+            continue
+        sentences = split_text_sentences(text)
+        if len(sentences) <= 1:
+            results[idx] = [text]
+            continue
+        section_sentences[idx] = sentences
+    return results, section_sentences
+
 class SmartChunkerAgent:
     """Агент для интеллектуального разделения текста на чанки"""
     
-    def __init__(self, embedding_model="all-MiniLM-L6-v2", chunk_size=500, overlap=50):
+    def __init__(self, embedding_model="all-MiniLM-L6-v2", chunk_size=500, overlap=50,
+                 embedder=None, boundary_strategy="threshold", boundary_params=None,
+                 min_chunk_size=0, max_chunk_size=None, batch_size=64):
         self.chunk_size = chunk_size
         self.overlap = overlap
+        self.batch_size = batch_size
         
-        print(f"📦 Инициализация чанкера с моделью: {embedding_model}")
+        # Поиск семантических границ: стратегия и ограничения размера чанка
+        self.boundary_strategy = boundary_strategy
+        self.boundary_params = boundary_params or {}
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
         
-        try:
-            self.embedder = SentenceTransformer(embedding_model)
-            print(f"✅ Модель эмбеддингов загружена успешно")
-        except Exception as e:
-            print(f"⚠️ Ошибка загрузки {embedding_model}: {e}")
-            print(f"📦 Пробую fallback модель: all-MiniLM-L6-v2")
-            try:
-                self.embedder = SentenceTransformer('all-MiniLM-L6-v2')
-                print(f"✅ Fallback модель загружена")
-            except Exception as e2:
-                print(f"❌ Критическая ошибка загрузки модели: {e2}")
-                raise
+        # Общий (ленивый) эмбеддер - модель загружается один раз на процесс
+        self.embedder = embedder or get_embedder(embedding_model)
+        print(f"📦 Инициализация чанкера с моделью: {self.embedder.model_name}")
     
     def semantic_chunking(self, text: str) -> List[str]:
         """Адаптивное разделение текста"""
@@ -110,7 +179,7 @@ class SmartChunkerAgent:
             if not text or len(text) < 100:  # Слишком короткий текст
                 return [text]
             
-            sentences = sent_tokenize(text)
+            sentences = split_text_sentences(text)
             if len(sentences) <= 1:
                 return [text]
             
@@ -118,32 +187,13 @@ class SmartChunkerAgent:
             
             # Получаем эмбеддинги
             try:
-                embeddings = self.embedder.encode(sentences)
+                embeddings = self.embedder.encode_cached(sentences)
                 print(f"   Эмбеддинги получены: {embeddings.shape}")
             except Exception as e:
                 print(f"⚠️ Ошибка получения эмбеддингов: {e}")
                 return self.semantic_chunking(text)
             
-            # Ищем точки разрыва
-            breaks = [0]
-            for i in range(1, len(embeddings)):
-                similarity = cosine_similarity(
-                    embeddings[i-1].reshape(1, -1),
-                    embeddings[i].reshape(1, -1)
-                )[0][0]
-                
-                if similarity < 0.6:  # Порог семантического разрыва
-                    breaks.append(i)
-                    print(f"   Разрыв после предложения {i} (схожесть: {similarity:.3f})")
-            
-            breaks.append(len(sentences))
-            
-            # Формируем чанки
-            chunks = []
-            for i in range(len(breaks)-1):
-                chunk = ' '.join(sentences[breaks[i]:breaks[i+1]])
-                if chunk.strip():
-                    chunks.append(chunk)
+            chunks = self._chunks_from_embeddings(sentences, embeddings)
             
             print(f"✅ Семантическое разделение дало {len(chunks)} чанков")
             return chunks if chunks else [text]
@@ -151,4 +201,108 @@ class SmartChunkerAgent:
         except Exception as e:
             print(f"❌ Ошибка в split_by_semantics: {e}")
             traceback.print_exc()
-            return self.semantic_chunking(text)
\ No newline at end of file
+            return self.semantic_chunking(text)
+    
+    def _segment_bounds(self, sentences: List[str], embeddings: np.ndarray) -> List[Tuple[int, int]]:
+        """Границы чанков (start, end) по предложениям, найденные одним векторным проходом"""
+        breaks = detect_boundaries(embeddings, self.boundary_strategy, **self.boundary_params)
+        bounds = enforce_chunk_sizes(
+            [len(s) for s in sentences], breaks,
+            min_size=self.min_chunk_size, max_size=self.max_chunk_size
+        )
+        print(f"   Разрывов: {len(breaks)}, чанков после ограничения размера: {len(bounds) - 1}")
+        return [
+            (start, end) for start, end in zip(bounds[:-1], bounds[1:])
+            if ' '.join(sentences[start:end]).strip()
+        ]
+    
+    def _chunks_from_embeddings(self, sentences: List[str], embeddings: np.ndarray) -> List[str]:
+        """Формирование чанков по семантическим границам"""
+        return [
+            ' '.join(sentences[start:end])
+            for start, end in self._segment_bounds(sentences, embeddings)
+        ]
+    
+    def chunk_document(self, texts: List[str], pooling: Optional[str] = None, progress=None):
+        """
+        Чанкование всех глав/разделов документа за один проход кодирования.
+        Сначала все тексты разбиваются на предложения, затем все предложения
+        кодируются одним вызовом крупными пакетами (отсортированными по длине),
+        после чего эмбеддинги раскладываются обратно и границы ищутся по разделам.
+        Возвращает список чанков для каждого текста в исходном порядке.
+        
+        pooling ('mean' | 'attention') - дополнительно вернуть векторы чанков,
+        собранные из эмбеддингов предложений: (чанки, векторы). Для чанков без
+        эмбеддингов предложений (короткий текст, fallback) вектор - None.
+        
+        progress(done, total) вызывается после обработки каждого раздела.
+        """
+        results, section_sentences = split_sentences(texts)
+        
+        if not section_sentences:
+            return self.chunk_with_embeddings(texts, results, section_sentences, None, pooling, progress)
+        
+        all_sentences = [s for sentences in section_sentences.values() for s in sentences]
+        print(f"🔬 Семантическое разделение документа: {len(section_sentences)} разделов, "
+              f"{len(all_sentences)} предложений (пакет {self.batch_size})")
+        
+        try:
+            embeddings = self.encode_sentences(all_sentences)
+        except Exception as e:
+            print(f"⚠️ Ошибка получения эмбеддингов: {e}")
+            for idx in section_sentences:
+                results[idx] = self.semantic_chunking(texts[idx])
+            return self.chunk_with_embeddings(texts, results, {}, None, pooling, progress)
+        
+        return self.chunk_with_embeddings(texts, results, section_sentences, embeddings, pooling, progress)
+    
+    def encode_sentences(self, sentences: List[str]) -> np.ndarray:
+        """Эмбеддинги предложений в исходном порядке"""
+        # Сортировка по длине - меньше паддинга внутри пакетов модели
+        order = np.argsort([len(s) for s in sentences], kind='stable')
+        sorted_embeddings = self.embedder.encode_cached(
+            [sentences[i] for i in order], batch_size=self.batch_size
+        )
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+        return embeddings
+    
+    def chunk_with_embeddings(self, texts: List[str], results: List[List[str]],
+                              section_sentences: Dict[int, List[str]],
+                              embeddings: Optional[np.ndarray],
+                              pooling: Optional[str] = None, progress=None):
+        """
+        Вторая половина chunk_document: границы чанков по готовым эмбеддингам
+        предложений (в порядке section_sentences). Позволяет разбивать на
+        предложения и кодировать в другом месте - например, пакетом на несколько документов.
+        """
+        vectors: List[List[Optional[np.ndarray]]] = [[] for _ in texts]
+        
+        offset = 0
+        for done, (idx, sentences) in enumerate(section_sentences.items(), 1):
+            if progress:
+                progress(done, len(section_sentences))
+            section_embeddings = embeddings[offset:offset + len(sentences)]
+            offset += len(sentences)
+            try:
+                bounds = self._segment_bounds(sentences, section_embeddings)
+                if not bounds:
+                    results[idx] = [texts[idx]]
+                    continue
+                results[idx] = [' '.join(sentences[start:end]) for start, end in bounds]
+                if pooling:
+                    vectors[idx] = [
+                        pool_sentence_embeddings(section_embeddings[start:end], pooling)
+                        for start, end in bounds
+                    ]
+            except Exception as e:
+                print(f"❌ Ошибка чанкования раздела {idx}: {e}")
+                results[idx] = self.semantic_chunking(texts[idx])
+        
+        if section_sentences:
+            print(f"✅ Семантическое разделение дало {sum(len(r) for r in results)} чанков")
+        
+        for idx, chunks in enumerate(results):
+            if len(vectors[idx]) != len(chunks):
+                vectors[idx] = [None] * len(chunks)
+        return (results, vectors) if pooling else results
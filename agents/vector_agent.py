@@ -1,77 +1,646 @@
-from sentence_transformers import SentenceTransformer
 import chromadb
 from chromadb.config import Settings
 from typing import List, Dict, Any, Optional
 import numpy as np
+import os
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from agents.embedding_provider import get_embedder
+from agents.embedding_cache import EmbeddingCache
+from agents.corpus_router import CorpusRouter, DEFAULT_DOCUMENT, collection_name_for
+from agents.lexical_index import LexicalIndex, reciprocal_rank_fusion
+from agents.node_index import NodeIndex
 
 class VectorAgent:
     """Агент для векторизации и поиска в векторной БД"""
     
+    MAX_BATCH = 5000  # Лимит размера пакета для операций Chroma без эмбеддингов
+    RETRIEVAL_MODES = ('dense', 'hybrid', 'lexical')
+    
     def __init__(self, embedding_model="all-MiniLM-L6-v2", 
-                 use_gpu=False, batch_size=16, db_path="./vector_db"):
+                 use_gpu=False, batch_size=16, db_path="./vector_db",
+                 embedder=None, incremental=True, router_top_documents=20,
+                 query_cache_size=1024, retrieval_mode="dense", rrf_k=60,
+                 hybrid_candidates=20, hierarchy_min_chunks=200, hierarchy_top_nodes=5,
+                 hierarchy_title_weight=0.3):
+        if retrieval_mode not in self.RETRIEVAL_MODES:
+            raise ValueError(f"Неизвестный режим поиска: {retrieval_mode}. "
+                             f"Доступны: {', '.join(self.RETRIEVAL_MODES)}")
         self.batch_size = batch_size
+        self.db_path = db_path
+        # Гибридный поиск: ранги BM25 и векторного поиска сливаются через RRF
+        self.retrieval_mode = retrieval_mode
+        self.rrf_k = rrf_k
+        self.hybrid_candidates = hybrid_candidates
+        self.lexical_indexes: Dict[str, LexicalIndex] = {}
+        # Поиск «сверху вниз»: для документов от hierarchy_min_chunks чанков
+        # сначала выбираются ближайшие главы/разделы (0 - всегда плоский поиск)
+        self.hierarchy_min_chunks = hierarchy_min_chunks
+        self.hierarchy_top_nodes = hierarchy_top_nodes
+        self.hierarchy_title_weight = hierarchy_title_weight
+        self.node_indexes: Dict[str, NodeIndex] = {}
+        self.incremental = incremental
         
-        try:
-            self.embedder = SentenceTransformer(embedding_model)
-            print(f"✅ Загружена модель эмбеддингов: {embedding_model}")
-        except Exception as e:
-            print(f"⚠️ Ошибка загрузки модели: {e}")
-            self.embedder = SentenceTransformer('all-MiniLM-L6-v2')
+        # LRU векторов запросов (нормализованный текст -> вектор)
+        self.query_cache_size = query_cache_size
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        
+        # Общий (ленивый) эмбеддер - модель загружается один раз на процесс
+        device = 'cuda' if use_gpu else 'cpu'
+        self.embedder = embedder or get_embedder(embedding_model, device=device)
+        print(f"✅ Эмбеддер подключен: {self.embedder}")
         
         self.client = chromadb.PersistentClient(path=db_path)
-        self.collection = None
+        self.collection = None  # коллекция последнего проиндексированного документа
+        self.collections: Dict[str, Any] = {}
+        self.router = CorpusRouter(db_path, top_documents=router_top_documents)
     
-    def create_index(self, chunks: List[str], metadata: List[Dict]) -> Any:
-        """Создание векторного индекса"""
+    def create_index(self, chunks: List[str], metadata: List[Dict],
+                     incremental: Optional[bool] = None,
+                     document_id: str = DEFAULT_DOCUMENT,
+                     document_info: Optional[Dict] = None,
+                     embeddings: Optional[List[Optional[np.ndarray]]] = None,
+                     progress=None) -> Dict[str, Any]:
+        """
+        Создание векторного индекса документа (у каждого документа своя коллекция).
+        В инкрементальном режиме (по умолчанию) коллекция не пересоздается:
+        добавляются только новые чанки, исчезнувшие удаляются.
+        embeddings - готовые векторы чанков (например, пулинг эмбеддингов
+        предложений из чанкера); чанки с None кодируются моделью.
+        progress(done, total) вызывается после каждого пакета новых чанков.
+        Возвращает изменения индекса (см. finish_index).
+        """
+        session = self.begin_index(document_id, incremental)
         try:
-            self.client.delete_collection("document_chunks")
-        except:
-            pass
+            self.write_batch(session, chunks, metadata, embeddings, progress)
+            return self.finish_index(session, document_info)
+        except Exception:
+            self.abort_index(session)
+            raise
+    
+    def begin_index(self, document_id: str = DEFAULT_DOCUMENT,
+                    incremental: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        Начало записи документа по частям (begin_index -> write_batch... -> finish_index):
+        чанки можно записывать по мере готовности, не собирая документ целиком.
+        При ошибке - abort_index: прежний индекс документа остается рабочим.
+        При полной пересборке документ пишется во временную коллекцию, которая
+        заменяет прежнюю только в finish_index.
+        """
+        incremental = self.incremental if incremental is None else incremental
+        name = collection_name_for(document_id)
+        target = name if incremental else f"{name}_rebuild"
         
-        self.collection = self.client.create_collection(
-            name="document_chunks",
+        created = True
+        if not incremental:
+            # Остаток прерванной пересборки
+            try:
+                self.client.delete_collection(target)
+            except Exception:
+                pass
+        else:
+            try:
+                self.client.get_collection(target)
+                created = False
+            except Exception:
+                pass
+        
+        collection = self.client.get_or_create_collection(
+            name=target,
             metadata={"hnsw:space": "cosine"}
         )
+        if incremental:
+            self.collections[document_id] = collection
+        return {
+            'document_id': document_id,
+            'name': name,
+            'collection': collection,
+            'incremental': incremental,
+            'created': created,
+            'existing': set(collection.get(include=[])['ids']) if incremental else set(),
+            'ids': [],
+            'added_ids': [],
+            'updated': [],
+            'seen': {},
+            'planned_seen': {},
+            'metadata_hash': hashlib.sha1(),
+            'added': 0,
+            'unchanged': 0
+        }
+    
+    def abort_index(self, session: Dict[str, Any]):
+        """
+        Откат незавершенной записи документа: временная коллекция пересборки удаляется,
+        при инкрементальной загрузке удаляются добавленные в этой сессии чанки
+        и возвращаются прежние метаданные неизмененных. Коллекция нового
+        документа удаляется целиком.
+        """
+        try:
+            collection = session['collection']
+            if not session['incremental'] or session['created']:
+                self.client.delete_collection(collection.name)
+                if session['incremental']:
+                    self.collections.pop(session['document_id'], None)
+            else:
+                added = session['added_ids']
+                for i in range(0, len(added), self.MAX_BATCH):
+                    collection.delete(ids=added[i:i+self.MAX_BATCH])
+                for ids, metadatas in session['updated']:
+                    collection.update(ids=ids, metadatas=metadatas)
+            print(f"↩️ Загрузка документа {session['document_id']} отменена, прежний индекс сохранен")
+        except Exception as e:
+            print(f"⚠️ Не удалось откатить загрузку документа {session['document_id']}: {e}")
+    
+    def write_batch(self, session: Dict[str, Any], chunks: List[str], metadata: List[Dict],
+                    embeddings: Optional[List[Optional[np.ndarray]]] = None, progress=None):
+        """Запись очередной части чанков документа: новые добавляются, у неизменных обновляются метаданные"""
+        collection = session['collection']
+        metadata = [dict(meta, document_id=session['document_id']) for meta in metadata]
+        
+        ids = self._make_chunk_ids(chunks, metadata, session['document_id'], session['seen'])
+        session['ids'].extend(ids)
+        # Номера глав и разделов в id чанков не входят - их изменение видно по хэшу метаданных
+        session['metadata_hash'].update(json.dumps(metadata, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+        existing = session['existing']
+        new_positions = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing]
+        kept_positions = [i for i, chunk_id in enumerate(ids) if chunk_id in existing]
         
-        # Пакетная обработка
-        for i in range(0, len(chunks), self.batch_size):
-            batch_chunks = chunks[i:i+self.batch_size]
-            batch_meta = metadata[i:i+self.batch_size]
-            batch_ids = [f"chunk_{j}" for j in range(i, i+len(batch_chunks))]
+        # Пакетная обработка только новых/измененных чанков
+        for i in range(0, len(new_positions), self.batch_size):
+            positions = new_positions[i:i+self.batch_size]
+            batch_chunks = [chunks[p] for p in positions]
             
-            embeddings = self.embedder.encode(batch_chunks)
+            batch_embeddings = self._batch_embeddings(positions, chunks, embeddings)
             
-            self.collection.add(
-                embeddings=embeddings.tolist(),
+            collection.add(
+                embeddings=batch_embeddings.tolist(),
                 documents=batch_chunks,
-                metadatas=batch_meta,
-                ids=batch_ids
+                metadatas=[metadata[p] for p in positions],
+                ids=[ids[p] for p in positions]
             )
+            session['added_ids'].extend(ids[p] for p in positions)
+            if progress:
+                progress(i + len(positions), len(new_positions))
+        
+        # У неизменных чанков обновляем только изменившиеся метаданные (без пересчета
+        # векторов); прежние значения запоминаются для отката в abort_index.
+        # Chroma сливает метаданные при update, лишние ключи удаляются значением None
+        for i in range(0, len(kept_positions), self.MAX_BATCH):
+            positions = kept_positions[i:i+self.MAX_BATCH]
+            stored = collection.get(ids=[ids[p] for p in positions], include=['metadatas'])
+            previous = dict(zip(stored['ids'], stored['metadatas']))
+            changed_ids, changed_meta, restore_meta = [], [], []
+            for p in positions:
+                old = previous.get(ids[p]) or {}
+                new = metadata[p]
+                if old == new:
+                    continue
+                changed_ids.append(ids[p])
+                changed_meta.append(dict(new, **{key: None for key in old if key not in new}))
+                restore_meta.append(dict(old, **{key: None for key in new if key not in old}))
+            if changed_ids:
+                collection.update(ids=changed_ids, metadatas=changed_meta)
+                session['updated'].append((changed_ids, restore_meta))
+        
+        session['added'] += len(new_positions)
+        session['unchanged'] += len(kept_positions)
+    
+    def new_chunk_positions(self, session: Dict[str, Any], chunks: List[str], metadata: List[Dict]) -> List[int]:
+        """
+        Позиции чанков, которых еще нет в коллекции (их нужно кодировать).
+        Части передаются в том же порядке, что и в write_batch: счетчик повторов
+        у них свой, поэтому id совпадают с теми, что будут записаны.
+        """
+        ids = self._make_chunk_ids(chunks, metadata, session['document_id'], session['planned_seen'])
+        return [i for i, chunk_id in enumerate(ids) if chunk_id not in session['existing']]
+    
+    def finish_index(self, session: Dict[str, Any], document_info: Optional[Dict] = None) -> Dict[str, Any]:
+        """
+        Завершение записи документа: удаление исчезнувших чанков, маршрутизатор, BM25, узлы.
+        Если документ не изменился (ни новых, ни удаленных чанков, те же заголовки),
+        центроид, BM25 и узлы не пересчитываются.
+        Возвращает изменения индекса (mode, added, deleted, unchanged, total), они же -
+        в session['delta']: агент общий для параллельных загрузок, поэтому
+        результат хранится не в нем.
+        """
+        document_id = session['document_id']
+        collection = session['collection']
+        ids = session['ids']
+        current = set(ids)
+        
+        # Удаляем исчезнувшие чанки
+        vanished = [chunk_id for chunk_id in session['existing'] if chunk_id not in current]
+        for i in range(0, len(vanished), self.MAX_BATCH):
+            collection.delete(ids=vanished[i:i+self.MAX_BATCH])
+        
+        if not session['incremental']:
+            # Пересборка готова - заменяем ею прежнюю коллекцию
+            try:
+                self.client.delete_collection(session['name'])
+            except Exception:
+                pass
+            collection.modify(name=session['name'])
+        self.collection = collection
+        self.collections[document_id] = collection
+        
+        delta = session['delta'] = {
+            'mode': 'incremental' if session['incremental'] else 'rebuild',
+            'added': session['added'],
+            'deleted': len(vanished),
+            'unchanged': session['unchanged'],
+            'total': len(ids)
+        }
         
-        print(f"✅ Индекс создан. Чанков: {len(chunks)}")
-        return self.collection
+        # Версия содержимого: id чанков адресуются по тексту, поэтому повторная
+        # загрузка того же файла версию не меняет
+        version = hashlib.sha1('\n'.join(sorted(ids)).encode('utf-8')).hexdigest()[:16]
+        metadata_version = session['metadata_hash'].hexdigest()[:16]
+        info = dict(document_info or {}, collection=session['name'], chunks_count=len(ids),
+                    version=version, metadata_version=metadata_version)
+        
+        previous = self.router.documents.get(document_id) or {}
+        if (session['incremental'] and not session['added'] and not vanished
+                and previous.get('version') == version
+                and previous.get('metadata_version') == metadata_version
+                and os.path.exists(self._node_path(document_id))
+                and os.path.exists(self._lexical_path(document_id))):
+            self.router.update_info(document_id, info)
+            print(f"✅ Индекс не изменился. Чанков: {len(ids)}")
+            return delta
+        
+        # Центроид документа - для маршрутизации запросов по корпусу
+        stored = collection.get(include=['embeddings', 'metadatas', 'documents'])
+        self.router.register(document_id, info, CorpusRouter.centroid(stored['embeddings']))
+        
+        # Векторы глав и разделов - для поиска «сверху вниз»
+        self.node_indexes[document_id] = NodeIndex(self.hierarchy_title_weight).build(
+            stored['metadatas'], stored['embeddings'], self.embedder
+        )
+        self.node_indexes[document_id].save(self._node_path(document_id))
+        
+        # BM25 строится по итоговому набору чанков документа
+        self.lexical_indexes[document_id] = LexicalIndex().build(stored['ids'], stored['documents'])
+        self.lexical_indexes[document_id].save(self._lexical_path(document_id))
+        print(f"✅ Индекс обновлен. Чанков: {len(ids)} "
+              f"(+{session['added']} / -{len(vanished)} / ={session['unchanged']})")
+        return delta
+    
+    def _batch_embeddings(self, positions: List[int], chunks: List[str],
+                          embeddings: Optional[List[Optional[np.ndarray]]]) -> np.ndarray:
+        """Векторы пакета: готовые, где они есть, остальные - через модель"""
+        if embeddings is None:
+            return self.embedder.encode_cached([chunks[p] for p in positions],
+                                               batch_size=self.batch_size)
+        
+        missing = [p for p in positions if embeddings[p] is None]
+        encoded = {}
+        if missing:
+            vectors = self.embedder.encode_cached([chunks[p] for p in missing],
+                                                  batch_size=self.batch_size)
+            encoded = dict(zip(missing, vectors))
+        return np.stack([
+            np.asarray(embeddings[p] if embeddings[p] is not None else encoded[p], dtype=np.float32)
+            for p in positions
+        ])
+    
+    def _make_chunk_ids(self, chunks: List[str], metadata: List[Dict], document_id: str,
+                        seen: Optional[Dict[str, int]] = None) -> List[str]:
+        """
+        Стабильные id чанков по содержимому: хэш документа, пути заголовков и текста.
+        Берутся названия глав/разделов, а не их номера: вставка нового заголовка
+        не меняет id чанков остальных разделов.
+        id уникальны во всем корпусе - одинаковый текст в разных документах
+        не смешивается при слиянии результатов поиска и в кэше переранжирования.
+        Повторы (тот же текст под тем же путем заголовков) получают порядковый
+        суффикс по месту в документе (seen - счетчики, общие для всех частей).
+        """
+        ids = []
+        seen = {} if seen is None else seen
+        for chunk, meta in zip(chunks, metadata):
+            payload = (f"{document_id}\x00{meta.get('type', '')}\x00{meta.get('chapter_title', '')}"
+                       f"\x00{meta.get('section_title', '')}\x00{meta.get('subsection_title', '')}"
+                       f"\x00{chunk}")
+            digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()[:24]
+            count = seen.get(digest, 0)
+            seen[digest] = count + 1
+            ids.append(f"chunk_{digest}" if count == 0 else f"chunk_{digest}_{count}")
+        return ids
+    
+    def _get_collection(self, document_id: str):
+        """Коллекция документа (открывается при первом обращении)"""
+        collection = self.collections.get(document_id)
+        if collection is None:
+            collection = self.client.get_collection(collection_name_for(document_id))
+            self.collections[document_id] = collection
+        return collection
+    
+    def _lexical_path(self, document_id: str) -> str:
+        return os.path.join(self.db_path, "lexical", f"{collection_name_for(document_id)}.npz")
+    
+    def _get_lexical(self, document_id: str) -> LexicalIndex:
+        """BM25-индекс документа; для документов, проиндексированных раньше, строится по коллекции"""
+        index = self.lexical_indexes.get(document_id)
+        if index is None:
+            index = LexicalIndex.load(self._lexical_path(document_id))
+            if index is None:
+                stored = self._get_collection(document_id).get(include=['documents'])
+                index = LexicalIndex().build(stored['ids'], stored['documents'])
+                index.save(self._lexical_path(document_id))
+            self.lexical_indexes[document_id] = index
+        return index
+    
+    def _node_path(self, document_id: str) -> str:
+        return os.path.join(self.db_path, "nodes", f"{collection_name_for(document_id)}.npz")
+    
+    def _get_nodes(self, document_id: str) -> NodeIndex:
+        """Узлы дерева документа; для документов, проиндексированных раньше, строятся по коллекции"""
+        index = self.node_indexes.get(document_id)
+        if index is None:
+            index = NodeIndex.load(self._node_path(document_id))
+            if index is None:
+                stored = self._get_collection(document_id).get(include=['embeddings', 'metadatas'])
+                index = NodeIndex(self.hierarchy_title_weight).build(
+                    stored['metadatas'], stored['embeddings'], self.embedder
+                )
+                index.save(self._node_path(document_id))
+            self.node_indexes[document_id] = index
+        return index
+    
+    def _node_filter(self, document_id: str, chunks_count: int, query_embedding) -> Optional[Dict]:
+        """Фильтр по ближайшим главам/разделам или None для плоского поиска"""
+        if not self.hierarchy_min_chunks or chunks_count < self.hierarchy_min_chunks:
+            return None
+        return self._get_nodes(document_id).select(query_embedding, self.hierarchy_top_nodes)
+    
+    def list_documents(self) -> Dict[str, Dict]:
+        """Документы корпуса"""
+        return dict(self.router.documents)
+    
+    def has_documents(self) -> bool:
+        return bool(self.router.documents)
+    
+    def index_version(self, document_ids: Optional[List[str]] = None) -> str:
+        """
+        Версия индекса в области поиска (весь корпус или document_ids):
+        меняется при добавлении, обновлении и удалении документов
+        """
+        documents = self.router.documents
+        scope = sorted(documents) if document_ids is None else sorted(set(document_ids))
+        payload = '\n'.join(
+            f"{doc_id}:{documents[doc_id].get('version', documents[doc_id].get('chunks_count'))}"
+            if doc_id in documents else f"{doc_id}:-"
+            for doc_id in scope
+        )
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+    
+    def delete_document(self, document_id: str) -> bool:
+        """Удаление документа из корпуса"""
+        if document_id not in self.router.documents:
+            return False
+        try:
+            self.client.delete_collection(collection_name_for(document_id))
+        except Exception as e:
+            print(f"⚠️ Коллекция документа {document_id} не удалена: {e}")
+        self.collections.pop(document_id, None)
+        self.lexical_indexes.pop(document_id, None)
+        self.node_indexes.pop(document_id, None)
+        for path in (self._lexical_path(document_id), self._node_path(document_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        self.router.remove(document_id)
+        return True
+    
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Векторы запросов с LRU-кэшем в памяти: повторные запросы не кодируются,
+        новые кодируются одним пакетом
+        """
+        keys = [EmbeddingCache.normalize_text(q) for q in queries]
+        vectors: List[Optional[np.ndarray]] = [None] * len(queries)
+        missing: Dict[str, List[int]] = {}
+        
+        with self._query_cache_lock:
+            for i, key in enumerate(keys):
+                cached = self._query_cache.get(key)
+                if cached is not None:
+                    self._query_cache.move_to_end(key)
+                    vectors[i] = cached
+                else:
+                    missing.setdefault(key, []).append(i)
+            self.query_cache_hits += len(queries) - sum(len(p) for p in missing.values())
+            self.query_cache_misses += sum(len(p) for p in missing.values())
+        
+        if missing:
+            texts = [queries[positions[0]] for positions in missing.values()]
+            encoded = np.asarray(self.embedder.encode(texts, batch_size=self.batch_size),
+                                 dtype=np.float32)
+            with self._query_cache_lock:
+                for (key, positions), vector in zip(missing.items(), encoded):
+                    for i in positions:
+                        vectors[i] = vector
+                    if self.query_cache_size:
+                        self._query_cache[key] = vector
+                        self._query_cache.move_to_end(key)
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+        
+        return np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+    
+    def query_cache_stats(self) -> Dict[str, Any]:
+        total = self.query_cache_hits + self.query_cache_misses
+        return {
+            'entries': len(self._query_cache),
+            'capacity': self.query_cache_size,
+            'hits': self.query_cache_hits,
+            'misses': self.query_cache_misses,
+            'hit_rate': round(self.query_cache_hits / total, 3) if total else 0.0
+        }
     
     def hierarchical_search(self, query: str, top_k: int = 5, 
-                           filters: Optional[Dict] = None) -> List[Dict]:
-        """Поиск по векторной БД"""
-        if not self.collection:
+                           filters: Optional[Dict] = None,
+                           document_ids: Optional[List[str]] = None,
+                           query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
+        """
+        Поиск по векторной БД.
+        document_ids ограничивает поиск документами корпуса; без него
+        маршрутизатор выбирает документы с ближайшими центроидами.
+        query_embedding - уже посчитанный вектор запроса (иначе кодируется здесь).
+        """
+        embeddings = None if query_embedding is None else [query_embedding]
+        return self.batch_search([query], top_k=top_k, filters=filters,
+                                 document_ids=document_ids, query_embeddings=embeddings)[0]
+    
+    def batch_search(self, queries: List[str], top_k: int = 5,
+                     filters: Optional[Dict] = None,
+                     document_ids: Optional[List[str]] = None,
+                     query_embeddings: Optional[List[np.ndarray]] = None,
+                     mode: Optional[str] = None) -> List[List[Dict]]:
+        """
+        Пакетный поиск: все запросы кодируются одним проходом модели, а каждая
+        коллекция опрашивается одним вызовом query со всеми запросами,
+        для которых маршрутизатор ее выбрал. Возвращает списки чанков по запросам.
+        mode - dense | hybrid | lexical (по умолчанию retrieval_mode агента).
+        """
+        if not self.has_documents():
             raise ValueError("Индекс не создан. Сначала вызовите create_index()")
+        if not queries:
+            return []
+        mode = mode or self.retrieval_mode
+        
+        if query_embeddings is None:
+            query_embeddings = self.embed_queries(queries)
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32).reshape(len(queries), -1)
+        
+        # Группировка запросов по коллекциям
+        routed: Dict[str, List[int]] = {}
+        for qi, embedding in enumerate(query_embeddings):
+            for document_id in self.router.route(embedding, document_ids):
+                routed.setdefault(document_id, []).append(qi)
+        
+        n_candidates = top_k if mode == 'dense' else max(top_k, self.hybrid_candidates)
+        dense = (self._dense_search(query_embeddings, routed, n_candidates, filters)
+                 if mode != 'lexical' else [[] for _ in queries])
         
-        query_embedding = self.embedder.encode(query)
+        if mode == 'dense':
+            for chunks in dense:
+                chunks.sort(key=lambda c: c['distance'] if c['distance'] is not None else float('inf'))
+                del chunks[top_k:]
+            return dense
         
-        results = self.collection.query(
-            query_embeddings=[query_embedding.tolist()],
-            n_results=top_k,
-            where=filters
+        lexical = self._lexical_search(queries, routed, n_candidates, filters)
+        return [
+            self._fuse(dense_chunks, lexical_hits, top_k, filters)
+            for dense_chunks, lexical_hits in zip(dense, lexical)
+        ]
+    
+    def _dense_search(self, query_embeddings: np.ndarray, routed: Dict[str, List[int]],
+                      n_candidates: int, filters: Optional[Dict]) -> List[List[Dict]]:
+        """
+        Векторный поиск: один запрос к коллекции на все направленные в нее вопросы
+        с одинаковым набором выбранных глав/разделов. Если в выбранных узлах
+        нашлось меньше n_candidates чанков, вопрос дополняется плоским поиском.
+        """
+        results_per_query: List[List[Dict]] = [[] for _ in range(len(query_embeddings))]
+        for document_id, query_positions in routed.items():
+            collection = self._get_collection(document_id)
+            count = collection.count()
+            n_results = min(n_candidates, count)
+            if n_results == 0:
+                continue
+            
+            groups: Dict[str, tuple] = {}
+            for qi in query_positions:
+                node_filter = self._node_filter(document_id, count, query_embeddings[qi])
+                key = repr(node_filter)
+                groups.setdefault(key, (node_filter, []))[1].append(qi)
+            
+            underfilled = []
+            for node_filter, positions in groups.values():
+                where = filters
+                if node_filter is not None:
+                    where = {'$and': [filters, node_filter]} if filters else node_filter
+                found = self._query_collection(collection, query_embeddings, positions, n_results, where)
+                for qi, chunks in zip(positions, found):
+                    results_per_query[qi].extend(chunks)
+                    if node_filter is not None and len(chunks) < n_results:
+                        underfilled.append(qi)
+            
+            if underfilled:
+                found = self._query_collection(collection, query_embeddings, underfilled, n_results, filters)
+                for qi, chunks in zip(underfilled, found):
+                    seen = {c['id'] for c in results_per_query[qi]}
+                    results_per_query[qi].extend(c for c in chunks if c['id'] not in seen)
+        return results_per_query
+    
+    def _query_collection(self, collection, query_embeddings: np.ndarray, positions: List[int],
+                          n_results: int, where: Optional[Dict]) -> List[List[Dict]]:
+        results = collection.query(
+            query_embeddings=query_embeddings[positions].tolist(),
+            n_results=n_results,
+            where=where
         )
+        found = []
+        for row in range(len(positions)):
+            found.append([
+                {
+                    'text': results['documents'][row][i],
+                    'metadata': results['metadatas'][row][i],
+                    'id': results['ids'][row][i],
+                    'distance': results['distances'][row][i] if 'distances' in results else None
+                }
+                for i in range(len(results['documents'][row]))
+            ])
+        return found
+    
+    def _lexical_search(self, queries: List[str], routed: Dict[str, List[int]],
+                        n_candidates: int, filters: Optional[Dict] = None) -> List[List[tuple]]:
+        """
+        BM25 по тем же документам: [(document_id, chunk_id, score)] по запросам.
+        С фильтром кандидаты ищутся только среди подходящих чанков (маска по id
+        из Chroma), иначе лучшие BM25-кандидаты могли бы все оказаться вне области.
+        """
+        hits: List[List[tuple]] = [[] for _ in queries]
+        for document_id, query_positions in routed.items():
+            index = self._get_lexical(document_id)
+            mask = None
+            if filters:
+                allowed = self._get_collection(document_id).get(where=filters, include=[])['ids']
+                if not allowed:
+                    continue
+                mask = index.mask(allowed)
+            for qi in query_positions:
+                hits[qi].extend((document_id, chunk_id, score)
+                                for chunk_id, score in index.search(queries[qi], n_candidates, mask))
+        for query_hits in hits:
+            query_hits.sort(key=lambda h: h[2], reverse=True)
+            del query_hits[n_candidates:]
+        return hits
+    
+    def _fuse(self, dense_chunks: List[Dict], lexical_hits: List[tuple],
+              top_k: int, filters: Optional[Dict]) -> List[Dict]:
+        """Слияние рангов (RRF); чанки, найденные только BM25, догружаются из Chroma"""
+        dense_chunks = sorted(dense_chunks, key=lambda c: c['distance'] if c['distance'] is not None else float('inf'))
+        by_id = {c['id']: c for c in dense_chunks}
+        bm25 = {chunk_id: score for _, chunk_id, score in lexical_hits}
+        fused = reciprocal_rank_fusion(
+            [[c['id'] for c in dense_chunks], [chunk_id for _, chunk_id, _ in lexical_hits]],
+            k=self.rrf_k
+        )
+        
+        # Догружаем недостающие чанки (по коллекциям), с теми же фильтрами;
+        # без фильтров в выдачу попадут только первые top_k
+        missing: Dict[str, List[str]] = {}
+        selected = [chunk_id for chunk_id, _ in (fused if filters else fused[:top_k])]
+        documents_of = {chunk_id: document_id for document_id, chunk_id, _ in lexical_hits}
+        for chunk_id in selected:
+            if chunk_id not in by_id:
+                missing.setdefault(documents_of[chunk_id], []).append(chunk_id)
+        for document_id, chunk_ids in missing.items():
+            stored = self._get_collection(document_id).get(
+                ids=chunk_ids, where=filters, include=['documents', 'metadatas']
+            )
+            for i, chunk_id in enumerate(stored['ids']):
+                by_id[chunk_id] = {
+                    'text': stored['documents'][i],
+                    'metadata': stored['metadatas'][i],
+                    'id': chunk_id,
+                    'distance': None
+                }
         
         chunks = []
-        for i in range(len(results['documents'][0])):
-            chunks.append({
-                'text': results['documents'][0][i],
-                'metadata': results['metadatas'][0][i],
-                'id': results['ids'][0][i],
-                'distance': results['distances'][0][i] if 'distances' in results else None
-            })
-        
-        return chunks
\ No newline at end of file
+        for chunk_id, score in fused:
+            if chunk_id not in by_id:
+                continue  # отсеян фильтром
+            chunk = dict(by_id[chunk_id], rrf_score=round(score, 6))
+            if chunk_id in bm25:
+                chunk['bm25'] = round(bm25[chunk_id], 4)
+            chunks.append(chunk)
+            if len(chunks) == top_k:
+                break
+        return chunks
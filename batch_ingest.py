@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Пакетная загрузка документов в корпус DocMind
+Запуск: python batch_ingest.py <файлы или папки .docx> [--workers N] [--config config.yaml]
+"""
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from agents.batch_documents import find_documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная загрузка .docx в корпус DocMind")
+    parser.add_argument("paths", nargs="+", help="файлы .docx или папки с ними")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="процессов для парсинга (по умолчанию batch_ingest_workers из конфига)")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--report", help="сохранить отчет в JSON")
+    args = parser.parse_args()
+
+    found = find_documents(args.paths)
+    if not found:
+        print("❌ Документы .docx не найдены")
+        return 1
+
+    from orchestrator import RAGOrchestrator
+    orchestrator = RAGOrchestrator(args.config)
+    report = orchestrator.process_documents([path for path, _ in found], workers=args.workers,
+                                            document_ids=[document_id for _, document_id in found])
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📝 Отчет сохранен: {args.report}")
+    return 0 if not report['failed'] else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Замеры производительности компонентов DocMind
+Запуск: python benchmark.py <сценарий> [параметры]
+"""
+
+import sys
+import os
+import time
+import argparse
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bench_router(args):
+    """
+    Реестр корпуса: регистрация документов через register (как при пакетной
+    загрузке - с одним сохранением в конце), запись реестра и время маршрутизации
+    """
+    import tempfile
+    from agents.corpus_router import CorpusRouter
+
+    rng = np.random.default_rng(42)
+    print(f"📊 Маршрутизатор корпуса (dim={args.dim}, top_documents={args.top})")
+    print(f"{'документов':>12} | {'register, мс':>12} | {'запись, мс':>10} | "
+          f"{'route, мс':>10} | {'опрашивается':>12}")
+
+    for n_docs in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            router = CorpusRouter(tmp, top_documents=args.top)
+            centroids = rng.normal(size=(n_docs, args.dim)).astype(np.float32)
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+            start = time.perf_counter()
+            with router.deferred_save():
+                for i, centroid in enumerate(centroids):
+                    router.register(f"doc_{i}", {'filename': f"doc_{i}.docx"}, centroid)
+                register_ms = (time.perf_counter() - start) * 1000 / n_docs
+                start = time.perf_counter()
+            save_ms = (time.perf_counter() - start) * 1000
+
+            queries = rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+            start = time.perf_counter()
+            for query in queries:
+                selected = router.route(query)
+            elapsed_ms = (time.perf_counter() - start) * 1000 / args.queries
+
+            print(f"{n_docs:>12} | {register_ms:>12.4f} | {save_ms:>10.1f} | "
+                  f"{elapsed_ms:>10.3f} | {len(selected):>12}")
+
+
+def bench_lexical(args):
+    """BM25: время построения и поиска на синтетическом корпусе (распределение Ципфа)"""
+    from agents.lexical_index import LexicalIndex
+
+    rng = np.random.default_rng(42)
+    words = np.array([f"слово{i}" for i in range(args.vocab)])
+    codes = np.array([f"{i // 100}.{i % 100}" for i in range(args.vocab)])
+    print(f"📊 BM25 (словарь {args.vocab}, {args.words} слов в чанке, max_postings={args.max_postings})")
+    print(f"{'чанков':>10} | {'построение, с':>13} | {'поиск, мс':>9} | {'p99, мс':>8}")
+
+    def generate_texts(n_chunks, block=10000):
+        # Корпус генерируется блоками прямо во время построения: миллион
+        # готовых текстов занял бы в памяти больше, чем сам индекс
+        for offset in range(0, n_chunks, block):
+            size = min(block, n_chunks - offset)
+            ranks = np.minimum(rng.zipf(1.2, size=(size, args.words)) - 1, args.vocab - 1)
+            for i, row in enumerate(words[ranks], offset):
+                text = ' '.join(row)
+                # Номера пунктов - редкие точные термы
+                if i % 10 == 0:
+                    text += f" пункт {codes[i % args.vocab]}"
+                yield text
+
+    for n_chunks in args.sizes:
+        ids = [f"chunk_{i}" for i in range(n_chunks)]
+
+        start = time.perf_counter()
+        index = LexicalIndex(max_postings=args.max_postings).build(ids, generate_texts(n_chunks))
+        build_time = time.perf_counter() - start
+
+        queries = [' '.join(words[np.minimum(rng.zipf(1.2, size=3) - 1, args.vocab - 1)])
+                   + f" {codes[rng.integers(args.vocab)]}" for _ in range(args.queries)]
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query, top_k=20)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        print(f"{n_chunks:>10} | {build_time:>13.1f} | {np.mean(latencies):>9.3f} | "
+              f"{np.percentile(latencies, 99):>8.3f}")
+
+
+def _legacy_parse_events(docx_path):
+    """Прежний парсер: только doc.paragraphs, стиль и три регулярных выражения на абзац"""
+    import re
+    from docx import Document
+
+    for para in Document(docx_path).paragraphs:
+        text = para.text.strip()
+        if not text:
+            continue
+        level = 0
+        style_name = para.style.name.lower() if para.style and para.style.name else ''
+        if 'heading' in style_name:
+            level = 1
+        elif re.match(r'^\d+\.', text) or re.match(r'^\d+\.\d+\.', text) or re.match(r'^\d+\.\d+\.\d+\.', text):
+            level = 1
+        yield level, text
+
+
+def _make_table_document(path, tables, rows=10):
+    """Синтетический документ с таблицами: заголовки, абзацы и таблицы параметров"""
+    from docx import Document
+
+    doc = Document()
+    for t in range(tables):
+        doc.add_heading(f"{t + 1}. Раздел {t + 1}", level=1)
+        doc.add_paragraph(f"Характеристики изделия серии {t + 1} приведены в таблице.")
+        table = doc.add_table(rows=rows + 1, cols=4)
+        for j, name in enumerate(["Параметр", "Значение", "Допуск", "Ед."]):
+            table.cell(0, j).text = name
+        for i in range(1, rows + 1):
+            for j, value in enumerate([f"Параметр {i}", str(i * 10 + t), f"±{i % 5}", "мм"]):
+                table.cell(i, j).text = value
+    doc.save(path)
+
+
+def bench_parsing(args):
+    """
+    Парсинг .docx: прежний парсер (только абзацы) против однопроходного обхода
+    тела документа (абзацы и таблицы) через python-docx и потокового чтения XML
+    """
+    import tracemalloc
+    import tempfile
+    from agents.doc_parser import DocParserAgent
+
+    docx_path = args.docx
+    if docx_path is None:
+        docx_path = os.path.join(tempfile.mkdtemp(), "tables.docx")
+        _make_table_document(docx_path, args.tables)
+
+    print(f"📊 Парсинг {docx_path} ({os.path.getsize(docx_path) / 2 ** 20:.1f} МБ)")
+    print(f"{'режим':>10} | {'блоков':>8} | {'символов':>9} | {'время, с':>8} | {'пик памяти, МБ':>14}")
+
+    runs = [('legacy', lambda: _legacy_parse_events(docx_path))]
+    for mode in ('document', 'streaming'):
+        runs.append((mode, lambda mode=mode: DocParserAgent(mode=mode).iter_events(docx_path)))
+
+    for name, make_events in runs:
+        tracemalloc.start()
+        start = time.perf_counter()
+        events = chars = 0
+        for _, text in make_events():
+            events += 1
+            chars += len(text)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+        print(f"{name:>10} | {events:>8} | {chars:>9} | {elapsed:>8.2f} | {peak:>14.1f}")
+
+
+def _document_texts(structure):
+    """Тексты глав, разделов и подразделов документа в порядке следования"""
+    from agents.doc_parser import collect_sections
+    return collect_sections(structure)[0]
+
+
+def _retrieval_metrics(ranks):
+    ranks = np.asarray(ranks)
+    return {
+        'recall@1': float(np.mean(ranks < 1)),
+        'recall@5': float(np.mean(ranks < 5)),
+        'mrr': float(np.mean(1.0 / (ranks + 1)))
+    }
+
+
+def bench_pooling(args):
+    """
+    Векторы чанков: пулинг эмбеддингов предложений против повторного кодирования.
+    Качество - leave-one-out: случайное предложение чанка служит запросом,
+    вектор этого чанка строится без него; ищем чанк среди всех чанков документа.
+    """
+    from agents.doc_parser import DocParserAgent
+    from agents.embedding_provider import get_embedder
+    from agents.smart_chunker import SmartChunkerAgent, pool_sentence_embeddings, split_text_sentences
+
+    embedder = get_embedder(args.model)
+    chunker = SmartChunkerAgent(embedder=embedder, min_chunk_size=100, max_chunk_size=1500,
+                                batch_size=args.batch_size)
+    structure = DocParserAgent().parse_with_hierarchy(args.docx)
+    chunks = [c for section in chunker.chunk_document(_document_texts(structure)) for c in section]
+    chunk_sentences = [split_text_sentences(c) for c in chunks]
+
+    def normalize(m):
+        m = np.asarray(m, dtype=np.float32)
+        return m / np.maximum(np.linalg.norm(m, axis=-1, keepdims=True), 1e-12)
+
+    # Стоимость: эмбеддинги предложений уже есть после чанкования
+    sentence_vectors = [normalize(embedder.encode(s, batch_size=args.batch_size)) for s in chunk_sentences]
+
+    start = time.perf_counter()
+    encoded = normalize(embedder.encode(chunks, batch_size=args.batch_size))
+    encode_time = time.perf_counter() - start
+
+    results = {}
+    for mode in ('mean', 'attention'):
+        start = time.perf_counter()
+        pooled = np.stack([pool_sentence_embeddings(v, mode) for v in sentence_vectors])
+        results[mode] = {'time': time.perf_counter() - start, 'vectors': pooled, 'ranks': []}
+    encode_ranks = []
+
+    rng = np.random.default_rng(42)
+    candidates = [i for i, s in enumerate(chunk_sentences) if len(s) >= 3]
+    samples = rng.choice(candidates, size=min(args.samples, len(candidates)), replace=False)
+
+    def rank_of(corpus, query, target, target_vector):
+        scores = corpus @ query
+        scores[target] = target_vector @ query
+        return int(np.sum(scores > scores[target]))
+
+    for i in samples:
+        j = rng.integers(len(chunk_sentences[i]))
+        query = sentence_vectors[i][j]
+        rest = [s for k, s in enumerate(chunk_sentences[i]) if k != j]
+        held_out = normalize(embedder.encode(' '.join(rest)))
+        encode_ranks.append(rank_of(encoded, query, i, held_out))
+        rest_vectors = np.delete(sentence_vectors[i], j, axis=0)
+        for mode, r in results.items():
+            r['ranks'].append(rank_of(r['vectors'], query, i, pool_sentence_embeddings(rest_vectors, mode)))
+
+    print(f"📊 Векторы чанков: {len(chunks)} чанков, {len(samples)} запросов (leave-one-out)")
+    print(f"{'режим':>10} | {'время, с':>9} | {'R@1':>6} | {'R@5':>6} | {'MRR':>6}")
+    rows = [('encode', encode_time, _retrieval_metrics(encode_ranks))]
+    rows += [(mode, r['time'], _retrieval_metrics(r['ranks'])) for mode, r in results.items()]
+    for mode, elapsed, m in rows:
+        print(f"{mode:>10} | {elapsed:>9.3f} | {m['recall@1']:>6.3f} | {m['recall@5']:>6.3f} | {m['mrr']:>6.3f}")
+
+
+def bench_queries(args):
+    """Поиск: последовательные запросы против пакетного batch_search"""
+    import tempfile
+    from agents.doc_parser import DocParserAgent
+    from agents.embedding_provider import get_embedder
+    from agents.smart_chunker import SmartChunkerAgent, split_text_sentences
+    from agents.vector_agent import VectorAgent
+
+    embedder = get_embedder(args.model)
+    chunker = SmartChunkerAgent(embedder=embedder, min_chunk_size=100, max_chunk_size=1500,
+                                batch_size=args.batch_size)
+    structure = DocParserAgent().parse_with_hierarchy(args.docx)
+    chunks = [c for section in chunker.chunk_document(_document_texts(structure)) for c in section]
+
+    rng = np.random.default_rng(42)
+    sentences = [s for c in chunks for s in split_text_sentences(c)]
+    queries = [sentences[i] for i in rng.choice(len(sentences), size=min(args.queries, len(sentences)),
+                                                replace=False)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        agent = VectorAgent(embedder=embedder, db_path=tmp, batch_size=args.batch_size,
+                            query_cache_size=0)
+        agent.create_index(chunks, [{'chunk_index': i} for i in range(len(chunks))])
+
+        start = time.perf_counter()
+        sequential = [agent.hierarchical_search(q, top_k=5) for q in queries]
+        sequential_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = agent.batch_search(queries, top_k=5)
+        batch_time = time.perf_counter() - start
+
+    same = sum(1 for a, b in zip(sequential, batched) if [c['id'] for c in a] == [c['id'] for c in b])
+    print(f"📊 Поиск: {len(chunks)} чанков, {len(queries)} запросов")
+    print(f"{'режим':>15} | {'всего, с':>9} | {'запросов/с':>10}")
+    print(f"{'последовательно':>15} | {sequential_time:>9.3f} | {len(queries) / sequential_time:>10.1f}")
+    print(f"{'batch_search':>15} | {batch_time:>9.3f} | {len(queries) / batch_time:>10.1f}")
+    print(f"Совпадение выдачи: {same}/{len(queries)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности DocMind")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    router = sub.add_parser("router", help="маршрутизация запросов по корпусу")
+    router.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    router.add_argument("--dim", type=int, default=384)
+    router.add_argument("--top", type=int, default=20)
+    router.add_argument("--queries", type=int, default=200)
+    router.set_defaults(func=bench_router)
+
+    pooling = sub.add_parser("pooling", help="пулинг векторов чанков против повторного кодирования")
+    pooling.add_argument("docx", help="путь к .docx документу")
+    pooling.add_argument("--model", default="all-MiniLM-L6-v2")
+    pooling.add_argument("--samples", type=int, default=200)
+    pooling.add_argument("--batch-size", type=int, default=64)
+    pooling.set_defaults(func=bench_pooling)
+
+    lexical = sub.add_parser("lexical", help="построение и поиск BM25 на синтетическом корпусе")
+    lexical.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    lexical.add_argument("--vocab", type=int, default=50000)
+    lexical.add_argument("--words", type=int, default=80)
+    lexical.add_argument("--max-postings", type=int, default=2048)
+    lexical.add_argument("--queries", type=int, default=500)
+    lexical.set_defaults(func=bench_lexical)
+
+    queries = sub.add_parser("queries", help="последовательный поиск против пакетного")
+    queries.add_argument("docx", help="путь к .docx документу")
+    queries.add_argument("--model", default="all-MiniLM-L6-v2")
+    queries.add_argument("--queries", type=int, default=200)
+    queries.add_argument("--batch-size", type=int, default=64)
+    queries.set_defaults(func=bench_queries)
+
+    parsing = sub.add_parser("parsing", help="парсинг .docx: прежний парсер, обход тела документа, потоковое чтение")
+    parsing.add_argument("docx", nargs="?", help="путь к .docx документу (без него - синтетический с таблицами)")
+    parsing.add_argument("--tables", type=int, default=200, help="таблиц в синтетическом документе")
+    parsing.set_defaults(func=bench_parsing)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# job_queue.py
+import time
+import uuid
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+
+class QueueFullError(Exception):
+    """Очередь задач заполнена - клиенту нужно повторить запрос позже"""
+
+
+class IngestionJobQueue:
+    """
+    Очередь фоновых задач обработки документов.
+    Задачи выполняются пулом воркеров; очередь ограничена по размеру,
+    поэтому всплеск загрузок не приводит к неограниченному росту памяти.
+    """
+
+    def __init__(self, handler: Callable[[Dict[str, Any], Callable], Any],
+                 workers: int = 1, max_queued: int = 8, max_finished: int = 100):
+        self.handler = handler
+        self.max_finished = max_finished
+        self._queue: "queue.Queue[str]" = queue.Queue(maxsize=max_queued)
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = []
+
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"ingest-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        print(f"✅ Очередь обработки документов: воркеров {workers}, мест в очереди {max_queued}")
+
+    def submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Постановка задачи в очередь; QueueFullError, если мест нет"""
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'stage': 'queued',
+            'progress': {},
+            'payload': payload,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+        with self._lock:
+            try:
+                self._queue.put_nowait(job['id'])
+            except queue.Full:
+                raise QueueFullError(f"Очередь обработки заполнена ({self._queue.maxsize} задач)")
+            self._jobs[job['id']] = job
+            self._trim_finished()
+        return self.get(job['id'])
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Снимок состояния задачи"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = {k: v for k, v in job.items() if k != 'payload'}
+            snapshot['progress'] = dict(job['progress'])
+            if job['status'] == 'queued':
+                snapshot['queue_position'] = self._queue_position(job_id)
+            return snapshot
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            job_ids = list(self._jobs.keys())
+        return [job for job in (self.get(job_id) for job_id in job_ids) if job]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        counts['capacity'] = self._queue.maxsize
+        return counts
+
+    def _queue_position(self, job_id: str) -> int:
+        position = 0
+        for other_id, other in self._jobs.items():
+            if other['status'] == 'queued':
+                position += 1
+                if other_id == job_id:
+                    return position
+        return 0
+
+    def _trim_finished(self):
+        """Удаление самых старых завершенных задач сверх лимита"""
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def _progress_callback(self, job_id: str) -> Callable:
+        def progress(stage: str, **counters):
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    job['stage'] = stage
+                    job['progress'].update(counters)
+        return progress
+
+    def _worker_loop(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                payload = job['payload'] if job else None
+            if job is None:
+                self._queue.task_done()
+                continue
+
+            self._update(job_id, status='running', stage='started', started_at=time.time())
+            try:
+                result = self.handler(payload, self._progress_callback(job_id))
+                self._update(job_id, status='done', stage='done', result=result, finished_at=time.time())
+            except Exception as e:
+                print(f"❌ Задача {job_id} завершилась с ошибкой: {e}")
+                traceback.print_exc()
+                self._update(job_id, status='failed', error=str(e), finished_at=time.time())
+            finally:
+                self._queue.task_done()
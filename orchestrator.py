@@ -2,14 +2,30 @@
 import os
 import json
 import yaml
+import time
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from typing import List, Dict, Any, Optional
 
 # Импорты агентов
-from agents.doc_parser import DocParserAgent
+from agents.doc_parser import DocParserAgent, collect_sections, node_metadata, iter_nodes, text_chars
 from agents.smart_chunker import SmartChunkerAgent
 from agents.vector_agent import VectorAgent
-from agents.answer_gpt import AnswerGPTAgent
+from agents.answer_gpt_low_speed import AnswerGPTAgent
+from agents.answer_gpt import AnswerGPTAgentAsync
 from agents.validator import ValidatorAgent
+from agents.prompt_builder import GenerationError
+from agents.embedding_provider import get_embedder
+from agents.corpus_router import make_document_id, is_valid_document_id
+from agents.answer_cache import AnswerCache
+from agents.reranker import RerankerAgent, DEFAULT_RERANK_MODEL
+from agents.context_packer import ContextPacker, TokenCounter
+from agents.llm_pool import LLMPool
+from single_flight import SingleFlight, AsyncSingleFlight, AsyncStreamFlight
+from agents.batch_documents import prepare_document
+from agents.ingest_pipeline import IngestPipeline, assemble_chunks, coverage_report
 
 class RAGOrchestrator:
     """Оркестратор мультиагентной RAG системы"""
@@ -27,8 +43,24 @@ class RAGOrchestrator:
         print("🔄 Инициализация агентов...")
         self.agents = {}
         
+        # Один эмбеддер на процесс: чанкер и векторный агент используют
+        # общий экземпляр, веса загружаются лениво (см. warmup())
+        self.embedder = get_embedder(
+            self.config['embedding_model'],
+            device='cuda' if self.config['use_gpu'] else 'cpu'
+        )
+        # Дисковый кэш эмбеддингов: повторные загрузки кодируют только новый текст
+        self.embedder.enable_cache(
+            self.config.get('embedding_cache_path'),
+            max_size_mb=self.config.get('embedding_cache_max_mb', 512)
+        )
+        
         try:
-            self.agents['parser'] = DocParserAgent()
+            # auto - потоковый парсинг для файлов крупнее parse_streaming_min_mb
+            self.parse_mode = self.config.get('parse_mode', 'auto')
+            self.agents['parser'] = DocParserAgent(
+                mode='streaming' if self.parse_mode == 'streaming' else 'document'
+            )
             print("  ✅ ParserAgent")
         except Exception as e:
             print(f"  ❌ ParserAgent: {e}")
@@ -37,7 +69,13 @@ class RAGOrchestrator:
             self.agents['chunker'] = SmartChunkerAgent(
                 embedding_model=self.config['embedding_model'],
                 chunk_size=self.config['chunk_size'],
-                overlap=self.config['overlap_size']
+                overlap=self.config['overlap_size'],
+                embedder=self.embedder,
+                batch_size=self.config['batch_size'],
+                boundary_strategy=self.config.get('boundary_strategy', 'threshold'),
+                boundary_params=self.config.get('boundary_params'),
+                min_chunk_size=self.config.get('min_chunk_size', 0),
+                max_chunk_size=self.config.get('max_chunk_size')
             )
             print("  ✅ ChunkerAgent")
         except Exception as e:
@@ -48,119 +86,232 @@ class RAGOrchestrator:
                 embedding_model=self.config['embedding_model'],
                 use_gpu=self.config['use_gpu'],
                 batch_size=self.config['batch_size'],
-                db_path=self.config['vector_db_path']
+                db_path=self.config['vector_db_path'],
+                embedder=self.embedder,
+                incremental=self.config.get('index_mode', 'incremental') == 'incremental',
+                router_top_documents=self.config.get('router_top_documents', 20),
+                query_cache_size=self.config.get('query_embedding_cache_size', 1024),
+                retrieval_mode=self.config.get('retrieval_mode', 'dense'),
+                rrf_k=self.config.get('rrf_k', 60),
+                hybrid_candidates=self.config.get('hybrid_candidates', 20),
+                hierarchy_min_chunks=self.config.get('hierarchy_min_chunks', 200),
+                hierarchy_top_nodes=self.config.get('hierarchy_top_nodes', 5),
+                hierarchy_title_weight=self.config.get('hierarchy_title_weight', 0.3)
             )
             print("  ✅ VectorAgent")
         except Exception as e:
             print(f"  ❌ VectorAgent: {e}")
         
+        # Контекст промпта собирается по бюджету токенов генерирующей модели.
+        # prefix_stable: контекст в порядке документа перед вопросом - общий
+        # префикс запросов к одному разделу берется из KV-кэша LLM-сервера
+        prompt_layout = self.config.get('prompt_layout', 'question_first')
+        self.context_packer = ContextPacker(
+            TokenCounter(self.config.get('context_tokenizer')),
+            budget_tokens=self.config.get('context_budget_tokens', 2500),
+            merge_adjacent=self.config.get('context_merge_adjacent', True),
+            order='document' if prompt_layout == 'prefix_stable' else 'relevance'
+        )
+        self.prompt_stats = {'requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0}
+        
+        # Пул серверов генерации: общий для синхронного и асинхронного агентов
+        self.llm_pool = LLMPool(
+            self.config.get('llm_backends') or [self.config['lm_studio_url']],
+            timeout=self.config.get('generation_timeout', 180),
+            failure_threshold=self.config.get('llm_failure_threshold', 3),
+            cooldown=self.config.get('llm_circuit_cooldown', 30),
+            health_interval=self.config.get('llm_health_interval', 30),
+            hedge_after_ms=self.config.get('llm_hedge_after_ms'),
+            http2=True
+        )
+        
         try:
             self.agents['generator'] = AnswerGPTAgent(
                 api_base=self.config['lm_studio_url'],
                 model=self.config['generation_model'],
                 temperature=self.config['temperature'],
-                max_tokens=self.config['max_tokens']
+                max_tokens=self.config['max_tokens'],
+                timeout=self.config.get('generation_timeout', 180),
+                context_packer=self.context_packer,
+                prompt_layout=prompt_layout,
+                cache_prompt=self.config.get('llm_cache_prompt', False),
+                pool=self.llm_pool
             )
             print("  ✅ GeneratorAgent")
         except Exception as e:
             print(f"  ❌ GeneratorAgent: {e}")
         
+        try:
+            self.agents['async_generator'] = AnswerGPTAgentAsync(
+                api_base=self.config['lm_studio_url'],
+                model=self.config['generation_model'],
+                temperature=self.config['temperature'],
+                max_tokens=self.config['max_tokens'],
+                timeout=self.config.get('generation_timeout', 180),
+                context_packer=self.context_packer,
+                prompt_layout=prompt_layout,
+                cache_prompt=self.config.get('llm_cache_prompt', False),
+                pool=self.llm_pool
+            )
+            print("  ✅ AsyncGeneratorAgent")
+        except Exception as e:
+            print(f"  ❌ AsyncGeneratorAgent: {e}")
+        
+        if self.config.get('rerank_enabled', False):
+            try:
+                self.agents['reranker'] = RerankerAgent(
+                    model_name=self.config.get('rerank_model', DEFAULT_RERANK_MODEL),
+                    device='cuda' if self.config['use_gpu'] else 'cpu',
+                    batch_size=self.config.get('rerank_batch_size', 32),
+                    cache_size=self.config.get('rerank_cache_size', 20000),
+                    latency_budget_ms=self.config.get('rerank_budget_ms', 1000),
+                    max_pending=self.config.get('rerank_max_pending', 1)
+                )
+                print("  ✅ RerankerAgent")
+            except Exception as e:
+                print(f"  ❌ RerankerAgent: {e}")
+        
         try:
             self.agents['validator'] = ValidatorAgent()
             print("  ✅ ValidatorAgent")
         except Exception as e:
             print(f"  ❌ ValidatorAgent: {e}")
         
+        # Асинхронный путь запроса: эмбеддинг и Chroma - в ограниченном пуле
+        # потоков, генерация - через httpx с лимитом одновременных вызовов LLM
+        self.query_executor = ThreadPoolExecutor(
+            max_workers=self.config.get('query_workers', 4),
+            thread_name_prefix="query"
+        )
+        self.max_concurrent_generations = self.config.get('max_concurrent_generations', 2)
+        self._generation_semaphore = None
+        
+        # Кэш ответов: повторные и перефразированные вопросы без поиска и LLM
+        cache_size = self.config.get('answer_cache_size', 500)
+        self.answer_cache = AnswerCache(
+            max_entries=cache_size,
+            ttl_seconds=self.config.get('answer_cache_ttl', 3600),
+            similarity_threshold=self.config.get('answer_cache_similarity', 0.92)
+        ) if cache_size else None
+        
+        # Одинаковые одновременные вопросы: один поиск и один вызов LLM на всех
+        self.coalesce_requests = self.config.get('coalesce_requests', True)
+        self._flight = SingleFlight()
+        self._aflight = AsyncSingleFlight()
+        self._stream_flight = AsyncStreamFlight()
+        
+        # Структура последнего обработанного документа (только для статуса);
+        # во время загрузки структура хранится локально и присваивается целиком
         self.doc_structure = None
-        self.is_indexed = False
+        self.last_coverage = None  # полнота индекса последнего загруженного документа
+        # Загрузки одного документа идут по очереди: две инкрементальные сессии
+        # на одной коллекции удалили бы чанки друг друга
+        self._document_locks: Dict[str, threading.Lock] = {}
+        self._document_locks_guard = threading.Lock()
+        self.structures_dir = os.path.join(self.config['vector_db_path'], "structures")
+        self.is_indexed = 'vector' in self.agents and self.agents['vector'].has_documents()
         print("✅ RAGOrchestrator инициализирован")
     
-    def process_document(self, docx_path: str) -> Dict[str, Any]:
+    def warmup(self, background: bool = True):
         """
-        Полный пайплайн обработки документа
+        Загрузка модели эмбеддингов заранее (по умолчанию в фоне),
+        чтобы веб-сервер поднимался, не дожидаясь загрузки весов
+        """
+        if 'reranker' in self.agents:
+            self.agents['reranker'].warmup(background=background)
+        return self.embedder.warmup(background=background)
+    
+    def process_document(self, docx_path: str, document_id: Optional[str] = None,
+                         progress=None) -> Dict[str, Any]:
+        """
+        Полный пайплайн обработки документа.
+        Документ добавляется в корпус (или обновляется, если id уже есть);
+        по умолчанию id строится из имени файла.
+        progress(stage, **counters) - колбэк прогресса по стадиям
+        (parsing, parsed, chunking, embedding, indexed).
         """
         print(f"\n📄 Начало обработки документа: {docx_path}")
+        document_id = document_id or make_document_id(os.path.basename(docx_path))
+        if not is_valid_document_id(document_id):
+            raise ValueError(f"Недопустимый id документа: {document_id!r}")
+        progress = progress or (lambda stage, **counters: None)
         
+        with self._document_lock(document_id):
+            return self._process_document(docx_path, document_id, progress)
+    
+    def _document_lock(self, document_id: str) -> threading.Lock:
+        """Блокировка загрузки документа (очередь задач, ingest_workers > 1, пакеты)"""
+        with self._document_locks_guard:
+            return self._document_locks.setdefault(document_id, threading.Lock())
+    
+    def _process_document(self, docx_path: str, document_id: str, progress) -> Dict[str, Any]:
         try:
+            if self.config.get('ingest_pipeline', True):
+                return self._process_pipelined(docx_path, document_id, progress)
+            if self._use_streaming_parser(docx_path):
+                return self._process_streaming(docx_path, document_id, progress)
+            
             # 1. ПАРСИНГ - извлекаем структуру
+            # 2. ЧАНКОВАНИЕ - разбиваем на смысловые фрагменты
             print("🔍 Парсинг структуры...")
-            self.doc_structure = self.agents['parser'].parse_with_hierarchy(docx_path)
-            print(f"✅ Найдено глав: {len(self.doc_structure['chapters'])}")
+            progress('parsing')
             
-            # 2. ЧАНКОВАНИЕ - разбиваем на смысловые фрагменты
-            print("✂️ Разделение на чанки...")
-            chunks = []
-            metadata = []
+            def chunking_progress(done, total):
+                progress('chunking', sections_done=done, sections_total=total)
             
-            for chapter_idx, chapter in enumerate(self.doc_structure['chapters']):
-                print(f"  Обработка главы {chapter_idx + 1}: {chapter['title'][:50]}...")
-                
-                # Обработка контента главы
-                if chapter.get('content'):
-                    print(f"    Контент главы: {len(chapter['content'])} символов")
-                    chapter_chunks = self.agents['chunker'].split_by_semantics(chapter['content'])
-                    print(f"    Получено чанков из главы: {len(chapter_chunks)}")
-                    
-                    for chunk in chapter_chunks:
-                        chunks.append(chunk)
-                        metadata.append({
-                            'chapter_id': chapter['id'],
-                            'chapter_title': chapter['title'],
-                            'level': 1,
-                            'type': 'chapter'
-                        })
-                
-                # Обработка разделов внутри главы
-                for section_idx, section in enumerate(chapter.get('sections', [])):
-                    print(f"    Обработка раздела {section_idx + 1}: {section['title'][:50]}...")
-                    
-                    if section.get('content'):
-                        section_chunks = self.agents['chunker'].split_by_semantics(section['content'])
-                        print(f"      Получено чанков из раздела: {len(section_chunks)}")
-                        
-                        for chunk in section_chunks:
-                            chunks.append(chunk)
-                            metadata.append({
-                                'chapter_id': chapter['id'],
-                                'chapter_title': chapter['title'],
-                                'section_id': section['id'],
-                                'section_title': section['title'],
-                                'level': 2,
-                                'type': 'section'
-                            })
+            structure = self.agents['parser'].parse_with_hierarchy(docx_path, streaming=False)
+            print(f"✅ Найдено глав: {len(structure['chapters'])}")
+            progress('parsed', chapters=len(structure['chapters']))
+            
+            print("✂️ Разделение на чанки...")
+            # Сначала собираем тексты всех глав и разделов, затем чанкуем
+            # документ целиком: все предложения кодируются крупными пакетами
+            section_texts, section_meta = collect_sections(structure)
+            print(f"  Глав и разделов с текстом: {len(section_texts)}")
+            progress('chunking', sections_done=0, sections_total=len(section_texts))
+            chunks, metadata, chunk_vectors = self._chunk_sections(
+                section_texts, section_meta, chunking_progress
+            )
             
             print(f"📊 Всего собрано чанков: {len(chunks)}")
             
             # Проверка на пустые чанки
             if len(chunks) == 0:
-                print("⚠️ Внимание: не создано ни одного чанка!")
-                # Создаем один общий чанк
-                all_text = ""
-                for chapter in self.doc_structure['chapters']:
-                    if chapter.get('content'):
-                        all_text += chapter['content'] + "\n"
-                
-                if all_text:
-                    chunks = [all_text[:self.config['chunk_size']]]
-                    metadata = [{
-                        'chapter_id': 'all',
-                        'chapter_title': 'Весь документ',
-                        'level': 0,
-                        'type': 'full'
-                    }]
-                    print(f"✅ Создан один общий чанк")
+                chunks, metadata, chunk_vectors = self._whole_document_chunk(structure)
             
             # 3. ИНДЕКСАЦИЯ - создаем векторный индекс
             print("🔗 Создание векторного индекса...")
-            self.agents['vector'].create_index(chunks, metadata)
+            progress('embedding', chunks=len(chunks), chunks_embedded=0, chunks_to_embed=None)
+            
+            def embedding_progress(done, total):
+                progress('embedding', chunks_embedded=done, chunks_to_embed=total)
+            
+            index_delta = self.agents['vector'].create_index(
+                chunks, metadata,
+                document_id=document_id,
+                document_info={
+                    'filename': structure['document'],
+                    'chapters_count': len(structure['chapters'])
+                },
+                embeddings=chunk_vectors,
+                progress=embedding_progress
+            )
+            coverage = self._record_coverage(document_id, structure,
+                                             sum(text_chars(chunk) for chunk in chunks))
+            self._save_structure(document_id, structure)
+            self.doc_structure = structure
             self.is_indexed = True
+            progress('indexed', index_delta=index_delta)
             
-            print(f"✅ Документ обработан. Глав: {len(self.doc_structure['chapters'])}, Чанков: {len(chunks)}")
+            print(f"✅ Документ обработан. Глав: {len(structure['chapters'])}, Чанков: {len(chunks)}")
             
             return {
-                'structure': self.doc_structure,
+                'document_id': document_id,
+                'structure': structure,
                 'chunks_count': len(chunks),
-                'chapters_count': len(self.doc_structure['chapters'])
+                'chapters_count': len(structure['chapters']),
+                'index_delta': index_delta,
+                'coverage': coverage
             }
             
         except Exception as e:
@@ -168,60 +319,738 @@ class RAGOrchestrator:
             import traceback
             traceback.print_exc()
             raise
+        finally:
+            self.embedder.flush_cache()
+    
+    def _process_pipelined(self, docx_path: str, document_id: str, progress) -> Dict[str, Any]:
+        """
+        Загрузка документа конвейером: парсинг, чанкование, кодирование и запись
+        в коллекцию идут одновременно в отдельных потоках (agents/ingest_pipeline.py)
+        """
+        print("🏭 Конвейерная загрузка: парсинг -> чанкование -> кодирование -> запись")
+        progress('parsing')
+        pipeline = IngestPipeline(
+            self.agents['parser'], self.agents['chunker'], self.agents['vector'],
+            pooling=self.config.get('chunk_embedding_mode', 'encode'),
+            section_batch_chars=self.config.get('pipeline_batch_chars', 50000),
+            queue_size=self.config.get('pipeline_queue_size', 4)
+        )
+        result = pipeline.run(docx_path, document_id,
+                              streaming=self._use_streaming_parser(docx_path), progress=progress)
+        
+        structure = result['structure']
+        self._record_coverage(document_id, structure, result['coverage']['indexed_chars'])
+        self._save_structure(document_id, structure)
+        self.doc_structure = structure
+        self.is_indexed = True
+        progress('indexed', index_delta=result['index_delta'])
+        print(f"✅ Документ обработан. Глав: {len(structure['chapters'])}, "
+              f"Чанков: {result['chunks_count']}")
+        
+        return {
+            'document_id': document_id,
+            'structure': structure,
+            'chunks_count': result['chunks_count'],
+            'chapters_count': len(structure['chapters']),
+            'index_delta': result['index_delta'],
+            'coverage': structure['coverage'],
+            'timing': result['timing']
+        }
+    
+    def process_documents(self, paths: List[str], workers: Optional[int] = None,
+                          progress=None, document_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        """
+        Пакетная загрузка документов. Парсинг и разбиение на предложения
+        выполняются в пуле процессов; готовые документы собираются в группы
+        (до batch_embed_sentences предложений или все, что готово к этому моменту),
+        и предложения всей группы кодируются одним вызовом модели в основном процессе.
+        Каждый документ записывается в свою коллекцию одним create_index.
+        progress(stage, **counters) - как у process_document (stage='batch').
+        document_ids - id документов в порядке paths (по умолчанию - по имени файла);
+        документ с id, уже встречавшимся в пакете, не загружается и попадает в ошибки.
+        Возвращает отчет с пропускной способностью (документов в минуту, чанков в секунду).
+        """
+        workers = workers or self.config.get('batch_ingest_workers') or os.cpu_count() or 1
+        group_sentences = self.config.get('batch_embed_sentences', 4096)
+        progress = progress or (lambda stage, **counters: None)
+        print(f"\n📚 Пакетная загрузка: {len(paths)} документов, процессов: {workers}")
+        
+        started = time.perf_counter()
+        report = {
+            'documents': [],
+            'failed': [],
+            'timing': {'prepare_s': 0.0, 'embedding_s': 0.0, 'writing_s': 0.0}
+        }
+        
+        def record_failure(path, error):
+            print(f"❌ {path}: {error}")
+            report['failed'].append({'path': path, 'error': str(error)})
+        
+        # Реестр корпуса записывается на диск один раз - в конце пакета
+        # spawn, а не fork: процесс веб-сервера многопоточный (модели, очередь задач,
+        # проверка LLM), копия его памяти с захваченными блокировками может зависнуть
+        with self.agents['vector'].router.deferred_save(), ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            pending = {}
+            seen: Dict[str, str] = {}
+            for i, path in enumerate(paths):
+                try:
+                    document_id = document_ids[i] if document_ids else make_document_id(os.path.basename(path))
+                    if not is_valid_document_id(document_id):
+                        raise ValueError(f"Недопустимый id документа: {document_id!r}")
+                    if document_id in seen:
+                        # Иначе второй файл молча заменил бы чанки первого
+                        raise ValueError(f"id {document_id} совпадает с документом {seen[document_id]}")
+                    seen[document_id] = path
+                    pending[pool.submit(prepare_document, path, self._use_streaming_parser(path),
+                                        document_id)] = path
+                except Exception as e:
+                    record_failure(path, e)
+            
+            group = []
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        prepared = future.result()
+                    except Exception as e:
+                        record_failure(path, e)
+                        continue
+                    report['timing']['prepare_s'] += prepared['prepare_s']
+                    group.append(prepared)
+                
+                # Кодируем, когда набралась группа или больше нечего ждать прямо сейчас
+                ready = any(future.done() for future in pending)
+                if group and (not pending or not ready
+                              or sum(doc['sentences'] for doc in group) >= group_sentences):
+                    self._ingest_group(group, report)
+                    group = []
+                    progress('batch', documents_done=len(report['documents']) + len(report['failed']),
+                             documents_total=len(paths))
+        
+        elapsed = time.perf_counter() - started
+        chunks_total = sum(doc['chunks'] for doc in report['documents'])
+        report.update({
+            'documents_total': len(paths),
+            'documents_indexed': len(report['documents']),
+            'chunks_total': chunks_total,
+            'elapsed_s': round(elapsed, 2),
+            'docs_per_min': round(len(report['documents']) / elapsed * 60, 1) if elapsed else None,
+            'chunks_per_s': round(chunks_total / elapsed, 1) if elapsed else None,
+            'workers': workers
+        })
+        report['timing'] = {k: round(v, 2) for k, v in report['timing'].items()}
+        self.embedder.flush_cache()
+        
+        print(f"\n📊 Загружено документов: {report['documents_indexed']}/{len(paths)}, "
+              f"чанков: {chunks_total}, ошибок: {len(report['failed'])}")
+        print(f"   Время: {report['elapsed_s']} с, {report['docs_per_min']} док/мин, "
+              f"{report['chunks_per_s']} чанков/с")
+        print(f"   Парсинг (сумма по процессам): {report['timing']['prepare_s']} с, "
+              f"кодирование: {report['timing']['embedding_s']} с, запись: {report['timing']['writing_s']} с")
+        return report
+    
+    def _ingest_group(self, group: List[Dict], report: Dict[str, Any]):
+        """Кодирование группы подготовленных документов одним проходом модели и запись в индекс"""
+        chunker = self.agents['chunker']
+        pooling = self.config.get('chunk_embedding_mode', 'encode')
+        
+        started = time.perf_counter()
+        all_sentences = [s for doc in group for sentences in doc['section_sentences'].values() for s in sentences]
+        print(f"🔬 Группа из {len(group)} документов: {len(all_sentences)} предложений")
+        try:
+            embeddings = chunker.encode_sentences(all_sentences) if all_sentences else None
+        except Exception as e:
+            for doc in group:
+                report['failed'].append({'path': doc['path'], 'error': f"Ошибка кодирования: {e}"})
+            return
+        
+        documents = []
+        offset = 0
+        for doc in group:
+            doc_embeddings = embeddings[offset:offset + doc['sentences']] if doc['sentences'] else None
+            offset += doc['sentences']
+            chunked = chunker.chunk_with_embeddings(
+                doc['section_texts'], doc['results'], doc['section_sentences'], doc_embeddings,
+                pooling=None if pooling == 'encode' else pooling
+            )
+            if pooling == 'encode':
+                chunked_sections, section_vectors = chunked, [[None] * len(c) for c in chunked]
+            else:
+                chunked_sections, section_vectors = chunked
+            chunks, metadata, chunk_vectors = assemble_chunks(
+                chunked_sections, section_vectors, doc['section_meta']
+            )
+            if not chunks:
+                chunks, metadata, chunk_vectors = self._whole_document_chunk(doc['structure'])
+            documents.append((doc, chunks, metadata, chunk_vectors))
+        
+        # Векторы чанков (кроме собранных пулингом) - тоже одним вызовом на группу
+        missing = [(i, j) for i, entry in enumerate(documents) for j, v in enumerate(entry[3]) if v is None]
+        if missing:
+            vectors = self.embedder.encode_cached([documents[i][1][j] for i, j in missing],
+                                                  batch_size=self.config.get('batch_size', 64))
+            for (i, j), vector in zip(missing, vectors):
+                documents[i][3][j] = vector
+        report['timing']['embedding_s'] += time.perf_counter() - started
+        
+        started = time.perf_counter()
+        for doc, chunks, metadata, chunk_vectors in documents:
+            try:
+                if not chunks:
+                    raise ValueError("В документе нет текста")
+                with self._document_lock(doc['document_id']):
+                    index_delta = self.agents['vector'].create_index(
+                        chunks, metadata,
+                        document_id=doc['document_id'],
+                        document_info={
+                            'filename': doc['structure']['document'],
+                            'chapters_count': len(doc['structure']['chapters'])
+                        },
+                        embeddings=chunk_vectors
+                    )
+                    coverage = self._record_coverage(doc['document_id'], doc['structure'],
+                                                     sum(text_chars(chunk) for chunk in chunks))
+                    self._save_structure(doc['document_id'], doc['structure'])
+                self.doc_structure = doc['structure']
+                self.is_indexed = True
+                report['documents'].append({
+                    'path': doc['path'],
+                    'document_id': doc['document_id'],
+                    'chapters': len(doc['structure']['chapters']),
+                    'chunks': len(chunks),
+                    'index_delta': index_delta,
+                    'coverage': coverage
+                })
+                print(f"✅ {doc['document_id']}: чанков {len(chunks)}")
+            except Exception as e:
+                print(f"❌ {doc['path']}: {e}")
+                report['failed'].append({'path': doc['path'], 'error': str(e)})
+        report['timing']['writing_s'] += time.perf_counter() - started
+    
+    def _whole_document_chunk(self, structure: Dict):
+        """Один общий чанк, если чанкование не дало ни одного"""
+        print("⚠️ Внимание: не создано ни одного чанка!")
+        # Создаем один общий чанк
+        all_text = ""
+        for path in iter_nodes(structure['chapters']):
+            if path[-1].get('content'):
+                all_text += path[-1]['content'] + "\n"
+        
+        if not all_text:
+            return [], [], []
+        print(f"✅ Создан один общий чанк")
+        return [all_text[:self.config['chunk_size']]], [{
+            'chapter_id': 'all',
+            'chapter_title': 'Весь документ',
+            'level': 0,
+            'type': 'full'
+        }], [None]
+    
+    def _record_coverage(self, document_id: str, structure: Dict, indexed_chars: int) -> Dict[str, Any]:
+        """
+        Полнота индекса документа (символы текста в источнике / в чанках):
+        сохраняется в структуре и в last_coverage, при потере текста - предупреждение
+        """
+        coverage = coverage_report(structure, indexed_chars)
+        structure['coverage'] = coverage
+        self.last_coverage = dict(coverage, document_id=document_id)
+        if coverage['ratio'] < self.config.get('coverage_warn_ratio', 0.98):
+            print(f"⚠️ В индекс попало {coverage['ratio']:.1%} текста документа "
+                  f"({coverage['indexed_chars']} из {coverage['source_chars']} символов)")
+        else:
+            print(f"📏 Полнота индекса: {coverage['ratio']:.1%}")
+        return coverage
+    
+    def _use_streaming_parser(self, docx_path: str) -> bool:
+        if self.parse_mode != 'auto':
+            return self.parse_mode == 'streaming'
+        size_mb = os.path.getsize(docx_path) / (1024 * 1024)
+        return size_mb >= self.config.get('parse_streaming_min_mb', 20)
+    
+    def _chunk_sections(self, section_texts: List[str], section_meta: List[Dict], progress=None):
+        """Чанкование текстов разделов: (чанки, метаданные, векторы чанков или None)"""
+        # В режиме пулинга векторы чанков собираются из эмбеддингов
+        # предложений, и текст чанков повторно не кодируется
+        pooling = self.config.get('chunk_embedding_mode', 'encode')
+        if pooling == 'encode':
+            chunked_sections = self.agents['chunker'].chunk_document(
+                section_texts, progress=progress
+            )
+            section_vectors = [[None] * len(c) for c in chunked_sections]
+        else:
+            chunked_sections, section_vectors = self.agents['chunker'].chunk_document(
+                section_texts, pooling=pooling, progress=progress
+            )
+        
+        return assemble_chunks(chunked_sections, section_vectors, section_meta)
+    
+    def _process_streaming(self, docx_path: str, document_id: str, progress) -> Dict[str, Any]:
+        """
+        Потоковый парсинг без конвейера: готовые главы и разделы копятся в пакет
+        до parse_batch_chars символов, пакет чанкуется и сразу пишется в индекс
+        (begin_index / write_batch / finish_index). В памяти одновременно - только
+        текущий пакет текста и его чанки, а не весь документ; в структуре остаются
+        заголовки без текста (content_chars - его длина).
+        """
+        print("🌊 Потоковый парсинг, чанкование и запись по мере чтения...")
+        progress('parsing')
+        batch_chars = self.config.get('parse_batch_chars', 200000)
+        batch_texts: List[str] = []
+        batch_meta: List[Dict] = []
+        state = {'chars': 0, 'sections': 0, 'chunks': 0, 'indexed_chars': 0}
+        vector = self.agents['vector']
+        session = vector.begin_index(document_id)
+        
+        def flush_batch():
+            if not batch_texts:
+                return
+            done_before = state['sections']
+            
+            def batch_progress(done, total):
+                progress('chunking', sections_done=done_before + done, sections_total=None)
+            
+            chunks, metadata, chunk_vectors = self._chunk_sections(batch_texts, batch_meta, batch_progress)
+            vector.write_batch(session, chunks, metadata, chunk_vectors)
+            state['sections'] += len(batch_texts)
+            state['chunks'] += len(chunks)
+            state['indexed_chars'] += sum(text_chars(chunk) for chunk in chunks)
+            progress('embedding', chunks=state['chunks'], chunks_embedded=state['chunks'],
+                     chunks_to_embed=None)
+            batch_texts.clear()
+            batch_meta.clear()
+            state['chars'] = 0
+        
+        def on_node(node, path):
+            if not node.get('content'):
+                return
+            batch_texts.append(node['content'])
+            batch_meta.append(node_metadata(path))
+            state['chars'] += len(node['content'])
+            if state['chars'] >= batch_chars:
+                flush_batch()
+        
+        try:
+            structure = self.agents['parser'].parse_with_hierarchy(
+                docx_path, streaming=True, on_node=on_node, keep_content=False
+            )
+            flush_batch()
+            print(f"✅ Найдено глав: {len(structure['chapters'])}")
+            progress('parsed', chapters=len(structure['chapters']))
+            index_delta = vector.finish_index(session, {
+                'filename': structure['document'],
+                'chapters_count': len(structure['chapters'])
+            })
+        except Exception:
+            # Прежний индекс документа остается рабочим
+            vector.abort_index(session)
+            raise
+        
+        print(f"  Глав, разделов и подразделов с текстом: {state['sections']}")
+        coverage = self._record_coverage(document_id, structure, state['indexed_chars'])
+        self._save_structure(document_id, structure)
+        self.doc_structure = structure
+        self.is_indexed = True
+        progress('indexed', index_delta=index_delta)
+        print(f"✅ Документ обработан. Глав: {len(structure['chapters'])}, Чанков: {state['chunks']}")
+        
+        return {
+            'document_id': document_id,
+            'structure': structure,
+            'chunks_count': state['chunks'],
+            'chapters_count': len(structure['chapters']),
+            'index_delta': index_delta,
+            'coverage': coverage
+        }
     
-    def query_document(self, question: str, chapter_filter: Optional[str] = None) -> Dict[str, Any]:
+    def query_document(self, question: str, chapter_filter: Optional[str] = None,
+                       document_ids: Optional[List[str]] = None) -> Dict[str, Any]:
         """
-        Обработка запроса пользователя
+        Обработка запроса пользователя.
+        document_ids - область поиска (один, несколько документов или весь корпус)
         """
         print(f"\n❓ Вопрос: {question}")
         
         if not self.is_indexed:
-            return {
-                "error": "Сначала загрузите и обработайте документ",
-                "answer": "Документ не загружен. Пожалуйста, сначала загрузите документ."
-            }
+            return self._not_indexed_result()
         
+        if not self.coalesce_requests:
+            return self._query_document(question, chapter_filter, document_ids)
+        try:
+            key = self._flight_key(question, chapter_filter, document_ids)
+            result, shared = self._flight.do(
+                key, lambda: self._query_document(question, chapter_filter, document_ids)
+            )
+        except Exception as e:
+            return self._error_result(e)
+        if shared:
+            print("🔗 Ответ получен от такого же одновременного запроса")
+        return result
+    
+    def _query_document(self, question: str, chapter_filter: Optional[str],
+                        document_ids: Optional[List[str]]) -> Dict[str, Any]:
         try:
+            # 0. КЭШ - тот же или похожий вопрос к той же версии индекса
+            cached, scope, query_embedding = self._lookup_answer(question, chapter_filter, document_ids)
+            if cached:
+                return cached
+            
             # 1. ПОИСК - находим релевантные чанки
-            print("🔎 Поиск релевантных чанков...")
-            filters = {"chapter_id": chapter_filter} if chapter_filter else None
-            chunks = self.agents['vector'].hierarchical_search(question, top_k=5, filters=filters)
-            print(f"   Найдено чанков: {len(chunks)}")
+            chunks = self._retrieve(question, chapter_filter, document_ids, query_embedding)
             
             if not chunks:
-                return {
-                    "answer": "По вашему запросу ничего не найдено в документе.",
-                    "sources": [],
-                    "confidence": 0,
-                    "warnings": ["Ничего не найдено"]
-                }
+                return self._nothing_found_result()
             
             # 2. ГЕНЕРАЦИЯ - создаем ответ на основе найденных чанков
             print("🤖 Генерация ответа...")
-            answer = self.agents['generator'].generate_answer(question, chunks)
+            usage = {}
+            answer = self.agents['generator'].generate_answer(question, chunks, usage=usage)
             
             # 3. ВАЛИДАЦИЯ - проверяем качество ответа
             print("✅ Валидация ответа...")
             validated = self.agents['validator'].validate(answer, chunks)
+            validated['generation_error'] = isinstance(answer, GenerationError)
+            self._record_usage(validated, usage)
             
+            self._remember_answer(question, query_embedding, scope, validated)
             return validated
             
         except Exception as e:
-            print(f"❌ Ошибка при обработке запроса: {e}")
-            import traceback
-            traceback.print_exc()
-            return {
-                "error": str(e),
-                "answer": f"Произошла ошибка при обработке запроса: {str(e)}",
-                "sources": [],
-                "confidence": 0
+            return self._error_result(e)
+    
+    async def aquery_document(self, question: str, chapter_filter: Optional[str] = None,
+                              document_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        """
+        Асинхронная обработка запроса: не блокирует event loop.
+        Поиск выполняется в пуле потоков, генерация - через асинхронный клиент
+        с ограничением числа одновременных запросов к LLM.
+        """
+        print(f"\n❓ Вопрос: {question}")
+        
+        if not self.is_indexed:
+            return self._not_indexed_result()
+        
+        if not self.coalesce_requests:
+            return await self._aquery_document(question, chapter_filter, document_ids)
+        try:
+            key = self._flight_key(question, chapter_filter, document_ids)
+            result, shared = await self._aflight.do(
+                key, lambda: self._aquery_document(question, chapter_filter, document_ids)
+            )
+        except Exception as e:
+            return self._error_result(e)
+        if shared:
+            print("🔗 Ответ получен от такого же одновременного запроса")
+        return result
+    
+    async def _aquery_document(self, question: str, chapter_filter: Optional[str],
+                               document_ids: Optional[List[str]]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        try:
+            cached, scope, query_embedding = await loop.run_in_executor(
+                self.query_executor, self._lookup_answer, question, chapter_filter, document_ids
+            )
+            if cached:
+                return cached
+            
+            chunks = await loop.run_in_executor(
+                self.query_executor, self._retrieve, question, chapter_filter, document_ids,
+                query_embedding
+            )
+            
+            if not chunks:
+                return self._nothing_found_result()
+            
+            print("🤖 Генерация ответа...")
+            usage = {}
+            async with self._get_generation_semaphore():
+                answer = await self.agents['async_generator'].generate_answer_async(
+                    question, chunks, usage=usage
+                )
+            
+            print("✅ Валидация ответа...")
+            validated = self.agents['validator'].validate(answer, chunks)
+            validated['generation_error'] = isinstance(answer, GenerationError)
+            self._record_usage(validated, usage)
+            self._remember_answer(question, query_embedding, scope, validated)
+            return validated
+            
+        except Exception as e:
+            return self._error_result(e)
+    
+    async def astream_query(self, question: str, chapter_filter: Optional[str] = None,
+                            document_ids: Optional[List[str]] = None):
+        """
+        Потоковая обработка запроса. Отдает события:
+          ('token', {'text': ...}) - очередной фрагмент ответа;
+          ('done', {...}) - результат валидации полного ответа и тайминги
+          (retrieval_ms, ttft_ms - время до первого токена, total_ms).
+        """
+        print(f"\n❓ Вопрос (поток): {question}")
+        
+        if not self.is_indexed:
+            yield 'done', self._not_indexed_result()
+            return
+        
+        if not self.coalesce_requests:
+            async for event in self._astream_query(question, chapter_filter, document_ids):
+                yield event
+            return
+        # Подключившийся к уже идущей генерации получает все ее события с начала
+        try:
+            key = self._flight_key(question, chapter_filter, document_ids)
+        except Exception as e:
+            yield 'done', self._error_result(e)
+            return
+        async for event in self._stream_flight.subscribe(
+            key, lambda: self._astream_query(question, chapter_filter, document_ids)
+        ):
+            yield event
+    
+    async def _astream_query(self, question: str, chapter_filter: Optional[str],
+                             document_ids: Optional[List[str]]):
+        started = time.perf_counter()
+        
+        def elapsed_ms() -> int:
+            return int((time.perf_counter() - started) * 1000)
+        
+        loop = asyncio.get_running_loop()
+        try:
+            cached, scope, query_embedding = await loop.run_in_executor(
+                self.query_executor, self._lookup_answer, question, chapter_filter, document_ids
+            )
+            if cached:
+                # Ответ из кэша отдается одним фрагментом
+                yield 'token', {'text': cached.get('answer', '')}
+                cached['timing'] = {'retrieval_ms': 0, 'ttft_ms': elapsed_ms(), 'total_ms': elapsed_ms()}
+                yield 'done', cached
+                return
+            
+            chunks = await loop.run_in_executor(
+                self.query_executor, self._retrieve, question, chapter_filter, document_ids,
+                query_embedding
+            )
+            retrieval_ms = elapsed_ms()
+            
+            if not chunks:
+                yield 'done', self._nothing_found_result()
+                return
+            
+            print("🤖 Потоковая генерация ответа...")
+            parts = []
+            ttft_ms = None
+            usage = {}
+            async with self._get_generation_semaphore():
+                async for text in self.agents['async_generator'].stream_answer(question, chunks, usage=usage):
+                    if ttft_ms is None:
+                        ttft_ms = elapsed_ms()
+                    parts.append(text)
+                    yield 'token', {'text': text}
+            
+            print("✅ Валидация ответа...")
+            validated = self.agents['validator'].validate(''.join(parts), chunks)
+            validated['generation_error'] = any(isinstance(text, GenerationError) for text in parts)
+            validated['timing'] = {
+                'retrieval_ms': retrieval_ms,
+                'ttft_ms': ttft_ms,
+                'total_ms': elapsed_ms()
             }
+            print(f"   Первый токен: {ttft_ms} мс, всего: {validated['timing']['total_ms']} мс")
+            self._record_usage(validated, usage)
+            self._remember_answer(question, query_embedding, scope, validated)
+            yield 'done', validated
+            
+        except Exception as e:
+            yield 'done', self._error_result(e)
+    
+    def _record_usage(self, result: Dict[str, Any], usage: Dict[str, Any]):
+        """Токены промпта и попадания в KV-кэш сервера - в ответ и в общую статистику"""
+        if not usage:
+            return
+        result['usage'] = usage
+        self.prompt_stats['requests'] += 1
+        self.prompt_stats['prompt_tokens'] += usage.get('prompt_tokens') or 0
+        self.prompt_stats['cached_tokens'] += usage.get('cached_tokens') or 0
+        if usage.get('prompt_tokens'):
+            print(f"   Промпт: {usage['prompt_tokens']} токенов, из кэша сервера: {usage.get('cached_tokens', 0)}")
+    
+    def _flight_key(self, question: str, chapter_filter: Optional[str],
+                    document_ids: Optional[List[str]]) -> tuple:
+        """Ключ объединения запросов: нормализованный вопрос, фильтр, область и версия индекса"""
+        return (
+            AnswerCache.normalize_question(question),
+            chapter_filter,
+            tuple(sorted(document_ids)) if document_ids else None,
+            self.agents['vector'].index_version(document_ids)
+        )
+    
+    def coalescing_stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.coalesce_requests,
+            'sync': self._flight.stats(),
+            'async': self._aflight.stats(),
+            'stream': self._stream_flight.stats()
+        }
+    
+    def _get_generation_semaphore(self) -> asyncio.Semaphore:
+        if self._generation_semaphore is None:
+            self._generation_semaphore = asyncio.Semaphore(self.max_concurrent_generations)
+        return self._generation_semaphore
+    
+    def _lookup_answer(self, question: str, chapter_filter: Optional[str],
+                       document_ids: Optional[List[str]]):
+        """
+        Поиск ответа в кэше. Возвращает (ответ или None, область кэша, вектор вопроса);
+        вектор переиспользуется при поиске чанков.
+        """
+        if self.answer_cache is None:
+            return None, None, None
+        
+        scope = (
+            self.agents['vector'].index_version(document_ids),
+            chapter_filter,
+            tuple(sorted(document_ids)) if document_ids else None
+        )
+        cached = self.answer_cache.get_exact(question, scope)
+        if cached:
+            print("⚡ Ответ из кэша (точное совпадение)")
+            return cached, scope, None
+        
+        query_embedding = self.agents['vector'].embed_queries([question])[0]
+        cached = self.answer_cache.get_similar(query_embedding, scope)
+        if cached:
+            print(f"⚡ Ответ из кэша (похожий вопрос, схожесть {cached['cache']['similarity']})")
+        return cached, scope, query_embedding
+    
+    def _remember_answer(self, question: str, query_embedding, scope, result: Dict[str, Any]):
+        """
+        Сохранение в кэш только успешных ответов с источниками: ошибки генерации
+        (таймаут, недоступный сервер) не кэшируются - иначе они отдавались бы
+        и после восстановления сервера
+        """
+        if self.answer_cache is None or query_embedding is None:
+            return
+        if result.get('error') or result.get('generation_error') or not result.get('sources'):
+            return
+        result = {k: v for k, v in result.items() if k not in ('timing', 'usage')}
+        self.answer_cache.put(question, query_embedding, scope, result)
+    
+    def _retrieve(self, question: str, chapter_filter: Optional[str],
+                  document_ids: Optional[List[str]],
+                  query_embedding=None) -> List[Dict]:
+        """Поиск релевантных чанков (с переранжированием, если оно включено)"""
+        print("🔎 Поиск релевантных чанков...")
+        filters = {"chapter_id": chapter_filter} if chapter_filter else None
+        reranker = self.agents.get('reranker')
+        # Кандидатов берем с запасом: упаковщик контекста сам отберет,
+        # сколько помещается в бюджет токенов
+        context_candidates = self.config.get('context_candidates', 10)
+        top_k = self.config.get('rerank_candidates', 50) if reranker else context_candidates
+        chunks = self.agents['vector'].hierarchical_search(
+            question, top_k=top_k, filters=filters, document_ids=document_ids,
+            query_embedding=query_embedding
+        )
+        if reranker:
+            chunks = reranker.rerank(question, chunks, top_k=context_candidates)
+        found = len(chunks)
+        # Дальше (генерация, валидация, источники) идут только чанки, попавшие в бюджет
+        chunks = self.context_packer.fit(chunks)
+        print(f"   Найдено чанков: {found}, в контексте: {len(chunks)}")
+        return chunks
+    
+    def retrieve_batch(self, questions: List[str], chapter_filter: Optional[str] = None,
+                       document_ids: Optional[List[str]] = None, top_k: int = 5) -> List[List[Dict]]:
+        """
+        Пакетный поиск без генерации (оценка качества поиска, пачки вопросов):
+        один проход модели по всем вопросам и один запрос к каждой коллекции
+        """
+        if not self.is_indexed:
+            return [[] for _ in questions]
+        filters = {"chapter_id": chapter_filter} if chapter_filter else None
+        return self.agents['vector'].batch_search(
+            questions, top_k=top_k, filters=filters, document_ids=document_ids
+        )
+    
+    def _not_indexed_result(self) -> Dict[str, Any]:
+        return {
+            "error": "Сначала загрузите и обработайте документ",
+            "answer": "Документ не загружен. Пожалуйста, сначала загрузите документ."
+        }
+    
+    def _nothing_found_result(self) -> Dict[str, Any]:
+        return {
+            "answer": "По вашему запросу ничего не найдено в документе.",
+            "sources": [],
+            "confidence": 0,
+            "warnings": ["Ничего не найдено"]
+        }
+    
+    def _error_result(self, e: Exception) -> Dict[str, Any]:
+        print(f"❌ Ошибка при обработке запроса: {e}")
+        import traceback
+        traceback.print_exc()
+        return {
+            "error": str(e),
+            "answer": f"Произошла ошибка при обработке запроса: {str(e)}",
+            "sources": [],
+            "confidence": 0
+        }
+    
+    async def aclose(self):
+        """
+        Освобождение ресурсов асинхронного пути запроса
+        """
+        if 'async_generator' in self.agents:
+            await self.agents['async_generator'].close()
+        if 'reranker' in self.agents:
+            self.agents['reranker'].close()
+        self.query_executor.shutdown(wait=False)
+        self.embedder.flush_cache()
+    
+    def _structure_path(self, document_id: str) -> str:
+        if not is_valid_document_id(document_id):
+            raise ValueError(f"Недопустимый id документа: {document_id!r}")
+        return os.path.join(self.structures_dir, f"{document_id}.json")
+    
+    def _save_structure(self, document_id: str, structure: Dict):
+        os.makedirs(self.structures_dir, exist_ok=True)
+        with open(self._structure_path(document_id), 'w', encoding='utf-8') as f:
+            json.dump(structure, f, ensure_ascii=False)
+    
+    def get_document_structure(self, document_id: Optional[str] = None) -> Dict:
+        """
+        Получение структуры документа (по умолчанию - последнего обработанного)
+        """
+        if document_id is None:
+            return self.doc_structure
+        # Только документы корпуса: id из запроса не должен становиться произвольным путем
+        if document_id not in self.agents['vector'].list_documents():
+            return None
+        path = self._structure_path(document_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def list_documents(self) -> List[Dict]:
+        """
+        Список документов корпуса
+        """
+        return [
+            dict(info, document_id=document_id)
+            for document_id, info in self.agents['vector'].list_documents().items()
+        ]
     
-    def get_document_structure(self) -> Dict:
+    def delete_document(self, document_id: str) -> bool:
         """
-        Получение структуры документа
+        Удаление документа из корпуса
         """
-        return self.doc_structure
+        deleted = self.agents['vector'].delete_document(document_id)
+        if deleted and os.path.exists(self._structure_path(document_id)):
+            os.remove(self._structure_path(document_id))
+        self.is_indexed = self.agents['vector'].has_documents()
+        return deleted
     
     def get_status(self) -> Dict:
         """
@@ -231,5 +1060,7 @@ class RAGOrchestrator:
             "is_indexed": self.is_indexed,
             "has_structure": self.doc_structure is not None,
             "chapters_count": len(self.doc_structure['chapters']) if self.doc_structure else 0,
-            "agents": list(self.agents.keys())
+            "documents_count": len(self.agents['vector'].list_documents()) if 'vector' in self.agents else 0,
+            "agents": list(self.agents.keys()),
+            "embedding_model_loaded": self.embedder.is_loaded
         }
\ No newline at end of file
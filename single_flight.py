@@ -0,0 +1,139 @@
+# single_flight.py
+import copy
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных вызовов (потоки):
+    пока вызов с ключом key выполняется, остальные вызовы с тем же ключом
+    ждут его результат вместо повторного выполнения.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Dict[str, Any]] = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Результат fn() и признак того, что он получен от чужого вызова"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return copy.deepcopy(call['result']), True
+
+        try:
+            result = fn()
+            call['result'] = copy.deepcopy(result)  # копия для ожидающих, независимая от инициатора
+            return result, False
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+
+    def stats(self) -> Dict[str, int]:
+        return {'executed': self.executed, 'shared': self.shared, 'in_flight': len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """
+    Объединение одинаковых одновременных корутин. Работа выполняется отдельной
+    задачей, поэтому отмена запроса-инициатора (клиент отключился)
+    не прерывает ее для остальных ожидающих.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.shared += 1
+        else:
+            self.executed += 1
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result), shared
+
+    def stats(self) -> Dict[str, int]:
+        return {'executed': self.executed, 'shared': self.shared, 'in_flight': len(self._tasks)}
+
+
+class AsyncStreamFlight:
+    """
+    Общий поток событий для одинаковых одновременных запросов:
+    генератор выполняется один раз, все подписчики (в том числе подключившиеся
+    позже) получают события с самого начала.
+    """
+
+    def __init__(self):
+        self._streams: Dict[Hashable, Dict[str, Any]] = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def _pump(self, key: Hashable, stream: Dict[str, Any], generator: AsyncIterator):
+        try:
+            async for event in generator:
+                async with stream['condition']:
+                    stream['events'].append(event)
+                    stream['condition'].notify_all()
+        except Exception as e:
+            stream['error'] = e
+        finally:
+            self._streams.pop(key, None)
+            async with stream['condition']:
+                stream['done'] = True
+                stream['condition'].notify_all()
+
+    async def subscribe(self, key: Hashable, factory: Callable[[], AsyncIterator]) -> AsyncIterator:
+        stream = self._streams.get(key)
+        if stream is not None:
+            self.shared += 1
+        else:
+            self.executed += 1
+            stream = {'events': [], 'done': False, 'error': None, 'condition': asyncio.Condition()}
+            self._streams[key] = stream
+            stream['task'] = asyncio.ensure_future(self._pump(key, stream, factory()))
+
+        position = 0
+        while True:
+            async with stream['condition']:
+                await stream['condition'].wait_for(
+                    lambda: position < len(stream['events']) or stream['done']
+                )
+                events: List[Any] = stream['events'][position:]
+                finished = stream['done']
+            for event in events:
+                yield copy.deepcopy(event)
+            position += len(events)
+            if finished and position >= len(stream['events']):
+                break
+        if stream['error'] is not None:
+            raise stream['error']
+
+    def stats(self) -> Dict[str, int]:
+        return {'executed': self.executed, 'shared': self.shared, 'in_flight': len(self._streams)}
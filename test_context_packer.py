@@ -0,0 +1,22 @@
+# test_context_packer.py
+from agents.context_packer import ContextPacker, natural_key
+
+
+def test_natural_key_orders_numbers():
+    assert natural_key('ch_2') < natural_key('ch_10')
+
+
+def test_document_order_with_mixed_ids():
+    # id из make_document_id: с цифрами в начале и без
+    chunks = [
+        {'text': 'Гарантийный срок - 12 месяцев.',
+         'metadata': {'document_id': 'устав_cad8f342', 'chapter_id': 'ch_1', 'chunk_index': 0}},
+        {'text': 'Отчет за 2023 год.',
+         'metadata': {'document_id': '2023_отчет_6c3719c0', 'chapter_id': 'ch_1', 'chunk_index': 0}},
+        {'text': 'Срок службы - 5 лет.',
+         'metadata': {'document_id': 'a_1b2c3d4e', 'chapter_id': 'ch_2', 'chunk_index': 0}},
+    ]
+    blocks = ContextPacker(order='document').pack(chunks)
+    assert [b['metadata']['document_id'] for b in blocks] == [
+        '2023_отчет_6c3719c0', 'a_1b2c3d4e', 'устав_cad8f342'
+    ]
@@ -0,0 +1,26 @@
+# test_corpus_router.py
+import numpy as np
+
+from agents.corpus_router import CorpusRouter
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_register_remove_and_reload(tmp_path):
+    router = CorpusRouter(str(tmp_path), top_documents=1)
+    with router.deferred_save():
+        for i in range(40):  # больше начальной емкости матрицы
+            router.register(f"doc_{i}", {'filename': f"doc_{i}.docx"}, unit(np.eye(40)[i]))
+        assert not (tmp_path / "corpus.json").exists()  # запись отложена до конца блока
+    router.remove("doc_3")  # на место удаленной строки переносится последняя
+    router.register("doc_39", {'filename': "doc_39.docx"}, unit(np.eye(40)[7]))
+
+    reloaded = CorpusRouter(str(tmp_path), top_documents=1)
+    for r in (router, reloaded):
+        assert len(r.documents) == 39 and "doc_3" not in r.documents
+        assert r.route(np.eye(40)[5]) == ["doc_5"]
+        assert r.route(np.eye(40)[7], document_ids=["doc_7", "doc_39", "doc_1"])[0] in ("doc_7", "doc_39")
+        assert r.route(np.eye(40)[39]) != ["doc_39"]
@@ -0,0 +1,59 @@
+# test_doc_parser.py
+from docx import Document
+
+from agents.doc_parser import DocParserAgent, collect_sections, text_chars
+from agents.heading_classifier import classify_heading
+
+
+def test_numbered_headings():
+    assert classify_heading("1. Введение") == 1
+    assert classify_heading("2.3. Область применения") == 2
+    assert classify_heading("2.3 Область применения") == 2
+    assert classify_heading("2.3.1.4. Допуски") == 4
+    assert classify_heading("Глава 3") == 1
+    assert classify_heading("Раздел 2.1 Данные") == 2
+    assert classify_heading("IV. Итоги") == 1
+    assert classify_heading("Любой текст", "Heading 5") == 5
+
+
+def test_numbered_text_is_not_heading():
+    assert classify_heading("2024 год был трудным.") == 0
+    assert classify_heading("3.5 кг - масса прибора") == 0
+    assert classify_heading("1. Включите прибор.") == 0
+    assert classify_heading("Раздел 2 содержит описание.") == 0
+    assert classify_heading("IIII. Не римское число") == 0
+
+
+def test_hierarchy_is_lossless():
+    events = [
+        (0, "Текст до заголовков."),
+        (1, "1. Глава"), (0, "Текст главы."),
+        (2, "1.1. Раздел"), (0, "Текст раздела."),
+        (3, "1.1.1. Подраздел"), (0, "Текст подраздела."),
+        (4, "1.1.1.1. Пункт"), (0, "Текст пункта."),
+        (2, "1.2. Последний раздел"), (0, "Последний текст."),
+    ]
+    structure = DocParserAgent()._build_hierarchy(iter(events), "test.docx")
+    texts, meta = collect_sections(structure)
+
+    assert texts == [text for level, text in events if level == 0]
+    assert [m['level'] for m in meta] == [1, 1, 2, 3, 4, 2]
+    assert meta[0]['chapter_id'] == 'ch_0' and meta[0]['type'] == 'preamble'
+    assert meta[4]['subsection_id'] == 'ch_1_sec_1_sub_1_sub_1'
+    assert structure['coverage']['source_chars'] == sum(text_chars(t) for t in texts)
+
+
+def test_parse_modes_match(tmp_path):
+    path = str(tmp_path / "outline.docx")
+    doc = Document()
+    doc.add_paragraph("Преамбула")
+    doc.add_heading("Глава 1", 1)
+    doc.add_paragraph("2.3. Раздел")
+    doc.add_paragraph("Текст раздела.")
+    doc.save(path)
+
+    parser = DocParserAgent()
+    document = collect_sections(parser.parse_with_hierarchy(path, streaming=False))
+    streaming = collect_sections(parser.parse_with_hierarchy(path, streaming=True))
+    assert document == streaming
+    assert document[0] == ["Преамбула", "Текст раздела."]
@@ -0,0 +1,32 @@
+# test_embedding_cache.py
+import numpy as np
+
+from agents.embedding_cache import EmbeddingCache
+
+DIM = 65536  # 1 МБ кэша = 4 строки
+
+
+def vectors(*values):
+    return np.array([np.full(DIM, v, dtype=np.float32) for v in values])
+
+
+def test_reused_rows_after_crash(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model", max_size_mb=1, flush_every=10 ** 6)
+    keys = [cache.make_key(f"текст {i}") for i in range(6)]
+    cache.put_many(keys[:4], vectors(0, 1, 2, 3))
+    cache.flush()
+    # Вытеснение: строки первых двух ключей перезаписаны, индекс на диск не сброшен
+    cache.put_many(keys[4:], vectors(4, 5))
+
+    # «Сбой»: новый экземпляр читает старый индекс и уже перезаписанные строки
+    reopened = EmbeddingCache(str(tmp_path), "model", max_size_mb=1)
+    reopened._open(DIM)
+    found = reopened.get_many(keys)
+    assert sorted(found) == [2, 3]
+    assert found[2][0] == 2 and found[3][0] == 3
+    assert reopened.stats()['stale'] == 2
+
+    # Освобожденные строки занимаются снова, не задевая живые
+    reopened.put_many(keys[:2], vectors(0, 1))
+    found = reopened.get_many(keys[:4])
+    assert [found[i][0] for i in range(4)] == [0, 1, 2, 3]
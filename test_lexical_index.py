@@ -0,0 +1,17 @@
+# test_lexical_index.py
+from agents.lexical_index import LexicalIndex
+
+
+def test_mask_applied_before_postings_cutoff():
+    ids = [f"c{i}" for i in range(10)]
+    # Частый терм: первые постинги заняты чанками вне фильтра
+    texts = ["прибор гост-123"] * 8 + ["прибор питание", "прибор гост-123 питание"]
+    index = LexicalIndex(max_postings=3).build(ids, texts)
+
+    unfiltered = [chunk_id for chunk_id, _ in index.search("прибор гост-123", 3)]
+    assert "c9" not in unfiltered
+
+    mask = index.mask(["c8", "c9", "нет-такого"])
+    filtered = [chunk_id for chunk_id, _ in index.search("прибор гост-123", 3, mask)]
+    assert filtered[0] == "c9" and set(filtered) == {"c8", "c9"}
+    assert index.search("прибор", 3, index.mask([])) == []
@@ -0,0 +1,256 @@
+# test_llm_pool.py
+import json
+import time
+import socket
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from agents.llm_pool import LLMPool
+
+
+def make_stub(name, delay=0.0, status=200):
+    """Локальный OpenAI-совместимый сервер-заглушка"""
+
+    class Stub(BaseHTTPRequestHandler):
+        calls = 0
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, code, body, content_type="application/json"):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if Stub.status != 200:
+                return self._send(Stub.status, b"{}")
+            self._send(200, json.dumps({"data": [{"id": f"model-{name}"}]}).encode())
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            Stub.calls += 1
+            time.sleep(Stub.delay)
+            if Stub.status != 200:
+                return self._send(Stub.status, b'{"error": "stub"}')
+            if request.get("stream"):
+                chunk = json.dumps({"choices": [{"delta": {"content": name}}]})
+                return self._send(200, f"data: {chunk}\n\ndata: [DONE]\n\n".encode(), "text/event-stream")
+            self._send(200, json.dumps({"choices": [{"message": {"content": name}}]}).encode())
+
+    Stub.delay = delay
+    Stub.status = status
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v1", Stub
+
+
+def dead_url():
+    """Адрес, на котором никто не слушает"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1"
+
+
+PAYLOAD = {"model": "local-model", "messages": [{"role": "user", "content": "Привет"}]}
+
+
+def answer(response):
+    return response.json()["choices"][0]["message"]["content"]
+
+
+def test_least_outstanding_balancing():
+    print("1️⃣ Балансировка по числу запросов в работе...")
+    url_a, stub_a = make_stub("a", delay=0.2)
+    url_b, stub_b = make_stub("b", delay=0.2)
+    pool = LLMPool([url_a, url_b], health_interval=None)
+
+    threads = [threading.Thread(target=pool.post, args=("/chat/completions", PAYLOAD)) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert stub_a.calls == 3 and stub_b.calls == 3, (stub_a.calls, stub_b.calls)
+    print(f"✅ Запросы распределены: {stub_a.calls} / {stub_b.calls}")
+
+
+def test_failover_and_circuit_breaker():
+    print("2️⃣ Переключение при отказе и circuit breaker...")
+    url_ok, stub_ok = make_stub("ok")
+    url_bad, stub_bad = make_stub("bad", status=503)
+    pool = LLMPool([url_bad, dead_url(), url_ok], health_interval=None,
+                   failure_threshold=2, cooldown=60)
+
+    for _ in range(4):
+        assert answer(pool.post("/chat/completions", PAYLOAD)) == "ok"
+
+    states = {b.url: b.state for b in pool.backends}
+    assert states[url_bad] == "open"
+    assert list(states.values()).count("open") == 2
+    assert stub_bad.calls == 2  # после открытия цепи сервер больше не получает запросов
+    print(f"✅ Ответы с рабочего сервера, неисправные исключены: {states}")
+
+    # После паузы - пробный запрос; успешный возвращает сервер в пул
+    stub_bad.status = 200
+    pool.cooldown = 0
+    for _ in range(3):
+        pool.post("/chat/completions", PAYLOAD)
+    assert pool.backends[0].state == "closed"
+    print("✅ Восстановившийся сервер вернулся в пул")
+
+
+def test_health_checks():
+    print("3️⃣ Проверка здоровья через /models...")
+    url_ok, _ = make_stub("ok")
+    url_bad, stub_bad = make_stub("bad", status=500)
+    pool = LLMPool([url_bad, url_ok], health_interval=None)
+
+    report = {b["url"]: b for b in pool.check_all()}
+    assert not report[url_bad]["healthy"] and report[url_ok]["healthy"]
+    assert report[url_ok]["models"] == ["model-ok"]
+
+    stub_bad.status = 200  # нездоровый сервер не выбирается, даже будучи первым
+    assert answer(pool.post("/chat/completions", PAYLOAD)) == "ok"
+    print("✅ Нездоровый сервер исключен из балансировки")
+
+
+def test_hedged_request():
+    print("4️⃣ Хеджированный запрос...")
+    url_slow, stub_slow = make_stub("slow", delay=1.0)
+    url_fast, _ = make_stub("fast", delay=0.0)
+
+    async def run():
+        pool = LLMPool([url_slow, url_fast], health_interval=None, hedge_after_ms=100)
+        pool.backends[1].outstanding = 1  # первым выбирается медленный сервер
+        started = time.perf_counter()
+        response = await pool.apost("/chat/completions", PAYLOAD)
+        elapsed = time.perf_counter() - started
+        pool.backends[1].outstanding -= 1
+        await pool.aclose()
+        return answer(response), elapsed, pool.hedged
+
+    result, elapsed, hedged = asyncio.run(run())
+    assert result == "fast" and hedged == 1 and elapsed < 0.8, (result, elapsed, hedged)
+    print(f"✅ Ответ второго сервера за {elapsed:.2f} с вместо 1 с")
+
+
+def test_half_open_only_for_chosen_backend():
+    print("6️⃣ Пробный запрос после паузы - только выбранному серверу...")
+    url_a, _ = make_stub("a")
+    url_b, _ = make_stub("b")
+    pool = LLMPool([url_a, url_b], health_interval=None, cooldown=0)
+    for backend in pool.backends:
+        backend.state = "open"
+    pool.backends[1].outstanding = 1  # выбирается первый сервер
+
+    backend = pool._acquire()
+    assert backend is pool.backends[0] and backend.state == "half_open"
+    assert pool.backends[1].state == "open"
+    pool._release(backend, ok=True)
+    print("✅ Второй сервер остался в состоянии open")
+
+
+def test_cancelled_apost_cancels_requests():
+    print("7️⃣ Отмена асинхронного запроса отменяет запросы к серверам...")
+    url_a, _ = make_stub("a", delay=1.0)
+    url_b, _ = make_stub("b", delay=1.0)
+
+    async def run():
+        pool = LLMPool([url_a, url_b], health_interval=None, hedge_after_ms=50)
+        task = asyncio.ensure_future(pool.apost("/chat/completions", PAYLOAD))
+        await asyncio.sleep(0.2)  # основной и хеджированный запросы в работе
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await asyncio.sleep(0.05)
+        outstanding = [b.outstanding for b in pool.backends]
+        await pool.aclose()
+        return outstanding, pool.hedged
+
+    outstanding, hedged = asyncio.run(run())
+    assert hedged == 1 and outstanding == [0, 0], (outstanding, hedged)
+    print("✅ Запросы к обоим серверам отменены")
+
+
+def test_stream_read_timeout_released():
+    print("8️⃣ Таймаут до начала потока учитывается как ошибка сервера...")
+    url_slow, _ = make_stub("slow", delay=1.0)
+    url_ok, _ = make_stub("ok")
+
+    async def run():
+        pool = LLMPool([url_slow, url_ok], health_interval=None, timeout=0.2)
+        pool.backends[1].outstanding = 1  # первым выбирается медленный сервер
+        lines = []
+        async with pool.stream("/chat/completions", dict(PAYLOAD, stream=True)) as response:
+            async for line in response.aiter_lines():
+                lines.append(line)
+        pool.backends[1].outstanding -= 1
+        slow = pool.backends[0]
+        await pool.aclose()
+        return lines, slow.outstanding, slow.failures
+
+    lines, outstanding, failures = asyncio.run(run())
+    assert any('"ok"' in line for line in lines)
+    assert outstanding == 0 and failures == 1, (outstanding, failures)
+    print("✅ Медленный сервер освобожден и получил ошибку, поток - с рабочего")
+
+
+def test_cancelled_hedge_keeps_breaker_state():
+    print("9️⃣ Отмена проигравшего хеджа не закрывает цепь...")
+    url_slow, _ = make_stub("slow", delay=1.0)
+    url_fast, _ = make_stub("fast")
+
+    async def run():
+        pool = LLMPool([url_slow, url_fast], health_interval=None, hedge_after_ms=100,
+                       failure_threshold=3)
+        slow = pool.backends[0]
+        slow.consecutive_failures = 2
+        slow.state = "half_open"
+        pool.backends[1].outstanding = 1
+        response = await pool.apost("/chat/completions", PAYLOAD)
+        await asyncio.sleep(0.05)
+        pool.backends[1].outstanding -= 1
+        await pool.aclose()
+        return answer(response), slow.state, slow.consecutive_failures, slow.outstanding
+
+    result, state, failures, outstanding = asyncio.run(run())
+    assert result == "fast" and state == "half_open" and failures == 2 and outstanding == 0, \
+        (result, state, failures, outstanding)
+    print("✅ Состояние медленного сервера не изменилось")
+
+
+def test_stream_failover():
+    print("5️⃣ Потоковый запрос с переключением до начала ответа...")
+    url_ok, _ = make_stub("ok")
+
+    async def run():
+        pool = LLMPool([dead_url(), url_ok], health_interval=None)
+        lines = []
+        async with pool.stream("/chat/completions", dict(PAYLOAD, stream=True)) as response:
+            async for line in response.aiter_lines():
+                lines.append(line)
+        await pool.aclose()
+        return lines
+
+    lines = asyncio.run(run())
+    assert any('"ok"' in line for line in lines)
+    print("✅ Поток получен с рабочего сервера")
+
+
+if __name__ == "__main__":
+    test_least_outstanding_balancing()
+    test_failover_and_circuit_breaker()
+    test_health_checks()
+    test_hedged_request()
+    test_stream_failover()
+    test_half_open_only_for_chosen_backend()
+    test_cancelled_apost_cancels_requests()
+    test_stream_read_timeout_released()
+    test_cancelled_hedge_keeps_breaker_state()
+    print("\n🎉 Пул LLM работает корректно!")
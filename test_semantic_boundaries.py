@@ -0,0 +1,29 @@
+# test_semantic_boundaries.py
+import numpy as np
+
+from agents.semantic_boundaries import enforce_chunk_sizes, percentile_breaks
+
+
+def test_percentile_ties_do_not_all_break():
+    similarities = np.array([0.2] * 20 + [0.9] * 80, dtype=np.float32)
+    assert percentile_breaks(similarities, percentile=10).sum() == 10
+    assert percentile_breaks(np.zeros(0), percentile=10).sum() == 0
+
+
+def test_merge_never_exceeds_max_size():
+    # 10 символов не сливаются с 495: вместе больше max_size
+    assert enforce_chunk_sizes([10, 495], np.array([1]), min_size=100, max_size=500) == [0, 1, 2]
+    # Короткий чанк уходит к меньшему соседу
+    bounds = enforce_chunk_sizes([300, 20, 150], np.array([1, 2]), min_size=100, max_size=500)
+    assert bounds == [0, 1, 3]
+
+
+def test_sizes_within_limits():
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(5, 200, size=300).tolist()
+    breaks = np.flatnonzero(rng.random(299) < 0.3) + 1
+    bounds = enforce_chunk_sizes(lengths, breaks, min_size=100, max_size=500)
+    cum = np.concatenate([[0], np.cumsum(np.asarray(lengths) + 1)])
+    sizes = np.diff(cum[bounds]) - 1
+    assert bounds[0] == 0 and bounds[-1] == len(lengths)
+    assert (sizes <= 500).all()
@@ -0,0 +1,58 @@
+# test_vector_agent.py
+import numpy as np
+import pytest
+
+from agents.vector_agent import VectorAgent
+
+
+class StubEmbedder:
+    """Детерминированные векторы без модели"""
+
+    def encode_cached(self, texts, batch_size=32):
+        return np.array([[len(text) % 7 + 1.0, sum(map(ord, text)) % 11 + 1.0, 1.0]
+                         for text in texts], dtype=np.float32)
+
+    encode = encode_cached
+
+
+def meta(chapter_id, chapter_title):
+    return {'chapter_id': chapter_id, 'chapter_title': chapter_title, 'level': 1, 'type': 'chapter'}
+
+
+@pytest.fixture
+def agent(tmp_path):
+    return VectorAgent(db_path=str(tmp_path), embedder=StubEmbedder())
+
+
+def test_inserted_heading_keeps_other_ids(agent):
+    first = agent.create_index(["Текст введения.", "Текст основы."],
+                               [meta(1, "Введение"), meta(2, "Основы")], document_id="doc")
+    assert first['added'] == 2
+    # Новая глава в начале сдвигает номера, но не названия
+    delta = agent.create_index(["Текст обзора.", "Текст введения.", "Текст основы."],
+                               [meta(1, "Обзор"), meta(2, "Введение"), meta(3, "Основы")],
+                               document_id="doc")
+    assert (delta['added'], delta['deleted'], delta['unchanged']) == (1, 0, 2)
+    stored = agent.collections["doc"].get(include=['metadatas', 'documents'])
+    chapters = {doc: m['chapter_id'] for doc, m in zip(stored['documents'], stored['metadatas'])}
+    assert chapters["Текст основы."] == 3
+
+
+def test_abort_restores_metadata(agent):
+    agent.create_index(["Текст введения."], [meta(1, "Введение")], document_id="doc")
+    session = agent.begin_index("doc")
+    agent.write_batch(session, ["Текст введения.", "Новый текст."],
+                      [dict(meta(1, "Введение"), level=2, extra="x"), meta(2, "Новое")])
+    agent.abort_index(session)
+    stored = agent.collections["doc"].get(include=['metadatas'])
+    assert len(stored['ids']) == 1
+    assert stored['metadatas'][0]['level'] == 1 and 'extra' not in stored['metadatas'][0]
+
+
+def test_abort_drops_new_document(agent):
+    session = agent.begin_index("fresh")
+    agent.write_batch(session, ["Текст."], [meta(1, "Глава")])
+    agent.abort_index(session)
+    assert "fresh" not in agent.collections
+    names = [c if isinstance(c, str) else c.name for c in agent.client.list_collections()]
+    assert session['name'] not in names
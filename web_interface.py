@@ -1,11 +1,17 @@
-from fastapi import FastAPI, UploadFile, File, Form, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, Request, Query
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 import os
+import json
+import uuid
 import shutil
 from pathlib import Path
+from typing import List, Optional
 from orchestrator import RAGOrchestrator
+from agents.embedding_provider import registered_embedders
+from agents.corpus_router import make_document_id
+from job_queue import IngestionJobQueue, QueueFullError
 import traceback
 
 app = FastAPI(title="DocMind Local RAG")
@@ -19,6 +25,82 @@ print("🔄 Инициализация глобального оркестрат
 orchestrator = RAGOrchestrator("config.yaml")
 print(f"✅ Оркестратор инициализирован: {orchestrator}")
 
+def save_upload(file: UploadFile) -> Path:
+    """
+    Сохранение загруженного файла в отдельную папку (uploads/<uuid>/<имя>):
+    одноименные загрузки не перезаписывают файл, который еще читает задача
+    в очереди, а имя файла (название документа) сохраняется
+    """
+    folder = UPLOAD_DIR / uuid.uuid4().hex
+    folder.mkdir()
+    file_path = folder / Path(file.filename).name
+    try:
+        with open(file_path, "wb") as buffer:
+            shutil.copyfileobj(file.file, buffer)
+    except Exception:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    return file_path
+
+def remove_uploads(paths):
+    """Удаление папок загрузок, созданных save_upload"""
+    for path in paths:
+        folder = Path(path).parent
+        if folder.parent.resolve() == UPLOAD_DIR.resolve():
+            shutil.rmtree(folder, ignore_errors=True)
+
+def process_upload(payload, progress):
+    """Обработка загруженного документа (выполняется воркером очереди)"""
+    try:
+        if 'file_paths' in payload:
+            return process_batch(payload, progress)
+        return process_single(payload, progress)
+    finally:
+        # Копия загрузки нужна только на время обработки
+        remove_uploads(payload.get('uploaded_paths', []))
+
+def process_single(payload, progress):
+    print(f"🔄 Обработка документа: {payload['filename']}")
+    result = orchestrator.process_document(payload['file_path'], document_id=payload['document_id'],
+                                           progress=progress)
+    
+    print(f"✅ Документ обработан успешно!")
+    print(f"   Глав: {result['chapters_count']}")
+    print(f"   Чанков: {result['chunks_count']}")
+    
+    return {
+        "status": "success",
+        "document_id": result['document_id'],
+        "filename": payload['filename'],
+        "chapters": result['chapters_count'],
+        "chunks": result['chunks_count'],
+        "index_delta": result.get('index_delta'),
+        "coverage": result.get('coverage'),
+        "structure": result['structure']
+    }
+
+def process_batch(payload, progress):
+    """Пакетная загрузка нескольких документов (пул процессов, общий кодировщик)"""
+    report = orchestrator.process_documents(payload['file_paths'], progress=progress,
+                                            document_ids=payload.get('document_ids'))
+    return dict(report, status="success" if not report['failed'] else "partial")
+
+job_queue = IngestionJobQueue(
+    process_upload,
+    workers=orchestrator.config.get('ingest_workers', 1),
+    max_queued=orchestrator.config.get('ingest_queue_size', 8)
+)
+
+@app.on_event("startup")
+async def warmup_models():
+    """Фоновая загрузка модели эмбеддингов - порт открывается сразу"""
+    orchestrator.warmup(background=True)
+
+@app.on_event("shutdown")
+async def close_clients():
+    """Закрытие HTTP-клиента генератора и пула потоков запросов"""
+    await orchestrator.aclose()
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
     """Главная страница"""
@@ -110,6 +192,13 @@ async def root():
                 display: flex;
                 gap: 10px;
             }
+            select {
+                padding: 12px;
+                border: 2px solid #e0e0e0;
+                border-radius: 8px;
+                font-size: 16px;
+                max-width: 300px;
+            }
             input[type="text"] {
                 flex: 1;
                 padding: 12px;
@@ -220,6 +309,9 @@ async def root():
             <div class="query-section" id="query-section">
                 <h2>❓ Задайте вопрос по документу</h2>
                 <div class="query-input">
+                    <select id="doc-scope">
+                        <option value="">Все документы</option>
+                    </select>
                     <input type="text" id="query-input" placeholder="Введите ваш вопрос...">
                     <button onclick="askQuestion()">Отправить</button>
                 </div>
@@ -237,6 +329,27 @@ async def root():
         <script>
             let isDocumentLoaded = false;
             
+            async function loadDocuments() {
+                try {
+                    const response = await fetch('/documents');
+                    const documents = await response.json();
+                    const scope = document.getElementById('doc-scope');
+                    const selected = scope.value;
+                    scope.innerHTML = '<option value="">Все документы</option>';
+                    documents.forEach(doc => {
+                        scope.innerHTML += `<option value="${doc.document_id}">${doc.filename || doc.document_id}</option>`;
+                    });
+                    scope.value = selected;
+                    if (documents.length > 0) {
+                        document.getElementById('query-section').style.display = 'block';
+                        isDocumentLoaded = true;
+                    }
+                } catch (error) {
+                    console.error('Не удалось загрузить список документов', error);
+                }
+            }
+            loadDocuments();
+            
             document.getElementById('file-input').addEventListener('change', async function(e) {
                 const file = e.target.files[0];
                 if (!file) return;
@@ -247,33 +360,79 @@ async def root():
                 const progressBar = document.getElementById('progress-bar');
                 const progressFill = document.getElementById('progress-fill');
                 progressBar.style.display = 'block';
-                progressFill.style.width = '50%';
+                progressFill.style.width = '5%';
                 
                 try {
                     const response = await fetch('/upload', {
                         method: 'POST',
                         body: formData
                     });
+                    const data = await response.json();
                     
-                    progressFill.style.width = '100%';
+                    if (!response.ok) {
+                        alert(data.error || 'Ошибка загрузки файла');
+                        progressBar.style.display = 'none';
+                        return;
+                    }
+                    
+                    pollJob(data.job_id);
+                } catch (error) {
+                    alert('Ошибка загрузки файла');
+                    progressBar.style.display = 'none';
+                }
+            });
+            
+            function jobProgressPercent(job) {
+                const p = job.progress || {};
+                switch (job.stage) {
+                    case 'queued': return 5;
+                    case 'started':
+                    case 'parsing': return 10;
+                    case 'parsed': return 20;
+                    case 'chunking':
+                        return 20 + (p.sections_total ? 40 * p.sections_done / p.sections_total : 0);
+                    case 'embedding':
+                        return 60 + (p.chunks_to_embed ? 35 * p.chunks_embedded / p.chunks_to_embed : 0);
+                    default: return 100;
+                }
+            }
+            
+            async function pollJob(jobId) {
+                const progressBar = document.getElementById('progress-bar');
+                const progressFill = document.getElementById('progress-fill');
+                
+                try {
+                    const response = await fetch(`/jobs/${jobId}`);
+                    const job = await response.json();
+                    progressFill.style.width = `${jobProgressPercent(job)}%`;
                     
-                    if (response.ok) {
-                        const data = await response.json();
+                    if (job.status === 'done') {
                         setTimeout(() => {
                             progressBar.style.display = 'none';
                             progressFill.style.width = '0%';
-                            showDocumentInfo(data);
+                            showDocumentInfo(job.result);
                         }, 500);
+                        return;
+                    }
+                    if (job.status === 'failed') {
+                        alert(`Ошибка обработки документа: ${job.error}`);
+                        progressBar.style.display = 'none';
+                        return;
                     }
                 } catch (error) {
-                    alert('Ошибка загрузки файла');
-                    progressBar.style.display = 'none';
+                    console.error('Ошибка получения статуса задачи', error);
                 }
-            });
+                setTimeout(() => pollJob(jobId), 1000);
+            }
             
             function showDocumentInfo(data) {
                 document.getElementById('doc-name').innerHTML = `<strong>Файл:</strong> ${data.filename}`;
-                document.getElementById('doc-stats').innerHTML = `<strong>Глав:</strong> ${data.chapters} | <strong>Чанков:</strong> ${data.chunks}`;
+                let statsHtml = `<strong>Глав:</strong> ${data.chapters} | <strong>Чанков:</strong> ${data.chunks}`;
+                if (data.index_delta) {
+                    const d = data.index_delta;
+                    statsHtml += ` | <strong>Индекс:</strong> +${d.added} / -${d.deleted} / без изменений ${d.unchanged}`;
+                }
+                document.getElementById('doc-stats').innerHTML = statsHtml;
                 
                 // Отображаем структуру
                 const structure = data.structure;
@@ -290,9 +449,50 @@ async def root():
                 document.getElementById('document-info').style.display = 'block';
                 document.getElementById('query-section').style.display = 'block';
                 isDocumentLoaded = true;
+                loadDocuments();
+            }
+            
+            function renderResult(data) {
+                const answerDiv = document.getElementById('answer');
+                const confidenceDiv = document.getElementById('confidence');
+                const warningsDiv = document.getElementById('warnings');
+                const sourcesDiv = document.getElementById('sources');
+                
+                answerDiv.innerHTML = data.answer.replace(/\\n/g, '<br>');
+                
+                // Уверенность
+                const confidencePercent = Math.round((data.confidence || 0) * 100);
+                let confidenceClass = 'confidence';
+                let confidenceText = `Уверенность: ${confidencePercent}%`;
+                if (data.timing) {
+                    confidenceText += ` | Первый токен: ${data.timing.ttft_ms} мс | Всего: ${data.timing.total_ms} мс`;
+                }
+                confidenceDiv.innerHTML = `<span class="${confidenceClass}">${confidenceText}</span>`;
+                
+                // Предупреждения
+                if (data.warnings && data.warnings.length > 0) {
+                    let warningsHtml = '';
+                    data.warnings.forEach(warning => {
+                        warningsHtml += `<div class="warning">${warning}</div>`;
+                    });
+                    warningsDiv.innerHTML = warningsHtml;
+                } else {
+                    warningsDiv.innerHTML = '';
+                }
+                
+                // Источники
+                if (data.sources && data.sources.length > 0) {
+                    let sourcesHtml = '<h4>📚 Источники:</h4>';
+                    data.sources.forEach(source => {
+                        sourcesHtml += `<div class="source-item">📖 ${source.chapter} → 📌 ${source.section}</div>`;
+                    });
+                    sourcesDiv.innerHTML = sourcesHtml;
+                } else {
+                    sourcesDiv.innerHTML = '';
+                }
             }
             
-            async function askQuestion() {
+            function askQuestion() {
                 const query = document.getElementById('query-input').value;
                 if (!query) {
                     alert('Введите вопрос');
@@ -301,48 +501,39 @@ async def root():
                 
                 const resultDiv = document.getElementById('result');
                 const answerDiv = document.getElementById('answer');
-                const confidenceDiv = document.getElementById('confidence');
-                const warningsDiv = document.getElementById('warnings');
-                const sourcesDiv = document.getElementById('sources');
                 
                 answerDiv.innerHTML = '🤔 Генерация ответа...';
+                document.getElementById('confidence').innerHTML = '';
+                document.getElementById('warnings').innerHTML = '';
+                document.getElementById('sources').innerHTML = '';
                 resultDiv.style.display = 'block';
                 
-                try {
-                    const response = await fetch(`/query?q=${encodeURIComponent(query)}`);
-                    const data = await response.json();
-                    
-                    answerDiv.innerHTML = data.answer.replace(/\\n/g, '<br>');
-                    
-                    // Уверенность
-                    const confidencePercent = Math.round(data.confidence * 100);
-                    let confidenceClass = 'confidence';
-                    let confidenceText = `Уверенность: ${confidencePercent}%`;
-                    confidenceDiv.innerHTML = `<span class="${confidenceClass}">${confidenceText}</span>`;
-                    
-                    // Предупреждения
-                    if (data.warnings && data.warnings.length > 0) {
-                        let warningsHtml = '';
-                        data.warnings.forEach(warning => {
-                            warningsHtml += `<div class="warning">${warning}</div>`;
-                        });
-                        warningsDiv.innerHTML = warningsHtml;
-                    } else {
-                        warningsDiv.innerHTML = '';
-                    }
-                    
-                    // Источники
-                    if (data.sources && data.sources.length > 0) {
-                        let sourcesHtml = '<h4>📚 Источники:</h4>';
-                        data.sources.forEach(source => {
-                            sourcesHtml += `<div class="source-item">📖 ${source.chapter} → 📌 ${source.section}</div>`;
-                        });
-                        sourcesDiv.innerHTML = sourcesHtml;
-                    }
-                    
-                } catch (error) {
-                    answerDiv.innerHTML = '❌ Ошибка при получении ответа';
+                // Ответ приходит по токенам через SSE
+                const scope = document.getElementById('doc-scope').value;
+                let url = `/query/stream?q=${encodeURIComponent(query)}`;
+                if (scope) {
+                    url += `&doc=${encodeURIComponent(scope)}`;
                 }
+                
+                let answerText = '';
+                const source = new EventSource(url);
+                
+                source.addEventListener('token', event => {
+                    answerText += JSON.parse(event.data).text;
+                    answerDiv.textContent = answerText;
+                });
+                
+                source.addEventListener('done', event => {
+                    source.close();
+                    renderResult(JSON.parse(event.data));
+                });
+                
+                source.onerror = () => {
+                    source.close();
+                    if (!answerText) {
+                        answerDiv.innerHTML = '❌ Ошибка при получении ответа';
+                    }
+                };
             }
         </script>
     </body>
@@ -363,11 +554,10 @@ async def upload_document(file: UploadFile = File(...)):
             content={"error": "Только .docx файлы поддерживаются"}
         )
     
-    # Сохраняем файл
-    file_path = UPLOAD_DIR / file.filename
+    # Сохраняем файл в отдельную папку; id документа - по исходному имени
+    filename = Path(file.filename).name
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        file_path = save_upload(file)
         print(f"✅ Файл сохранен: {file_path}")
     except Exception as e:
         print(f"❌ Ошибка сохранения файла: {e}")
@@ -376,54 +566,133 @@ async def upload_document(file: UploadFile = File(...)):
             content={"error": f"Ошибка сохранения файла: {str(e)}"}
         )
     
-    # Обрабатываем документ через ГЛОБАЛЬНЫЙ оркестратор
+    # Ставим обработку в очередь - ответ возвращается сразу,
+    # прогресс доступен через /jobs/{job_id}
     try:
-        print(f"🔄 Вызов orchestrator.process_document()")
-        print(f"   orchestrator: {orchestrator}")
-        print(f"   Доступные методы: {dir(orchestrator)}")
+        job = job_queue.submit({
+            'file_path': str(file_path),
+            'uploaded_paths': [str(file_path)],
+            'filename': filename,
+            'document_id': make_document_id(filename)
+        })
+    except QueueFullError as e:
+        remove_uploads([file_path])  # отклоненная загрузка не оставляет файла
+        print(f"⚠️ {e}")
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": "10"},
+            content={"error": str(e)}
+        )
+    
+    print(f"✅ Задача поставлена в очередь: {job['id']}")
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "queued",
+            "job_id": job['id'],
+            "filename": filename,
+            "queue_position": job.get('queue_position')
+        }
+    )
+
+@app.post("/ingest/batch")
+async def ingest_batch(files: List[UploadFile] = File(default=[]), directory: Optional[str] = Form(None)):
+    """
+    Пакетная загрузка: несколько .docx файлов и/или папка на сервере.
+    directory - путь внутри batch_ingest_root из конфига (без него параметр отключен).
+    Обрабатывается одной задачей очереди; отчет о пропускной способности - в /jobs/{job_id}
+    """
+    from agents.batch_documents import find_documents
+    
+    file_paths = []
+    document_ids = []
+    if directory:
+        root = orchestrator.config.get('batch_ingest_root')
+        if not root:
+            return JSONResponse(status_code=403, content={"error": "Загрузка папки с сервера отключена (batch_ingest_root)"})
+        root = os.path.realpath(root)
+        target = os.path.realpath(os.path.join(root, directory))
+        
+        def inside_root(path):
+            return os.path.commonpath([root, os.path.realpath(path)]) == root
         
-        # Проверяем наличие метода
-        if not hasattr(orchestrator, 'process_document'):
-            print("❌ У orchestrator нет метода process_document!")
+        if not inside_root(target):
+            return JSONResponse(status_code=403, content={"error": f"Папка {directory} вне batch_ingest_root"})
+        if not os.path.isdir(target):
+            return JSONResponse(status_code=400, content={"error": f"Папка {directory} не найдена"})
+        # Ссылки, ведущие за пределы корня, пропускаются; id - по пути от корня
+        for path, document_id in find_documents([target], root=root):
+            if inside_root(path):
+                file_paths.append(path)
+                document_ids.append(document_id)
+    
+    # Загруженные файлы сохраняются после проверки папки - каждый в свою папку
+    uploaded = []
+    for file in files:
+        if not file.filename.endswith('.docx'):
+            continue
+        try:
+            file_path = save_upload(file)
+        except Exception as e:
+            remove_uploads(uploaded)
             return JSONResponse(
                 status_code=500,
-                content={"error": "Внутренняя ошибка сервера: отсутствует метод process_document"}
+                content={"error": f"Ошибка сохранения файла {file.filename}: {str(e)}"}
             )
-        
-        result = orchestrator.process_document(str(file_path))
-        
-        print(f"✅ Документ обработан успешно!")
-        print(f"   Глав: {result['chapters_count']}")
-        print(f"   Чанков: {result['chunks_count']}")
-        
-        return {
-            "status": "success",
-            "filename": file.filename,
-            "chapters": result['chapters_count'],
-            "chunks": result['chunks_count'],
-            "structure": result['structure']
+        uploaded.append(str(file_path))
+        file_paths.append(str(file_path))
+        document_ids.append(make_document_id(Path(file.filename).name))
+    
+    if not file_paths:
+        return JSONResponse(status_code=400, content={"error": "Нет .docx файлов для загрузки"})
+    
+    try:
+        job = job_queue.submit({'file_paths': file_paths, 'document_ids': document_ids,
+                                'uploaded_paths': uploaded,
+                                'filename': f"Пакетная загрузка ({len(file_paths)} шт.)"})
+    except QueueFullError as e:
+        remove_uploads(uploaded)
+        print(f"⚠️ {e}")
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": "10"},
+            content={"error": str(e)}
+        )
+    
+    print(f"✅ Пакетная задача поставлена в очередь: {job['id']} ({len(file_paths)} документов)")
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "queued",
+            "job_id": job['id'],
+            "documents": len(file_paths),
+            "queue_position": job.get('queue_position')
         }
-    except Exception as e:
-        print(f"❌ ОШИБКА при обработке документа:")
-        print(f"   {str(e)}")
-        import traceback
-        traceback.print_exc()
-        
+    )
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Состояние задачи обработки документа"""
+    job = job_queue.get(job_id)
+    if job is None:
         return JSONResponse(
-            status_code=500,
-            content={
-                "error": str(e),
-                "traceback": traceback.format_exc()
-            }
+            status_code=404,
+            content={"error": f"Задача {job_id} не найдена"}
         )
+    return job
+
+@app.get("/jobs")
+async def list_jobs():
+    """Список задач обработки документов"""
+    return job_queue.list()
 
 @app.get("/query")
-async def query(q: str):
-    """Запрос к документу"""
+async def query(q: str, doc: Optional[List[str]] = Query(None)):
+    """Запрос к документу (doc - id документов области поиска, по умолчанию весь корпус)"""
     print(f"\n❓ ПОЛУЧЕН ЗАПРОС: {q}")
     
     try:
-        result = orchestrator.query_document(q)
+        result = await orchestrator.aquery_document(q, document_ids=doc)
         print(f"✅ Ответ сгенерирован. Уверенность: {result.get('confidence', 0)}")
         return result
     except Exception as e:
@@ -434,19 +703,59 @@ async def query(q: str):
             content={"error": str(e)}
         )
 
+@app.get("/query/stream")
+async def query_stream(q: str, doc: Optional[List[str]] = Query(None)):
+    """Потоковый ответ (Server-Sent Events): события token и done"""
+    print(f"\n❓ ПОЛУЧЕН ПОТОКОВЫЙ ЗАПРОС: {q}")
+    
+    async def events():
+        async for event, data in orchestrator.astream_query(q, document_ids=doc):
+            yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/structure")
-async def get_structure():
-    """Получение структуры документа"""
-    structure = orchestrator.get_document_structure()
+async def get_structure(doc: Optional[str] = None):
+    """Получение структуры документа (по умолчанию - последнего загруженного)"""
+    structure = orchestrator.get_document_structure(doc)
     return structure
 
+@app.get("/documents")
+async def list_documents():
+    """Список документов корпуса"""
+    return orchestrator.list_documents()
+
+@app.delete("/documents/{document_id}")
+async def delete_document(document_id: str):
+    """Удаление документа из корпуса"""
+    if not orchestrator.delete_document(document_id):
+        return JSONResponse(
+            status_code=404,
+            content={"error": f"Документ {document_id} не найден"}
+        )
+    return {"status": "deleted", "document_id": document_id}
+
 @app.get("/debug")
 async def debug():
     """Отладочная информация"""
     return {
         "orchestrator_exists": orchestrator is not None,
         "is_indexed": orchestrator.is_indexed if orchestrator else False,
-        "doc_structure": orchestrator.doc_structure is not None
+        "doc_structure": orchestrator.doc_structure is not None,
+        "documents_count": len(orchestrator.list_documents()),
+        "jobs": job_queue.stats(),
+        "answer_cache": orchestrator.answer_cache.stats() if orchestrator.answer_cache else None,
+        "coalescing": orchestrator.coalescing_stats(),
+        "last_coverage": orchestrator.last_coverage,
+        "query_embedding_cache": orchestrator.agents['vector'].query_cache_stats() if 'vector' in orchestrator.agents else None,
+        "reranker": orchestrator.agents['reranker'].stats() if 'reranker' in orchestrator.agents else None,
+        "prompt_tokens": orchestrator.prompt_stats,
+        "llm_pool": orchestrator.llm_pool.stats(),
+        "embedders": registered_embedders()
     }
 
 def start_server():